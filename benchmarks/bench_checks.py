@@ -0,0 +1,43 @@
+import time
+
+import pytest
+
+from sauna import Sauna
+
+
+def create_sauna(num_checks, concurrency):
+    return Sauna(config={
+        'concurrency': concurrency,
+        'plugins': [{
+            'type': 'Dummy',
+            'checks': [{'type': 'dummy', 'name': 'dummy_{}'.format(i),
+                        'status': 0, 'output': 'OK'}
+                       for i in range(num_checks)]
+        }]
+    })
+
+
+def wait_for_checks(sauna):
+    while True:
+        with sauna._current_checks_lock:
+            if not sauna._current_checks:
+                return
+        time.sleep(0.0001)
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def bench_check_throughput(benchmark, concurrency):
+    sauna = create_sauna(100, concurrency)
+    checks = sauna.check_registry.checks
+
+    def run_checks():
+        sauna.launch_and_publish_checks(checks)
+        wait_for_checks(sauna)
+
+    try:
+        benchmark(run_checks)
+    finally:
+        for executor in (sauna._thread_pool, sauna._serial_executor):
+            if executor is not None:
+                executor.shutdown()
+        sauna._watchdog.shutdown()
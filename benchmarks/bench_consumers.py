@@ -0,0 +1,258 @@
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+from queue import Queue
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from sauna import ServiceCheck, result_store
+from sauna.consumers.base import BatchQueuedConsumer
+from sauna.consumers.ext import nsca
+from sauna.consumers.ext.tcp_server import TCPServerConsumer
+from sauna.consumers.ext.http_server import HTTPServerConsumer
+
+
+def service_check(i=0):
+    return ServiceCheck(timestamp=int(time.time()), hostname='node-1',
+                        name='check_{}'.format(i), status=0,
+                        output='Everything is fine')
+
+
+class CountingConsumer(BatchQueuedConsumer):
+    """Consumer stopping once it sent a given number of checks."""
+
+    def __init__(self, config, num_checks, must_stop):
+        super().__init__(config)
+        self._remaining = num_checks
+        self._must_stop = must_stop
+
+    def _send_batch(self, service_checks):
+        self._remaining -= len(service_checks)
+        if self._remaining <= 0:
+            self._must_stop.set()
+
+
+@pytest.mark.parametrize('max_batch_size', [1, 64])
+def bench_batch_queued_consumer_run(benchmark, max_batch_size):
+    # A multiple of the batch sizes, no batch waits for more checks
+    num_checks = 1024
+    checks = [service_check(i) for i in range(num_checks)]
+
+    def setup():
+        must_stop = threading.Event()
+        consumer = CountingConsumer({}, num_checks, must_stop)
+        consumer.max_batch_size = max_batch_size
+        queue = Queue()
+        for check in checks:
+            queue.put(check)
+        return (must_stop, queue), {'consumer': consumer}
+
+    def run(must_stop, queue, consumer):
+        consumer.run(must_stop, queue)
+
+    benchmark.pedantic(run, setup=setup, rounds=20)
+
+
+@pytest.mark.parametrize('encryption', [0, 1])
+def bench_nsca_encode_encrypt(benchmark, encryption):
+    consumer = nsca.NSCAConsumer({'encryption': encryption,
+                                  'key': 'verylongkey'})
+    checks = [service_check(i) for i in range(100)]
+    iv = bytes(range(128))
+
+    def encode_encrypt():
+        for check in checks:
+            payload = consumer._encode_service_payload(check)
+            consumer._encrypt_service_payload(payload, iv)
+
+    benchmark(encode_encrypt)
+    if benchmark.stats is not None:
+        benchmark.extra_info['packets_per_second'] = int(
+            len(checks) / benchmark.stats.stats.mean
+        )
+
+
+class NSCAReceiver:
+    """Stand-in NSCA server discarding the checks it receives."""
+
+    def __init__(self):
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(128)
+        self.port = self.socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        init_payload = struct.pack(nsca.NSCAConsumer.init_payload_fmt,
+                                   bytes(128), int(time.time()))
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            with conn:
+                conn.sendall(init_payload)
+                while conn.recv(65536):
+                    pass
+
+    def close(self):
+        self.socket.close()
+
+
+@pytest.fixture
+def nsca_receiver():
+    receiver = NSCAReceiver()
+    yield receiver
+    receiver.close()
+
+
+@pytest.mark.parametrize('batch_size', [1, 64])
+def bench_nsca_send(benchmark, nsca_receiver, batch_size):
+    consumer = nsca.NSCAConsumer({'server': '127.0.0.1',
+                                  'port': nsca_receiver.port,
+                                  'encryption': 1, 'key': 'verylongkey'})
+    checks = [service_check(i) for i in range(batch_size)]
+
+    def send_batch():
+        # Sent checks are removed from the batch
+        consumer._send_batch(list(checks))
+
+    benchmark(send_batch)
+
+
+@pytest.fixture
+def http_server():
+    for i in range(200):
+        result_store.publish(service_check(i))
+    must_stop = threading.Event()
+    consumer = HTTPServerConsumer({'address': '127.0.0.1', 'port': 0,
+                                   'max_threads': 16})
+    server = consumer._create_server(must_stop)
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    yield server
+    must_stop.set()
+    thread.join()
+    server.server_close()
+    result_store.clear()
+
+
+@pytest.mark.parametrize('clients', [1, 8])
+def bench_http_server_latency(benchmark, http_server, clients):
+    port = http_server.server_address[1]
+    requests_per_client = 10
+
+    def get_status():
+        for _ in range(requests_per_client):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            assert response.status == 200
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+
+        def concurrent_requests():
+            futures = [pool.submit(get_status) for _ in range(clients)]
+            for future in futures:
+                future.result()
+
+        benchmark(concurrent_requests)
+
+
+@pytest.mark.parametrize('clients', [1, 16, 200])
+def bench_http_server_keep_alive_load(benchmark, http_server, clients):
+    port = http_server.server_address[1]
+    requests_per_client = 20
+
+    def scrape():
+        # Scrapers reuse their connection and get 304 while nothing changes
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        etag = None
+        for _ in range(requests_per_client):
+            conn.request('GET', '/', headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': etag or ''
+            })
+            response = conn.getresponse()
+            response.read()
+            assert response.status in (200, 304)
+            etag = response.getheader('ETag')
+        conn.close()
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+
+        def concurrent_scrapes():
+            futures = [pool.submit(scrape) for _ in range(clients)]
+            for future in futures:
+                future.result()
+
+        benchmark.pedantic(concurrent_scrapes, rounds=5)
+
+    if benchmark.stats is not None:
+        benchmark.extra_info['requests_per_second'] = int(
+            clients * requests_per_client / benchmark.stats.stats.mean
+        )
+
+
+@pytest.mark.parametrize('idle_clients', [0, 16])
+def bench_http_server_idle_keep_alive_clients(benchmark, http_server,
+                                              idle_clients):
+    # Probers keeping their connection open between two requests must not
+    # make other clients wait for the keep-alive timeout
+    port = http_server.server_address[1]
+    idle = []
+    for _ in range(idle_clients):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/')
+        conn.getresponse().read()
+        idle.append(conn)
+
+    def get_status():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        assert response.status == 200
+
+    benchmark(get_status)
+    for conn in idle:
+        conn.close()
+
+
+@pytest.fixture
+def tcp_server():
+    must_stop = threading.Event()
+    consumer = TCPServerConsumer({'port': 0, 'keepalive': False})
+    thread = threading.Thread(target=consumer.run, args=(must_stop,),
+                              daemon=True)
+    thread.start()
+    while consumer.selector is None:
+        time.sleep(0.01)
+    yield consumer
+    must_stop.set()
+    thread.join()
+
+
+@pytest.mark.parametrize('idle_clients', [0, 1000])
+def bench_tcp_server_idle_clients(benchmark, tcp_server, idle_clients):
+    # Like load balancers probing the server, idle clients stay connected
+    address = ('127.0.0.1', tcp_server.server.getsockname()[1])
+    idle = [socket.create_connection(address) for _ in range(idle_clients)]
+    client = socket.create_connection(address, timeout=10)
+    client.recv(64)
+
+    def get_status():
+        client.sendall(b'\n')
+        assert client.recv(64).endswith(b'\n')
+
+    benchmark(get_status)
+    client.close()
+    for s in idle:
+        s.close()
@@ -0,0 +1,23 @@
+import pytest
+
+from sauna.scheduler import Scheduler, Job
+
+
+def noop():
+    pass
+
+
+@pytest.mark.parametrize('num_jobs', [10, 100, 1000, 10000])
+def bench_scheduler_next(benchmark, num_jobs):
+    jobs = [Job(1 + i % 60, noop) for i in range(num_jobs)]
+    for i, job in enumerate(jobs):
+        job.offset = i / num_jobs
+    now = [0]
+    scheduler = Scheduler(jobs, clock=lambda: now[0])
+
+    def next_jobs():
+        # Time jumps to the next deadline, as if the producer slept until it
+        now[0] = scheduler.next_deadline
+        return next(scheduler)
+
+    benchmark(next_jobs)
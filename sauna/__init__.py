@@ -1,6 +1,5 @@
 from collections import namedtuple
 import threading
-import queue
 from logging import getLogger
 import time
 import socket
@@ -13,26 +12,43 @@ import re
 import sys
 import glob
 import functools
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from concurrent.futures import Future
 
 from sauna import plugins, consumers
-from sauna.plugins.base import Check
+from sauna.plugins.base import Check, CheckRegistry, Plugin
 from sauna.consumers.base import BatchQueuedConsumer, QueuedConsumer
 from sauna.consumers import ConsumerRegister
 from sauna.plugins import PluginRegister
-from sauna.scheduler import Scheduler, Job
+from sauna.scheduler import Scheduler, Job, splay_offset
+from sauna.results import ResultStore
+from sauna.executors import (SerialExecutor, ThreadExecutor,
+                             AsyncioExecutor, ProcessExecutor, Watchdog,
+                             CheckTimeoutError)
+from sauna import metrics
 
 __version__ = '0.0.19'
 logger = getLogger(__name__)
 
+overruns = metrics.counter(
+    'sauna_check_overruns_total',
+    'Number of times a check did not complete before its timeout'
+)
+skipped_runs = metrics.counter(
+    'sauna_check_skipped_runs_total',
+    'Number of runs skipped because the previous one was not finished'
+)
+check_durations = metrics.histogram(
+    'sauna_check_duration_seconds',
+    'Time taken by checks to run'
+)
+
 ServiceCheck = namedtuple('ServiceCheck',
                           ['timestamp', 'hostname', 'name',
                            'status', 'output'])
 
-# Global dict containing the last status of each check
-# Needs to hold a lock to access it
-check_results = {}
-check_results_lock = threading.Lock()
+# Last result of each check, read by asynchronous consumers
+result_store = ResultStore()
 
 try:
     # In Python 3.2 threading.Event is a factory function
@@ -103,18 +119,26 @@ class Sauna:
         self.config = config
         self.must_stop = threading.Event()
         self._consumers_queues = []
-        if self.config.get("concurrency", 1) > 1:
-            self._thread_pool = ThreadPoolExecutor(
-                max_workers=self.config.get("concurrency")
+        self._serial_executor = SerialExecutor()
+        self._thread_pool = None
+        self._async_executor = None
+        self._process_executor = None
+        if self.config.get('executor', 'thread') == 'asyncio':
+            self._async_executor = AsyncioExecutor(
+                self.config.get('concurrency', 1)
             )
-        else:
-            self._thread_pool = None
+        elif self.config.get('concurrency', 1) > 1:
+            self._thread_pool = ThreadExecutor(
+                max_workers=self.config.get('concurrency')
+            )
+        self._watchdog = Watchdog()
         self.import_submodules(__name__ + '.plugins.ext')
         self.import_submodules(__name__ + '.consumers.ext')
         for extra_plugin_path in self.config.get('extra_plugins', []):
             self.import_directory_modules(extra_plugin_path)
         self._current_checks = []
         self._current_checks_lock = threading.Lock()
+        self._check_registry = None
 
     @classmethod
     def assemble_config_sample(cls, path):
@@ -159,6 +183,29 @@ class Sauna:
     def periodicity(self):
         return self.config.get('periodicity', 120)
 
+    @property
+    def splay(self):
+        return self.config.get('splay', 0)
+
+    def get_check_offset(self, check_name, periodicity, splay):
+        """Delay of the first run of a check, spread by the splay.
+
+        The offset is derived from the hostname and the check name so
+        that the same check starts at a different moment on each host but
+        always at the same moment on a given host.
+
+        :param splay: maximum delay in seconds, True to spread over the
+                      whole periodicity
+        """
+        if splay is True:
+            window = periodicity
+        elif not splay:
+            return 0
+        else:
+            window = min(splay, periodicity)
+        return splay_offset('{}/{}'.format(self.hostname, check_name),
+                            window)
+
     @property
     def plugins_checks(self):
         plugins = []
@@ -190,9 +237,30 @@ class Sauna:
             sys.exit(1)
         return consumers
 
+    @property
+    def check_registry(self):
+        """Active checks, compiled the first time they are needed."""
+        if self._check_registry is None:
+            self.compile_checks()
+        return self._check_registry
+
+    def compile_checks(self):
+        """Instantiate plugins and build the registry of active checks.
+
+        This is done once, plugin instances are then reused by every run.
+        """
+        self._check_registry = CheckRegistry(self.get_all_active_checks())
+        needs_processes = any(check.executor == 'process'
+                              for check in self._check_registry.checks)
+        if needs_processes and self._process_executor is None:
+            self._process_executor = ProcessExecutor(
+                self.config.get('processes', 1),
+                extra_plugins=self.config.get('extra_plugins', [])
+            )
+        return self._check_registry
+
     def get_active_checks_name(self):
-        checks = self.get_all_active_checks()
-        return [check.name for check in checks]
+        return [check.name for check in self.check_registry.checks]
 
     def get_all_available_consumers(self):
         return_consumers = []
@@ -247,17 +315,38 @@ class Sauna:
                 check_periodicity = (check.get('periodicity') or
                                      self.periodicity)
 
-                checks.append(Check(check_name, check_periodicity,
-                                    check_func, check))
+                check_obj = Check(check_name, check_periodicity,
+                                  check_func, check)
+                check_obj.offset = self.get_check_offset(
+                    check_name, check_periodicity,
+                    check.get('splay', self.splay)
+                )
+                check_obj.executor = check.get('executor',
+                                               plugin_data.get('executor'))
+                if check_obj.executor not in (None, 'process'):
+                    print('Unknown executor {} for check {}'.format(
+                        check_obj.executor, check_name))
+                    sys.exit(1)
+                if (check_obj.executor == 'process' and
+                        not ProcessExecutor.supported):
+                    print('Check {} needs Python 3.7 or later to run in a '
+                          'worker process'.format(check_name))
+                    sys.exit(1)
+                check_obj.plugin_config = plugin_data.get('config', {})
+                check_obj.timeout = check.get(
+                    'check_timeout',
+                    self.config.get('check_timeout', check_periodicity)
+                )
+                checks.append(check_obj)
         if deps_error:
             for error in deps_error:
                 print(error)
             sys.exit(1)
 
         # Check duplicate name
-        names = [check.name for check in checks]
-        duplicates_names = {name: names.count(name)
-                            for name in names if names.count(name) > 1}
+        names = Counter(check.name for check in checks)
+        duplicates_names = {name: count
+                            for name, count in names.items() if count > 1}
         for name, count in duplicates_names.items():
             print("check name {} was found {} times, please add name"
                   " field to theses checks".format(name, count))
@@ -267,7 +356,7 @@ class Sauna:
 
     def launch_all_checks(self):
         """Run once every single check."""
-        for check in self.get_all_active_checks():
+        for check in self.check_registry.checks:
             yield self.launch_check(check)
 
     def launch_and_publish_checks_with_periodicity(self, periodicity):
@@ -275,44 +364,144 @@ class Sauna:
 
         Sends the result of each check to the queues and shared dict.
         """
-        checks = filter(lambda x: x.periodicity == periodicity,
-                        self.get_all_active_checks())
+        self.launch_and_publish_checks(
+            self.check_registry.get_checks(periodicity)
+        )
+
+    def launch_and_publish_checks(self, checks):
+        """Run once the given checks.
+
+        Sends the result of each check to the queues and shared dict.
+        """
+        CheckRegistry.invalidate_plugins_cache(checks)
         for check in checks:
-            if not self._thread_pool:
-                # No threadpool, checks are executed one by one
+            # A check is only run again once it really finished, even if
+            # it timed out long before, so that a check stuck in a thread
+            # does not take up new threads on every run
+            with self._current_checks_lock:
+                if check.name in self._current_checks:
+                    logger.debug(
+                        "Skipping {}, already being checked".format(
+                            check.name))
+                    skipped_runs.inc(check=check.name)
+                    continue
+                self._current_checks.append(check.name)
+
+            executor = self._get_executor(check)
+            if executor is self._serial_executor:
+                # Checks are executed one by one
                 self._check_helper(check)
-            else:
-                # Submit check to threadpool
-                with self._current_checks_lock:
-                    if check.name not in self._current_checks:
-                        self._current_checks.append(check.name)
-                        self._thread_pool.submit(self._check_helper, check)
-                    else:
-                        logger.debug(
-                            "Skipping {}, already being checked".format(
-                                check.name))
+                continue
+
+            # The result is published by the thread completing the check,
+            # or when it times out
+            future = self._submit_check(
+                executor, check,
+                on_finished=functools.partial(self._check_finished, check)
+            )
+            future.add_done_callback(
+                functools.partial(self._check_done, check)
+            )
+
+    def _get_executor(self, check):
+        if check.executor == 'process':
+            return self._process_executor
+        return (self._async_executor or self._thread_pool or
+                self._serial_executor)
+
+    def _submit_check(self, executor, check, on_finished=None):
+        """Submit a check to an executor, bounded by its timeout.
+
+        :param on_finished: callable run with the future of the executor
+                            once the check completes, even if it timed out
+                            long before
+        :returns: a :py:class:`concurrent.futures.Future` holding the
+                  (status, output) tuple of the check
+        """
+        started_at = time.monotonic()
+        try:
+            future = executor.submit(check)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+        watched = self._watchdog.watch(
+            future, check.timeout,
+            on_timeout=functools.partial(self._check_timed_out,
+                                         executor, future, check)
+        )
+        if on_finished is not None:
+            future.add_done_callback(on_finished)
+        watched.add_done_callback(lambda _: check_durations.observe(
+            time.monotonic() - started_at, check=check.name
+        ))
+        return watched
+
+    def _check_timed_out(self, executor, future, check):
+        if not executor.cancel(future, check):
+            logger.warning('Check {} could not start in {}s, all workers '
+                           'are busy'.format(check.name, check.timeout))
+            return
+        overruns.inc(check=check.name)
+        logger.warning('Check {} did not complete in {}s, {} overruns so far'
+                       .format(check.name, check.timeout,
+                               overruns.get(check=check.name)))
 
     def _check_helper(self, check):
-        service_check = self.launch_check(check)
+        """Run a check and wait for its result before publishing it."""
+        future = self._submit_check(
+            self._serial_executor, check,
+            on_finished=functools.partial(self._check_finished, check)
+        )
+        self._publish(self._future_to_service_check(check, future))
+
+    def _check_done(self, check, future):
+        self._publish(self._future_to_service_check(check, future))
+
+    def _check_finished(self, check, future):
+        with self._current_checks_lock:
+            self._current_checks.remove(check.name)
+
+    def _future_to_service_check(self, check, future):
+        try:
+            status, output = future.result()
+        except CheckTimeoutError as e:
+            return self._service_check(
+                check, Plugin.STATUS_UNKNOWN,
+                '{} ({} overruns since start)'.format(
+                    e, overruns.get(check=check.name)
+                )
+            )
+        except Exception as e:
+            return self._failed_service_check(check, e)
+        return self._service_check(check, status, output)
+
+    def _publish(self, service_check):
         logger.debug('Pushing check {} to {} synchronous consumers'.
                      format(service_check.name, len(self._consumers_queues)))
-        self.send_data_to_consumers(service_check)
-        with check_results_lock:
-            check_results[service_check.name] = service_check
-
-        if self._thread_pool:
-            with self._current_checks_lock:
-                self._current_checks.remove(service_check.name)
+        # A failing queue must neither stop the producer nor prevent the
+        # other consumers from getting the check
+        for queue in self._consumers_queues:
+            try:
+                queue.put(service_check)
+            except Exception as e:
+                logger.error('Could not push check {} to a consumer: {}'
+                             .format(service_check.name, e))
+        result_store.publish(service_check)
 
     def launch_check(self, check):
         try:
             status, output = check.run_check()
         except Exception as e:
-            logger.warning('Could not run check {}: {}'.format(
-                check.name, str(e)
-            ))
-            status = 3
-            output = str(e)
+            return self._failed_service_check(check, e)
+        return self._service_check(check, status, output)
+
+    def _failed_service_check(self, check, error):
+        logger.warning('Could not run check {}: {}'.format(
+            check.name, str(error)
+        ))
+        return self._service_check(check, Plugin.STATUS_UNKNOWN, str(error))
+
+    def _service_check(self, check, status, output):
         return ServiceCheck(
             timestamp=int(time.time()),
             hostname=self.hostname,
@@ -322,21 +511,51 @@ class Sauna:
         )
 
     def run_producer(self):
-        periodicities = {check.periodicity
-                         for check in self.get_all_active_checks()}
-        jobs = [Job(p, self.launch_and_publish_checks_with_periodicity, p)
-                for p in periodicities]
+        periodicities = self.check_registry.periodicities
+        jobs = []
+        for (periodicity, offset), checks in sorted(
+                self.check_registry.schedules.items()):
+            job = Job(periodicity, self.launch_and_publish_checks, checks)
+            job.offset = offset
+            jobs.append(job)
         logger.info('Running checks with interval: {}'
                     .format(str(periodicities)))
         scheduler = Scheduler(jobs)
 
-        for _ in scheduler:
-            if self.must_stop.wait(timeout=scheduler.tick_duration):
-                break
+        # Wait before running the first jobs too, they may have an offset
+        while jobs and not self.must_stop.wait(
+                timeout=scheduler.time_until_next_run()):
+            next(scheduler)
         if self._thread_pool:
             self._thread_pool.shutdown(wait=False)
+        if self._async_executor:
+            self._async_executor.shutdown()
+        if self._process_executor:
+            self._process_executor.shutdown()
+        self._serial_executor.shutdown()
+        self._watchdog.shutdown()
         logger.debug('Exited producer thread')
 
+    def _validate_consumer_queue(self, consumer_queue):
+        """Reject queues that cannot work with the executors in use.
+
+        A queue blocking when it is full must only ever block the producer.
+        Checks run in a pool publish their result from the thread that
+        completed them, or from the watchdog when they time out, which
+        would then stop enforcing the timeouts of all other checks.
+        """
+        from sauna.consumers.queues import BoundedQueue
+        if not (isinstance(consumer_queue, BoundedQueue) and
+                consumer_queue.policy == 'block'):
+            return
+        if (self._thread_pool or self._async_executor or
+                any(check.executor == 'process'
+                    for check in self.check_registry.checks)):
+            raise ValueError(
+                'queue_overflow: block is only supported when checks run '
+                'one by one, without concurrency nor process executor'
+            )
+
     def term_handler(self, *args):
         """Notify producer and consumer that they should stop."""
         if not self.must_stop.is_set():
@@ -356,6 +575,9 @@ class Sauna:
         signal.signal(signal.SIGTERM, self.term_handler)
         signal.signal(signal.SIGINT, self.term_handler)
 
+        # Fail early on configuration errors, before any thread is started
+        self.compile_checks()
+
         consumers_threads = []
         for consumer_data in self.consumers:
 
@@ -368,16 +590,18 @@ class Sauna:
 
             try:
                 consumer = consumer_info['consumer_cls'](consumer_data)
-            except DependencyError as e:
+                if isinstance(consumer, BatchQueuedConsumer):
+                    consumer_queue = consumer.create_queue()
+                    self._validate_consumer_queue(consumer_queue)
+                else:
+                    consumer_queue = None
+            except (DependencyError, ValueError, OSError) as e:
                 print(str(e))
                 self.term_handler()
                 sys.exit(1)
 
-            if isinstance(consumer, BatchQueuedConsumer):
-                consumer_queue = queue.Queue()
+            if consumer_queue is not None:
                 self._consumers_queues.append(consumer_queue)
-            else:
-                consumer_queue = None
 
             consumer_thread = threading.Thread(
                 name='consumer_{}'.format(consumer_name),
@@ -1,10 +1,22 @@
-from copy import deepcopy
 from datetime import timedelta, datetime
-from functools import reduce
+import json
 import logging
 from queue import Queue, Empty
 import threading
 import time
+from time import monotonic
+
+from sauna import metrics
+from sauna.consumers.retry import RetryPolicy, CircuitBreaker, retries
+
+queue_depth = metrics.gauge(
+    'sauna_consumer_queue_depth',
+    'Number of checks waiting in the queue of a consumer'
+)
+send_durations = metrics.histogram(
+    'sauna_consumer_send_duration_seconds',
+    'Time taken by consumers to send a batch of checks, failed or not'
+)
 
 
 class Consumer:
@@ -15,6 +27,21 @@ class Consumer:
         self.stale_age = config.get('stale_age', 300)
         self.retry_delay = config.get('retry_delay', 10)
         self.max_retry = config.get('max_retry', -1)
+        self.retry_policy = RetryPolicy(
+            base_delay=self.retry_delay,
+            max_delay=config.get('max_retry_delay', 300),
+            jitter=config.get('retry_jitter', True)
+        )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=config.get('breaker_threshold', 5),
+            reset_timeout=config.get('breaker_reset_timeout', 60),
+            name=self.__class__.__name__
+        )
+        self.max_queue_size = config.get('max_queue_size', 0)
+        self.queue_overflow = config.get('queue_overflow', 'drop_oldest')
+        self.coalesce = config.get('coalesce', False)
+        self.deliver_transitions = config.get('deliver_transitions', True)
+        self.spool = config.get('spool', None)
 
     @property
     def logger(self):
@@ -50,6 +77,36 @@ class BatchQueuedConsumer(Consumer):
     #: it.
     max_batch_delay: timedelta = timedelta(seconds=15)
 
+    def create_queue(self) -> Queue:
+        """Create the queue the consumer receives checks from.
+
+        The queue is unbounded unless `max_queue_size` is configured. With
+        `coalesce` only the latest result of each check is kept, and the
+        oldest results are dropped past `max_queue_size`. With `spool`
+        checks are stored on disk.
+        """
+        from sauna.consumers.queues import BoundedQueue, CoalescingQueue
+        if self.spool:
+            from sauna.consumers.spool import SpoolQueue
+            if 'directory' not in self.spool:
+                raise ValueError('The spool needs a directory')
+            return SpoolQueue(
+                self.spool['directory'],
+                segment_size=self.spool.get('segment_size', 4 * 1024 * 1024),
+                max_size=self.spool.get('max_size', 256 * 1024 * 1024),
+                max_age=self.spool.get('max_age', None),
+                fsync_interval=self.spool.get('fsync_interval', 1),
+                name=self.__class__.__name__
+            )
+        if self.coalesce:
+            return CoalescingQueue(self.deliver_transitions,
+                                   self.max_queue_size or None,
+                                   name=self.__class__.__name__)
+        if not self.max_queue_size:
+            return Queue()
+        return BoundedQueue(self.max_queue_size, self.queue_overflow,
+                            name=self.__class__.__name__)
+
     def _send(self, service_check):
         """Send one service checks.
 
@@ -62,9 +119,13 @@ class BatchQueuedConsumer(Consumer):
 
         Method to override in consumers for actually sending batches, otherwise
         checks are sent one by one using `self._send`.
+
+        Checks that were sent are removed from the list, so that a batch that
+        failed halfway is retried with only the checks that were not sent.
         """
-        for service_check in service_checks:
-            self._send(service_check)
+        while service_checks:
+            self._send(service_checks[0])
+            del service_checks[0]
 
     def try_send(self, service_checks: list, must_stop: threading.Event):
         try:
@@ -74,36 +135,61 @@ class BatchQueuedConsumer(Consumer):
 
         retry_count = 0
         while True:
-            retry_count = retry_count + 1
 
             if last_service_check.timestamp + self.stale_age < time.time():
                 self.logger.warning('Dropping batch because it is too old')
                 return
 
-            if self.max_retry != -1 and retry_count > self.max_retry:
+            if self.max_retry != -1 and retry_count >= self.max_retry:
                 self.logger.warning('Dropping batch because '
                                     'max_retry has been reached')
                 return
 
+            if not self.circuit_breaker.allow():
+                self._wait_for_circuit_breaker(must_stop)
+                if must_stop.is_set():
+                    return
+                continue
+
+            retry_count = retry_count + 1
+            if retry_count > 1:
+                retries.inc(consumer=self.__class__.__name__)
+
+            started_at = monotonic()
             try:
                 self._send_batch(service_checks)
             except Exception as e:
+                send_durations.observe(monotonic() - started_at,
+                                       consumer=self.__class__.__name__)
+                self.circuit_breaker.record_failure()
                 self.logger.warning('Could not send batch (attempt {}/{}): {}'
                                     .format(retry_count, self.max_retry, e))
                 if must_stop.is_set():
                     return
 
                 if self.max_retry == -1 or retry_count < self.max_retry:
-                    self._wait_before_retry(must_stop)
+                    self._wait_before_retry(must_stop, retry_count)
             else:
+                send_durations.observe(monotonic() - started_at,
+                                       consumer=self.__class__.__name__)
+                self.circuit_breaker.record_success()
                 self.logger.info('Batch sent')
                 return
 
-    def _wait_before_retry(self, must_stop: threading.Event):
-        self.logger.info('Waiting %s s before retry', self.retry_delay)
-        must_stop.wait(timeout=self.retry_delay)
+    def _wait_before_retry(self, must_stop: threading.Event, retry_count=1):
+        delay = self.retry_policy.delay(retry_count)
+        self.logger.info('Waiting %.1f s before retry', delay)
+        must_stop.wait(timeout=delay)
+
+    def _wait_for_circuit_breaker(self, must_stop: threading.Event):
+        delay = self.circuit_breaker.remaining()
+        self.logger.info('Receiver is failing, waiting %.1f s before probing '
+                         'it', delay)
+        must_stop.wait(timeout=delay)
 
     def run(self, must_stop, queue: Queue):
+        queue_depth.set_function(queue.qsize,
+                                 consumer=self.__class__.__name__)
         batch = list()
         batch_created_at = datetime.utcnow()
 
@@ -147,7 +233,13 @@ class BatchQueuedConsumer(Consumer):
                 must_stop.is_set()
             )
             if should_send_batch:
+                batch_size = len(batch)
                 self.try_send(batch, must_stop)
+                # Checks left unsent because sauna stops are not
+                # acknowledged, a spool keeps them for the next start
+                if not (batch and must_stop.is_set()):
+                    for _ in range(batch_size):
+                        queue.task_done()
                 batch = list()
 
         self.logger.debug('Exited consumer thread')
@@ -170,6 +262,25 @@ class AsyncConsumer(Consumer):
     queueing is made.
     """
 
+    # ((store, version of the results), cached value) shared by all
+    # consumers
+    _status_line_cache = (None, None)
+    _checks_json_cache = (None, None)
+
+    @staticmethod
+    def _checks_as_dict(snapshot):
+        from sauna.plugins.base import Plugin
+
+        checks = {}
+        for service_check in snapshot.results.values():
+            checks[service_check.name] = {
+                'status': Plugin.status_code_to_str(service_check.status),
+                'code': service_check.status,
+                'timestamp': service_check.timestamp,
+                'output': service_check.output
+            }
+        return checks
+
     @classmethod
     def get_current_status(cls):
         """Get the worse status of all check results.
@@ -178,31 +289,57 @@ class AsyncConsumer(Consumer):
         :rtype: tuple
         """
         from sauna.plugins.base import Plugin
-        from sauna import check_results_lock, check_results
-
-        def reduce_status(accumulated, update_value):
-            if update_value.status > Plugin.STATUS_CRIT:
-                return accumulated
-            return accumulated if accumulated > update_value.status else \
-                update_value.status
-
-        with check_results_lock:
-            code = reduce(reduce_status, check_results.values(), 0)
+        from sauna import result_store
 
+        code = result_store.snapshot().worst_status
         return Plugin.status_code_to_str(code), code
 
     @classmethod
     def get_checks_as_dict(cls):
+        from sauna import result_store
+
+        return cls._checks_as_dict(result_store.snapshot())
+
+    @classmethod
+    def get_status_line(cls) -> bytes:
+        """Get the worse status of all check results as an encoded line.
+
+        The line is only built again when the status of a check changed,
+        otherwise the same bytes object is returned.
+        """
         from sauna.plugins.base import Plugin
-        from sauna import check_results_lock, check_results
+        from sauna import result_store
+
+        snapshot = result_store.snapshot()
+        version = (result_store, snapshot.statuses_version)
+        cached_version, line = AsyncConsumer._status_line_cache
+        if cached_version == version:
+            return line
+        line = Plugin.status_code_to_str(snapshot.worst_status).encode()
+        line += b'\n'
+        AsyncConsumer._status_line_cache = (version, line)
+        return line
 
-        checks = {}
-        with check_results_lock:
-            for service_check in check_results.values():
-                checks[service_check.name] = {
-                    'status': Plugin.status_code_to_str(service_check.status),
-                    'code': service_check.status,
-                    'timestamp': service_check.timestamp,
-                    'output': service_check.output
-                }
-        return deepcopy(checks)
+    @classmethod
+    def get_checks_json(cls) -> bytes:
+        """Get the status and all check results encoded in JSON.
+
+        The document is only built again when a result changed, otherwise
+        the same bytes object is returned.
+        """
+        from sauna.plugins.base import Plugin
+        from sauna import result_store
+
+        snapshot = result_store.snapshot()
+        version = (result_store, snapshot.version)
+        cached_version, data = AsyncConsumer._checks_json_cache
+        if cached_version == version:
+            return data
+        code = snapshot.worst_status
+        data = json.dumps({
+            'status': Plugin.status_code_to_str(code),
+            'code': code,
+            'checks': cls._checks_as_dict(snapshot)
+        }).encode()
+        AsyncConsumer._checks_json_cache = (version, data)
+        return data
@@ -1,6 +1,11 @@
+from collections import namedtuple
+import functools
 import json
+import os
 import re
-from typing import Optional, Set, List
+import threading
+import time
+from typing import Optional, Set
 
 from sauna.consumers.base import BatchQueuedConsumer
 from sauna.consumers import ConsumerRegister
@@ -15,6 +20,25 @@ status_to_name = {
     3: 'Unknown'
 }
 
+CheckTopics = namedtuple('CheckTopics',
+                         ['unique_id', 'state_topic', 'discovery_topic'])
+
+
+def _to_safe_str(text: str) -> str:
+    return re.sub('[^0-9a-zA-Z]+', '_', text)
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_check_topics(hostname: str, name: str) -> CheckTopics:
+    safe_hostname = _to_safe_str(hostname)
+    safe_name = _to_safe_str(name)
+    unique_id = f"sauna_{safe_hostname}_{safe_name}"
+    return CheckTopics(
+        unique_id=unique_id,
+        state_topic=f"sauna/{safe_hostname}/{safe_name}/state",
+        discovery_topic=f"homeassistant/sensor/{unique_id}/config"
+    )
+
 
 @my_consumer.consumer()
 class HomeAssistantMQTTConsumer(BatchQueuedConsumer):
@@ -28,13 +52,18 @@ class HomeAssistantMQTTConsumer(BatchQueuedConsumer):
     MQTT topic that HA starts subscribing to.
 
     Afterwards checks are just sent on their own topic.
+
+    A single connection to the broker is kept open, the client reconnects
+    by itself when it is lost. Sensors already configured are remembered
+    in a state file so that a restart does not publish their discovery
+    message again.
     """
 
     def __init__(self, config):
         super().__init__(config)
         try:
-            import paho.mqtt.publish as mqtt_publish
-            self.mqtt_publish = mqtt_publish
+            import paho.mqtt.client as mqtt_client
+            self.mqtt_client = mqtt_client
         except ImportError:
             from ... import DependencyError
             raise DependencyError(self.__class__.__name__, 'paho-mqtt',
@@ -42,27 +71,102 @@ class HomeAssistantMQTTConsumer(BatchQueuedConsumer):
         self.config = {
             'hostname': config.get('hostname', 'localhost'),
             'port': config.get('port', 1883),
-            'auth': config.get('auth', None)
+            'auth': config.get('auth', None),
+            'keepalive': config.get('keepalive', 60),
+            'publish_timeout': config.get('publish_timeout', 10),
+            'max_inflight': config.get('max_inflight', 20),
+            'state_file': config.get('state_file', None)
         }
-        self._configured_checks: Set[str] = set()
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._configured_checks: Set[str] = self._load_configured_checks()
 
         from ... import __version__
         self._version = __version__
 
     def _to_safe_str(self, text: str) -> str:
-        return re.sub('[^0-9a-zA-Z]+', '_', text)
+        return _to_safe_str(text)
+
+    def _load_configured_checks(self) -> Set[str]:
+        state_file = self.config['state_file']
+        if not state_file:
+            return set()
+        try:
+            with open(state_file) as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError) as e:
+            self.logger.warning('Could not read state file {}: {}'
+                                .format(state_file, e))
+            return set()
+
+    def _save_configured_checks(self):
+        state_file = self.config['state_file']
+        if not state_file:
+            return
+        tmp_file = state_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(sorted(self._configured_checks), f)
+            os.replace(tmp_file, state_file)
+        except OSError as e:
+            self.logger.warning('Could not write state file {}: {}'
+                                .format(state_file, e))
+
+    def _get_client(self):
+        """Get the client connected to the broker, creating it if needed.
+
+        Once connected, the network loop of the client runs in its own
+        thread and reconnects automatically.
+        """
+        with self._client_lock:
+            if self._client is not None:
+                return self._client
+
+            kwargs = {}
+            if hasattr(self.mqtt_client, 'CallbackAPIVersion'):
+                # paho-mqtt >= 2.0, no callback is used
+                kwargs['callback_api_version'] = (
+                    self.mqtt_client.CallbackAPIVersion.VERSION2
+                )
+            client = self.mqtt_client.Client(**kwargs)
+            auth = self.config['auth']
+            if auth:
+                client.username_pw_set(auth['username'],
+                                       auth.get('password'))
+            client.max_inflight_messages_set(self.config['max_inflight'])
+            client.reconnect_delay_set(min_delay=1, max_delay=60)
+            client.connect(self.config['hostname'], self.config['port'],
+                           keepalive=self.config['keepalive'])
+            client.loop_start()
+            self._client = client
+            return client
+
+    def _close_client(self):
+        with self._client_lock:
+            if self._client is not None:
+                self._client.disconnect()
+                self._client.loop_stop()
+                self._client = None
+
+    def run(self, must_stop, queue):
+        try:
+            super().run(must_stop, queue)
+        finally:
+            self._close_client()
 
     def _get_check_discovery(self, service_check) -> Optional[dict]:
-        safe_hostname = self._to_safe_str(service_check.hostname)
-        safe_name = self._to_safe_str(service_check.name)
-        unique_id = f"sauna_{safe_hostname}_{safe_name}"
+        topics = _get_check_topics(service_check.hostname,
+                                   service_check.name)
+        unique_id = topics.unique_id
         if unique_id in self._configured_checks:
             return None
 
         self._configured_checks.add(unique_id)
-        state_topic = f"sauna/{safe_hostname}/{safe_name}/state"
+        state_topic = topics.state_topic
         return {
-            "topic": f"homeassistant/sensor/{unique_id}/config",
+            "topic": topics.discovery_topic,
             "retain": True,
             "qos": 1,
             "payload": json.dumps({
@@ -81,52 +185,81 @@ class HomeAssistantMQTTConsumer(BatchQueuedConsumer):
             })
         }
 
+    def _publish(self, client, msg: dict):
+        return client.publish(msg['topic'], payload=msg['payload'],
+                              qos=msg['qos'], retain=msg['retain'])
+
+    def _wait_for_publish(self, msg_info, deadline: float) -> bool:
+        try:
+            msg_info.wait_for_publish(
+                timeout=max(0, deadline - time.monotonic())
+            )
+        except (ValueError, RuntimeError) as e:
+            self.logger.info('Could not publish MQTT message: {}'.format(e))
+            return False
+        return msg_info.is_published()
+
     def _send_batch(self, service_checks: list):
-        msgs: List[dict] = list()
-        pending_discovery_checks: Set[str] = set()
+        client = self._get_client()
+        # Messages in flight: (message info, unique id of a discovery
+        # message or None, service check of a state message or None)
+        in_flight = list()
 
         for service_check in service_checks:
-
-            safe_hostname = self._to_safe_str(service_check.hostname)
-            safe_name = self._to_safe_str(service_check.name)
-            unique_id = f"sauna_{safe_hostname}_{safe_name}"
+            topics = _get_check_topics(service_check.hostname,
+                                       service_check.name)
 
             discovery_msg = self._get_check_discovery(service_check)
             if discovery_msg is not None:
-                msgs.append(discovery_msg)
-                pending_discovery_checks.add(unique_id)
+                in_flight.append((self._publish(client, discovery_msg),
+                                  topics.unique_id, None))
 
-            msgs.append({
-                'topic': f"sauna/{safe_hostname}/{safe_name}/state",
+            state_msg = {
+                'topic': topics.state_topic,
                 'retain': False,
                 'qos': 0,
                 'payload': json.dumps({
                     "status": status_to_name.get(service_check.status),
                     "output": service_check.output
                 })
-            })
+            }
+            in_flight.append((self._publish(client, state_msg),
+                              None, service_check))
 
-        try:
-            self.mqtt_publish.multiple(
-                msgs=msgs,
-                hostname=self.config['hostname'],
-                port=self.config['port'],
-                auth=self.config['auth']
-            )
-        except Exception:
-            # Remove the discovery message that could not be sent so that
-            # they will be recreated the next time they are seen.
-            self._configured_checks.difference_update(pending_discovery_checks)
-            raise
+        # QoS 0 messages are published once written to the socket, QoS 1
+        # messages once acknowledged by the broker
+        deadline = time.monotonic() + self.config['publish_timeout']
+        unpublished_checks = list()
+        new_configured_checks = False
+        for msg_info, unique_id, service_check in in_flight:
+            published = self._wait_for_publish(msg_info, deadline)
+            if unique_id is not None:
+                if published:
+                    new_configured_checks = True
+                else:
+                    # Discovery messages that could not be sent are
+                    # recreated the next time the check is seen
+                    self._configured_checks.discard(unique_id)
+            elif not published:
+                unpublished_checks.append(service_check)
+
+        if new_configured_checks:
+            self._save_configured_checks()
+        service_checks[:] = unpublished_checks
+        if unpublished_checks:
+            raise IOError('{} checks were not published to the MQTT broker'
+                          .format(len(unpublished_checks)))
 
     @staticmethod
     def config_sample():
         return '''
         # Report checks to Home Assistant via MQTT
+        # Configured sensors are remembered in state_file across restarts
         - type: HomeAssistantMQTT
           hostname: localhost
           port: 1883
           auth:
             username: user
             password: pass
+          state_file: /var/lib/sauna/home_assistant_mqtt.json
         '''
@@ -1,11 +1,16 @@
-from sauna.consumers.base import QueuedConsumer
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import gzip
+import json
+
+from sauna.consumers.base import BatchQueuedConsumer
 from sauna.consumers import ConsumerRegister
 
 my_consumer = ConsumerRegister('HTTP')
 
 
 @my_consumer.consumer()
-class HTTPConsumer(QueuedConsumer):
+class HTTPConsumer(BatchQueuedConsumer):
 
     def __init__(self, config):
         super().__init__(config)
@@ -19,31 +24,111 @@ class HTTPConsumer(QueuedConsumer):
         self.config = {
             'url': config.get('url', 'http://localhost'),
             'timeout': config.get('timeout', 60),
-            'headers': config.get('headers', None)
+            'headers': config.get('headers', None),
+            'batch': config.get('batch', False),
+            'gzip': config.get('gzip', False),
+            'max_in_flight': config.get('max_in_flight', 1)
         }
+        # Without batch mode each request carries a single check
+        if self.config['batch']:
+            self._checks_per_request = config.get('max_batch_size', 64)
+        else:
+            self._checks_per_request = 1
+        # Checks are taken from the queue by enough to fill all requests
+        # in flight
+        self.max_batch_size = (self._checks_per_request *
+                               self.config['max_in_flight'])
+        self.max_batch_delay = timedelta(
+            seconds=config.get('max_batch_delay', 1)
+        )
+        self._session = self._create_session()
+        self._pool = None
+        if self.config['max_in_flight'] > 1:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.config['max_in_flight']
+            )
+
+    def _create_session(self):
+        """Session keeping connections to the server alive between checks."""
+        session = self.requests.Session()
+        adapter = self.requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.config['max_in_flight']
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.config['headers']:
+            session.headers.update(self.config['headers'])
+        return session
 
-    def _send(self, service_check):
-        data = {
+    @staticmethod
+    def _service_check_to_dict(service_check):
+        return {
             'timestamp': service_check.timestamp,
             'hostname': service_check.hostname,
             'service': service_check.name,
             'status': service_check.status,
             'output': service_check.output
         }
-        response = self.requests.post(
+
+    def _post(self, service_checks):
+        if self.config['batch']:
+            data = [self._service_check_to_dict(service_check)
+                    for service_check in service_checks]
+        else:
+            data = self._service_check_to_dict(service_checks[0])
+        body = json.dumps(data).encode()
+        headers = {'Content-Type': 'application/json'}
+        if self.config['gzip']:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        response = self._session.post(
             self.config['url'], timeout=self.config['timeout'],
-            headers=self.config['headers'], json=data
+            headers=headers, data=body
         )
         response.raise_for_status()
 
+    def _send_batch(self, service_checks):
+        requests_checks = [
+            service_checks[i:i + self._checks_per_request]
+            for i in range(0, len(service_checks), self._checks_per_request)
+        ]
+        if self._pool is None or len(requests_checks) == 1:
+            for request_checks in requests_checks:
+                self._post(request_checks)
+                del service_checks[:len(request_checks)]
+            return
+
+        futures = [self._pool.submit(self._post, request_checks)
+                   for request_checks in requests_checks]
+        unsent_checks = []
+        error = None
+        for future, request_checks in zip(futures, requests_checks):
+            try:
+                future.result()
+            except Exception as e:
+                unsent_checks.extend(request_checks)
+                error = error or e
+        service_checks[:] = unsent_checks
+        if error is not None:
+            raise error
+
     @staticmethod
     def config_sample():
         return '''
-        # Posts a service check trough HTTP
+        # Posts service checks trough HTTP
         # Payload is serialized in JSON
+        # In batch mode the payload is an array of up to max_batch_size
+        # checks, a batch waits at most max_batch_delay seconds for more
+        # checks
+        # Up to max_in_flight requests are sent at the same time
         - type: HTTP
           url: http://server.tld/services
           timeout: 60
           headers:
             X-Auth-Token: XaiZevii0thaemaezaeJ
+          batch: false
+          max_batch_size: 64
+          max_batch_delay: 1
+          gzip: false
+          max_in_flight: 1
         '''
@@ -1,41 +1,41 @@
 # forked from http.py to match icinga Rest API
-from sauna.consumers.base import QueuedConsumer
+import functools
+import json
+
+from sauna.consumers.ext.http import HTTPConsumer
 from sauna.consumers import ConsumerRegister
 
 my_consumer = ConsumerRegister('HTTP-icinga')
 
 
+@functools.lru_cache(maxsize=4096)
+def _service_object_name(hostname, name):
+    """Name of a service object, cheaper for Icinga than a filter."""
+    return '{}!{}'.format(hostname, name)
+
+
 @my_consumer.consumer()
-class HTTPIcingaConsumer(QueuedConsumer):
+class HTTPIcingaConsumer(HTTPConsumer):
 
     def __init__(self, config):
+        # Icinga processes a single check result per request
+        config = dict(config or {}, batch=False, gzip=False,
+                      max_in_flight=(config or {}).get('max_in_flight', 4))
         super().__init__(config)
-        try:
-            import requests
-            self.requests = requests
-        except ImportError:
-            from ... import DependencyError
-            raise DependencyError(self.__class__.__name__, 'requests',
-                                  'requests', 'python3-requests')
-        self.config = {
-            'url': config.get('url', 'http://localhost'),
-            'timeout': config.get('timeout', 60),
-            'headers': config.get('headers', None)
-        }
 
-    def _send(self, service_check):
+    def _post(self, service_checks):
+        service_check = service_checks[0]
         data = {
-            "filter": (
-                "host.name==\"" + service_check.hostname +
-                "\" && service.name==\"" + service_check.name + "\""
-            ),
+            "type": "Service",
+            "service": _service_object_name(service_check.hostname,
+                                            service_check.name),
             "exit_status": service_check.status,
-            "plugin_output": service_check.output,
-            "type": "Service"
+            "plugin_output": service_check.output
         }
-        response = self.requests.post(
+        response = self._session.post(
             self.config['url'], timeout=self.config['timeout'],
-            headers=self.config['headers'], json=data
+            headers={'Content-Type': 'application/json'},
+            data=json.dumps(data).encode()
         )
         response.raise_for_status()
 
@@ -44,10 +44,12 @@ class HTTPIcingaConsumer(QueuedConsumer):
         return '''
         # Posts a service check trough HTTP to Icinga
         # Payload is serialized in JSON
+        # Up to max_in_flight checks are sent at the same time
         - type: HTTP-icinga
           url: http://icinga.host:5665/v1/actions/process-check-result
           timeout: 60
           headers:
             accept: application/json
             authorization: ICINGA_BASIC
+          max_in_flight: 4
         '''
@@ -1,10 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
 import json
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from logging import getLogger
+import threading
 
 from sauna.consumers.base import AsyncConsumer
 from sauna.consumers import ConsumerRegister
-from sauna import __version__
+from sauna import __version__, metrics
 
 logger = getLogger('sauna.HTTPServerConsumer')
 my_consumer = ConsumerRegister('HTTPServer')
@@ -13,6 +17,10 @@ my_consumer = ConsumerRegister('HTTPServer')
 class StoppableHTTPServer(HTTPServer):
     """HTTPServer that stops itself when receiving a threading.Event"""
 
+    # Probes arriving together wait in the backlog instead of being
+    # retried by their client
+    request_queue_size = 128
+
     def __init__(self, must_stop, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._must_stop = must_stop
@@ -27,6 +35,65 @@ class StoppableHTTPServer(HTTPServer):
             self._BaseServer__shutdown_request = True
 
 
+class ThreadPoolHTTPServer(StoppableHTTPServer):
+    """StoppableHTTPServer handling connections on a pool of threads.
+
+    A slow client only ties up one thread, the pool is bounded so that a
+    flood of clients cannot start an unlimited number of threads. Clients
+    in excess wait for a thread to be available.
+
+    An idle persistent connection also ties up its thread until the client
+    sends another request, connections are only kept open while a thread
+    remains free for new clients.
+    """
+
+    def __init__(self, must_stop, *args, max_threads=8, **kwargs):
+        super().__init__(must_stop, *args, **kwargs)
+        self._max_threads = max_threads
+        self._pool = ThreadPoolExecutor(max_workers=max_threads,
+                                        thread_name_prefix='http_server')
+        self._connections_lock = threading.Lock()
+        # Connections being served or waiting for a thread
+        self._connections = 0
+
+    def keep_alive_allowed(self):
+        """Tell whether a connection can stay open after its response."""
+        with self._connections_lock:
+            return self._connections < self._max_threads
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._connections += 1
+        self._pool.submit(self._process_request_thread, request,
+                          client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._connections_lock:
+                self._connections -= 1
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
+class Entity:
+    """Response body with its ETag and compressed version."""
+
+    def __init__(self, data, compress):
+        self.data = data
+        digest = hashlib.md5(data).hexdigest()
+        self.etag = '"{}"'.format(digest)
+        self.gzipped = gzip.compress(data) if compress else None
+        # Each representation has its own ETag
+        self.gzip_etag = '"{}-gzip"'.format(digest)
+
+
 @my_consumer.consumer()
 class HTTPServerConsumer(AsyncConsumer):
 
@@ -35,34 +102,118 @@ class HTTPServerConsumer(AsyncConsumer):
         self.config = {
             'port': config.get('port', 8080),
             'data_type': config.get('data_type', 'json'),
-            'address': config.get('address', '')  # listen on all interfaces
+            'address': config.get('address', ''),  # listen on all interfaces
+            'max_threads': config.get('max_threads', 8),
+            'keepalive_timeout': config.get('keepalive_timeout', 5),
+            'gzip_min_size': config.get('gzip_min_size', 1024)
         }
+        # Last JSON document served, reused until the results change
+        self._entity = None
+        # Exposition of check results in the Prometheus format, the lines
+        # of a check are only formatted again when its result changes
+        self._metrics_lock = threading.Lock()
+        self._checks_samples = {}
+        self._checks_metrics = (None, b'')
 
-    def run(self, must_stop, *args):
-        http_server = StoppableHTTPServer(
+    def _create_server(self, must_stop):
+        return ThreadPoolHTTPServer(
             must_stop,
             (self.config['address'], self.config['port']),
-            self.HandlerFactory()
+            self.HandlerFactory(),
+            max_threads=self.config['max_threads']
         )
-        http_server.serve_forever()
+
+    def run(self, must_stop, *args):
+        http_server = self._create_server(must_stop)
+        try:
+            http_server.serve_forever()
+        finally:
+            http_server.server_close()
         self.logger.debug('Exited consumer thread')
 
+    def get_json_entity(self):
+        """Get the status and check results in JSON, with its ETag."""
+        data = self.get_checks_json()
+        entity = self._entity
+        if entity is None or entity.data is not data:
+            compress = (self.config['gzip_min_size'] and
+                        len(data) >= self.config['gzip_min_size'])
+            entity = self._entity = Entity(data, compress)
+        return entity
+
+    def _get_checks_metrics(self):
+        from sauna import result_store
+
+        snapshot = result_store.snapshot()
+        version = (result_store, snapshot.version)
+        with self._metrics_lock:
+            cached_version, data = self._checks_metrics
+            if cached_version == version:
+                return data
+
+            samples = {}
+            for name, service_check in snapshot.results.items():
+                try:
+                    cached_check, lines = self._checks_samples[name]
+                except KeyError:
+                    cached_check = None
+                if cached_check is not service_check:
+                    labels = {'check': name}
+                    lines = (
+                        metrics.format_sample('sauna_check_status', labels,
+                                              service_check.status),
+                        metrics.format_sample('sauna_check_timestamp_seconds',
+                                              labels, service_check.timestamp)
+                    )
+                samples[name] = (service_check, lines)
+            self._checks_samples = samples
+
+            names = sorted(samples)
+            data = ''.join((
+                metrics.format_help('sauna_check_status',
+                                    'Status of the last run of a check',
+                                    'gauge'),
+                ''.join(samples[name][1][0] for name in names),
+                metrics.format_help('sauna_check_timestamp_seconds',
+                                    'Time of the last run of a check',
+                                    'gauge'),
+                ''.join(samples[name][1][1] for name in names)
+            )).encode()
+            self._checks_metrics = (version, data)
+            return data
+
+    def get_metrics(self):
+        """Get check results and sauna metrics in the Prometheus format."""
+        return self._get_checks_metrics() + metrics.render().encode()
+
     @staticmethod
     def config_sample():
         return '''
         # HTTP Server that exposes sauna status
         # as a REST API or a web dashboard
+        # Metrics are exposed in the Prometheus format under /metrics
+        # Up to max_threads clients are served at the same time, idle
+        # connections are closed after keepalive_timeout seconds and are
+        # only kept open while a thread is left for new clients
+        # JSON bigger than gzip_min_size bytes is compressed, 0 disables it
         - type: HTTPServer
           port: 8080
           data_type: json # Can be json or html
+          max_threads: 8
+          keepalive_timeout: 5
+          gzip_min_size: 1024
         '''
 
     def HandlerFactory(self):
         config = self.config
+        consumer = self
 
         class Handler(BaseHTTPRequestHandler):
 
             server_version = 'Sauna/' + __version__
+            # Clients can keep their connection open between requests
+            protocol_version = 'HTTP/1.1'
+            timeout = config['keepalive_timeout']
 
             def do_GET(self):
                 data = self.generate_response()
@@ -72,38 +223,98 @@ class HTTPServerConsumer(AsyncConsumer):
                 self.generate_response()
 
             def generate_response(self):
+                etag = None
+                gzipped = False
                 try:
                     content = self.get_content_from_path()
                     code = 200
                 except NotFoundError:
-                    content = {'error': 'Resource not found'}
+                    content = json.dumps({'error': 'Resource not found'})
+                    content = content.encode()
                     code = 404
 
-                self.send_response(code)
-                if config['data_type'] == 'json':
-                    self.send_header('Content-Type', 'application/json')
-                    data = json.dumps(content).encode()
+                if isinstance(content, Metrics):
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                    data = content.data
+                    if (self.accepts_gzip() and config['gzip_min_size'] and
+                            len(data) >= config['gzip_min_size']):
+                        data = gzip.compress(data)
+                        gzipped = True
+                elif config['data_type'] == 'json':
+                    content_type = 'application/json'
+                    if isinstance(content, Entity):
+                        if self.accepts_gzip() and content.gzipped:
+                            data, etag = content.gzipped, content.gzip_etag
+                            gzipped = True
+                        else:
+                            data, etag = content.data, content.etag
+                    else:
+                        data = content
                 elif config['data_type'] == 'html':
-                    self.send_header('Content-Type', 'text/html')
+                    content_type = 'text/html'
                     from .html import get_html
                     data = get_html()
                 else:
+                    content_type = None
                     data = 'data type not found'.encode()
+
+                # Decided for every response, idle connections of
+                # scrapers getting 304 would tie up threads as well
+                if (self.server._must_stop.is_set() or
+                        not self.server.keep_alive_allowed()):
+                    self.close_connection = True
+
+                if etag is not None and self.etag_matches(etag):
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_connection_header()
+                    self.end_headers()
+                    return b''
+
+                self.send_response(code)
+                if content_type:
+                    self.send_header('Content-Type', content_type)
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                    self.send_header('Vary', 'Accept-Encoding')
+                if gzipped:
+                    self.send_header('Content-Encoding', 'gzip')
                 self.send_header('Content-Length', len(data))
+                self.send_connection_header()
                 self.end_headers()
                 return data
 
+            def send_connection_header(self):
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+
             def get_content_from_path(self):
+                if self.path == '/metrics':
+                    return Metrics(consumer.get_metrics())
                 if self.path == '/':
-                    status, code = HTTPServerConsumer.get_current_status()
-                    return {
-                        'status': status,
-                        'code': code,
-                        'checks': HTTPServerConsumer.get_checks_as_dict()
-                    }
+                    if config['data_type'] == 'json':
+                        # Cached until a result changes
+                        return consumer.get_json_entity()
+                    return None
                 else:
                     raise NotFoundError()
 
+            def accepts_gzip(self):
+                for coding in self.headers.get('Accept-Encoding',
+                                               '').split(','):
+                    coding, _, params = coding.partition(';')
+                    if coding.strip().lower() != 'gzip':
+                        continue
+                    return params.replace(' ', '') not in ('q=0', 'q=0.0')
+                return False
+
+            def etag_matches(self, etag):
+                if_none_match = self.headers.get('If-None-Match')
+                if not if_none_match:
+                    return False
+                tags = [t.strip() for t in if_none_match.split(',')]
+                return '*' in tags or etag in tags
+
             def log_message(self, format, *args):
                 logger.debug(
                     '{} {}'.format(self.address_string(), format % args))
@@ -111,5 +322,12 @@ class HTTPServerConsumer(AsyncConsumer):
         return Handler
 
 
+class Metrics:
+    """Body of the /metrics endpoint."""
+
+    def __init__(self, data):
+        self.data = data
+
+
 class NotFoundError(Exception):
     pass
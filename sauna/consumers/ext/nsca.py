@@ -1,24 +1,43 @@
 import socket
 import struct
 import binascii
+import time
 from copy import deepcopy
+from datetime import timedelta
+import functools
 import itertools
 
-from sauna.consumers.base import QueuedConsumer
+from sauna.consumers.base import BatchQueuedConsumer
 from sauna.consumers import ConsumerRegister
+from sauna.consumers.receivers import dns_cache, ReceiverHealth
 
 my_consumer = ConsumerRegister('NSCA')
 
 
-def encrypt_xor(data, iv, key):
+@functools.lru_cache(maxsize=16)
+def _xor_keystream(iv, key, length):
+    """Combined IV and key stream XORed with the data, as an integer.
+
+    All the packets sent on a connection share the same IV, the keystream
+    is computed once for all of them.
+    """
+    keystream = bytes(length)
     for i in (iv, key):
-        i = itertools.cycle(i)
-        data = bytes(x ^ y for x, y in zip(data, i))
-    return data
+        # Like send_nsca, an empty IV or key does not alter the data
+        if i:
+            i = itertools.cycle(i)
+            keystream = bytes(x ^ y for x, y in zip(keystream, i))
+    return int.from_bytes(keystream, 'big')
+
+
+def encrypt_xor(data, iv, key):
+    length = len(data)
+    keystream = _xor_keystream(bytes(iv), bytes(key), length)
+    return (int.from_bytes(data, 'big') ^ keystream).to_bytes(length, 'big')
 
 
 @my_consumer.consumer()
-class NSCAConsumer(QueuedConsumer):
+class NSCAConsumer(BatchQueuedConsumer):
 
     protocol_version = 3
     max_hostname_size = 64
@@ -26,11 +45,23 @@ class NSCAConsumer(QueuedConsumer):
     max_output_size = 4096
 
     init_payload_fmt = '!128sL'
-    init_payload_size = struct.calcsize(init_payload_fmt)
+    init_payload_struct = struct.Struct(init_payload_fmt)
+    init_payload_size = init_payload_struct.size
     service_payload_fmt = '!hhIIh{}s{}s{}sh'.format(
         max_hostname_size, max_service_size, max_output_size
     )
-    service_payload_size = struct.calcsize(service_payload_fmt)
+    service_payload_struct = struct.Struct(service_payload_fmt)
+    service_payload_size = service_payload_struct.size
+
+    # Fields of a service payload changing from one check to the other
+    _crc_struct = struct.Struct('!I')
+    _crc_offset = 4
+    _check_struct = struct.Struct('!Ih')
+    _check_offset = 8
+    _output_offset = 14 + max_hostname_size + max_service_size
+
+    #: Maximum number of payload templates kept in memory
+    max_payload_templates = 4096
 
     encryption_functions = {
         0: lambda x, y, z: x,
@@ -45,36 +76,68 @@ class NSCAConsumer(QueuedConsumer):
             'timeout': config.get('timeout', 10),
             'encryption': config.get('encryption', 0),
             'key': config.get('key', '').encode('ascii'),
+            'dns_ttl': config.get('dns_ttl', 300),
+            'dns_negative_ttl': config.get('dns_negative_ttl', 30),
         }
+        self.max_batch_size = config.get('max_batch_size', 64)
+        self.max_batch_delay = timedelta(
+            seconds=config.get('max_batch_delay', 1)
+        )
         self._last_good_receiver_address = None
+        self._dns_cache = dns_cache
+        self._receivers = ReceiverHealth(
+            cooldown=config.get('receiver_cooldown', 30)
+        )
+        # Payloads with only the hostname and service name filled in,
+        # indexed by (hostname, service name)
+        self._payload_templates = {}
 
     def _recv_init_payload(self, s):
         init_payload = bytes()
         while len(init_payload) < self.init_payload_size:
             buffer = s.recv(self.init_payload_size - len(init_payload))
-            if buffer:
-                init_payload += buffer
+            if not buffer:
+                raise ConnectionError('Connection closed by the receiver')
+            init_payload += buffer
         return self._decode_init_payload(init_payload)
 
     def _decode_init_payload(self, init_payload):
-        return struct.unpack(self.init_payload_fmt, init_payload)
+        return self.init_payload_struct.unpack(init_payload)
 
-    def _encode_service_payload(self, service_check):
-        service_payload_list = [
+    def _get_payload_template(self, hostname, name):
+        try:
+            return self._payload_templates[(hostname, name)]
+        except KeyError:
+            pass
+        if len(self._payload_templates) >= self.max_payload_templates:
+            self._payload_templates.clear()
+        template = self.service_payload_struct.pack(
             self.protocol_version,
             0,  # Padding
             0,  # Placeholder for CRC
-            service_check.timestamp,
-            service_check.status,
-            service_check.hostname.encode('utf8'),
-            service_check.name.encode('utf8'),
-            service_check.output.encode('utf8'),
+            0,  # Placeholder for timestamp
+            0,  # Placeholder for status
+            hostname.encode('utf8'),
+            name.encode('utf8'),
+            b'',  # Placeholder for output
             0  # Padding
-        ]
-        crc = binascii.crc32(struct.pack(self.service_payload_fmt,
-                                         *service_payload_list))
-        service_payload_list[2] = crc
-        return struct.pack(self.service_payload_fmt, *service_payload_list)
+        )
+        self._payload_templates[(hostname, name)] = template
+        return template
+
+    def _encode_service_payload(self, service_check):
+        payload = bytearray(self._get_payload_template(
+            service_check.hostname, service_check.name
+        ))
+        self._check_struct.pack_into(payload, self._check_offset,
+                                     service_check.timestamp,
+                                     service_check.status)
+        output = service_check.output.encode('utf8')[:self.max_output_size]
+        payload[self._output_offset:self._output_offset + len(output)] = \
+            output
+        self._crc_struct.pack_into(payload, self._crc_offset,
+                                   binascii.crc32(payload))
+        return bytes(payload)
 
     def _format_service_check(self, service_check):
         # C strings are null terminated, we need one extra char for each
@@ -101,17 +164,18 @@ class NSCAConsumer(QueuedConsumer):
         return data
 
     def _get_receivers_addresses(self):
-        """Retrieve all the addresses associated with a hostname.
+        """Retrieve the addresses of the receivers to try in turn.
 
-        It will return in priority the address of the last known receiver which
-        accepted the previous check.
+        Addresses come from the DNS cache. Receivers that recently failed
+        are skipped, the last known receiver which accepted the previous
+        checks is returned in priority.
         """
-        receivers = socket.getaddrinfo(
+        addresses = self._dns_cache.get_addresses(
             self.config['server'], self.config['port'],
-            proto=socket.IPPROTO_TCP
+            ttl=self.config['dns_ttl'],
+            negative_ttl=self.config['dns_negative_ttl']
         )
-        # Only keep the actual address
-        addresses = [r[4][0] for r in receivers]
+        addresses = self._receivers.available(addresses)
         try:
             addresses.remove(self._last_good_receiver_address)
             addresses = [self._last_good_receiver_address] + addresses
@@ -119,24 +183,40 @@ class NSCAConsumer(QueuedConsumer):
             pass
         return addresses
 
-    def _send_to_receiver(self, service_check, receiver_address):
+    def _send_to_receiver(self, service_checks, receiver_address):
+        """Send checks to a receiver over a single connection.
+
+        Checks are removed from the list as they are sent, in case of error
+        the list only contains the checks that still need to be sent.
+        """
         with socket.socket() as s:
             s.settimeout(self.config['timeout'])
+            connect_started_at = time.monotonic()
             s.connect((receiver_address, self.config['port']))
             iv, timestamp = self._recv_init_payload(s)
-            service_payload = self._encode_service_payload(service_check)
-            s.sendall(self._encrypt_service_payload(service_payload, iv))
-
-    def _send(self, service_check):
+            self._receivers.record_latency(
+                receiver_address, time.monotonic() - connect_started_at
+            )
+            while service_checks:
+                service_payload = self._encode_service_payload(
+                    service_checks[0]
+                )
+                s.sendall(self._encrypt_service_payload(service_payload, iv))
+                del service_checks[0]
+
+    def _send_batch(self, service_checks):
         for receiver_address in self._get_receivers_addresses():
             try:
-                self._send_to_receiver(service_check, receiver_address)
-                self._last_good_receiver_address = receiver_address
-                return
+                self._send_to_receiver(service_checks, receiver_address)
             except OSError as e:
-                self.logger.info('Could not send check to receiver {}: '
+                self.logger.info('Could not send checks to receiver {}: '
                                  '{}'.format(receiver_address, e))
-        raise IOError('No receiver accepted the check')
+                self._receivers.record_failure(receiver_address, e)
+            else:
+                self._receivers.record_success(receiver_address)
+                self._last_good_receiver_address = receiver_address
+                return
+        raise IOError('No receiver accepted the checks')
 
     @staticmethod
     def config_sample():
@@ -144,10 +224,22 @@ class NSCAConsumer(QueuedConsumer):
         # Send service check to a NSCA server
         # Only encryption methods 0 and 1 are supported
         # Max plugin output is 4096 bytes
+        # Checks are sent by batches of up to max_batch_size checks on a
+        # single connection, a batch waits at most max_batch_delay seconds
+        # for more checks
+        # Addresses of the server are cached for dns_ttl seconds, failures
+        # to resolve it for dns_negative_ttl seconds
+        # A receiver that failed is not used for receiver_cooldown seconds,
+        # doubled at each consecutive failure
         - type: NSCA
           server: receiver.shinken.tld
           port: 5667
           timeout: 10
           encryption: 1
           key: verylongkey
+          max_batch_size: 64
+          max_batch_delay: 1
+          dns_ttl: 300
+          dns_negative_ttl: 30
+          receiver_cooldown: 30
         '''
@@ -1,6 +1,14 @@
+from collections import deque
+import errno
+import selectors
 import socket
-import select
-from collections import defaultdict
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
 from sauna.consumers.base import AsyncConsumer
 from sauna.consumers import ConsumerRegister
@@ -8,34 +16,146 @@ from sauna.consumers import ConsumerRegister
 my_consumer = ConsumerRegister('TCPServer')
 
 
+class Connection:
+    """State of a client connected to the server."""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        #: Data waiting to be sent, as memoryviews so that a partial send
+        #: does not copy what remains
+        self.outgoing = deque()
+
+    def queue(self, data):
+        self.outgoing.append(memoryview(data))
+
+    def send(self):
+        """Send as much data as the socket accepts.
+
+        :returns: True once everything was sent
+        """
+        while self.outgoing:
+            data = self.outgoing[0]
+            sent_len = self.sock.send(data)
+            if sent_len < len(data):
+                self.outgoing[0] = data[sent_len:]
+                return False
+            self.outgoing.popleft()
+        return True
+
+
 @my_consumer.consumer()
 class TCPServerConsumer(AsyncConsumer):
 
     service_checks = {}
 
+    #: File descriptors left for the rest of sauna when max_connections is
+    #: capped by the limit of open files of the process
+    reserved_fds = 64
+
+    #: Seconds to wait before accepting again once the process ran out of
+    #: file descriptors
+    accept_retry_delay = 1
+
     def __init__(self, config):
         super().__init__(config)
         self.config = {
             'port': config.get('port', 5555),
-            'backlog': config.get('port', 128),
-            'keepalive': config.get('keepalive', True)
+            'backlog': config.get('backlog', 128),
+            'keepalive': config.get('keepalive', True),
+            'max_connections': config.get('max_connections', 10000)
         }
-        self.read_wanted, self.write_wanted = ([], [])
-        self.write_buffers = defaultdict(bytes)
+        self.server = None
+        self.selector = None
+        self.connections = {}
+        self._accepting = False
+        # Monotonic time at which accepting resumes after running out of
+        # file descriptors
+        self._resume_accepting_at = None
+
+    def _cap_max_connections(self):
+        """Keep max_connections below the limit of open files."""
+        if resource is None:
+            return
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY:
+            return
+        limit = max(soft - self.reserved_fds, 1)
+        if self.config['max_connections'] > limit:
+            self.logger.warning(
+                'max_connections lowered from {} to {}, the process can '
+                'only open {} files'.format(self.config['max_connections'],
+                                            limit, soft)
+            )
+            self.config['max_connections'] = limit
 
     def _create_server(self):
+        self._cap_max_connections()
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setblocking(0)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind(('', self.config['port']))
         self.server.listen(self.config['backlog'])
+        self.selector = selectors.DefaultSelector()
+        self._start_accepting()
+
+    def _start_accepting(self):
+        self._resume_accepting_at = None
+        if not self._accepting:
+            self.selector.register(self.server, selectors.EVENT_READ)
+            self._accepting = True
+
+    def _stop_accepting(self):
+        # New clients wait in the backlog of the listening socket until a
+        # connection is closed
+        if self._accepting:
+            self.selector.unregister(self.server)
+            self._accepting = False
+            return True
+        return False
+
+    def _maybe_resume_accepting(self):
+        if (self._resume_accepting_at is not None and
+                time.monotonic() >= self._resume_accepting_at):
+            self._start_accepting()
 
-    def _accept_new_connection(self):
-        client_socket, address = self.server.accept()
-        self.logger.debug('New connection from {}'.format(address[0]))
-        self.write_wanted.append(client_socket)
-        self.read_wanted.append(client_socket)
-        return client_socket
+    def _select_timeout(self):
+        if self._resume_accepting_at is None:
+            return 1
+        return min(max(self._resume_accepting_at - time.monotonic(), 0), 1)
+
+    def _accept_new_connections(self):
+        while len(self.connections) < self.config['max_connections']:
+            try:
+                client_socket, address = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    # The listening socket stays readable, select would
+                    # return at once until a file descriptor is released
+                    if self._stop_accepting():
+                        self.logger.warning(
+                            'Out of file descriptors, not accepting new '
+                            'connections: {}'.format(e)
+                        )
+                    self._resume_accepting_at = (time.monotonic() +
+                                                 self.accept_retry_delay)
+                    return
+                self.logger.debug('Could not accept connection: {}'.format(e))
+                return
+            self.logger.debug('New connection from {}'.format(address[0]))
+            client_socket.setblocking(0)
+            if self.config['keepalive']:
+                self._activate_keepalive(client_socket)
+            connection = Connection(client_socket, address)
+            self.connections[client_socket] = connection
+            self.selector.register(client_socket, selectors.EVENT_READ,
+                                   connection)
+            self._send_status(connection)
+        if self._stop_accepting():
+            self.logger.warning('Reached {} connections, not accepting new '
+                                'ones'.format(self.config['max_connections']))
 
     def _activate_keepalive(self, s, after_idle_sec=30, interval_sec=10,
                             max_fails=5):
@@ -50,100 +170,101 @@ class TCPServerConsumer(AsyncConsumer):
         s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval_sec)
         s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max_fails)
 
-    def _close_socket(self, s):
+    def _close_connection(self, connection):
         try:
-            s.shutdown(socket.SHUT_RDWR)
-        except socket.error:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
             pass
+        del self.connections[connection.sock]
         try:
-            s.close()
+            connection.sock.shutdown(socket.SHUT_RDWR)
         except socket.error:
             pass
-        self._remove_from_list(self.write_wanted, s)
-        self._remove_from_list(self.read_wanted, s)
         try:
-            del self.write_buffers[s]
-        except KeyError:
+            connection.sock.close()
+        except socket.error:
             pass
         self.logger.debug('Closed connection')
+        self._start_accepting()
 
-    @staticmethod
-    def _remove_from_list(list_, value):
-        while value in list_:
-            try:
-                list_.remove(value)
-            except ValueError:
-                pass
+    def _send_status(self, connection):
+        # The line is cached, all clients share the same bytes
+        connection.queue(self.get_status_line())
+        self._handle_write_event(connection)
 
-    def _handle_read_event(self, s):
-        if s == self.server:
-            client_socket = self._accept_new_connection()
-            if self.config['keepalive']:
-                self._activate_keepalive(client_socket)
-            to_write = self.get_current_status()[0].encode() + b'\n'
-            self.write_buffers[client_socket] += to_write
-            self.write_wanted.append(client_socket)
+    def _handle_read_event(self, connection):
+        try:
+            read_data = connection.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            self.logger.debug(
+                'Error while receiving, closing connection: {}'.format(e)
+            )
+            self._close_connection(connection)
+            return
+        if len(read_data) == 0:
+            self._close_connection(connection)
         else:
-            try:
-                read_data = s.recv(4096)
-            except socket.error as e:
-                self.logger.debug(
-                    'Error while receiving, closing connection: {}'.format(e)
-                )
-                self._close_socket(s)
-                return
-            if len(read_data) == 0:
-                self._close_socket(s)
-            else:
-                self.logger.debug('Received data')
-                if b'\n' in read_data:
-                    to_write = self.get_current_status()[0].encode() + b'\n'
-                    self.write_buffers[s] += to_write
-                    self.write_wanted.append(s)
-
-    def _handle_write_event(self, s):
+            self.logger.debug('Received data')
+            if b'\n' in read_data:
+                self._send_status(connection)
+
+    def _handle_write_event(self, connection):
         try:
-            sent_len = s.send(self.write_buffers[s])
+            all_sent = connection.send()
+        except (BlockingIOError, InterruptedError):
+            all_sent = False
         except socket.error as e:
             self.logger.debug(
                 'Error while sending, closing connection: {}'.format(e)
             )
-            self._close_socket(s)
+            self._close_connection(connection)
             return
-        self.write_buffers[s] = self.write_buffers[s][sent_len:]
-        if not self.write_buffers[s]:
-            self.write_wanted.remove(s)
+        # Only wait for the socket to be writable while data is pending
+        events = selectors.EVENT_READ
+        if not all_sent:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(connection.sock).events != events:
+            self.selector.modify(connection.sock, events, connection)
+        if all_sent:
             self.logger.debug('Sent data')
 
+    def _close_all(self):
+        for connection in list(self.connections.values()):
+            self._close_connection(connection)
+        self.selector.close()
+        self.server.close()
+
     def run(self, must_stop, *args):
         self._create_server()
-        self.read_wanted = [self.server]
-        self.write_wanted = []
 
         while not must_stop.is_set():
-            readable, writable, errored = select.select(
-                self.read_wanted,
-                self.write_wanted,
-                self.read_wanted + self.write_wanted,
-                1
-            )
-
-            for s in errored:
-                self.logger.debug('Connection in error, closing it')
-                self._close_socket(s)
-
-            for s in readable:
-                self._handle_read_event(s)
+            events = self.selector.select(timeout=self._select_timeout())
+            self._maybe_resume_accepting()
+            for key, mask in events:
+                if key.fileobj is self.server:
+                    self._accept_new_connections()
+                    continue
 
-            for s in writable:
-                self._handle_write_event(s)
+                connection = key.data
+                if mask & selectors.EVENT_READ:
+                    self._handle_read_event(connection)
+                if (mask & selectors.EVENT_WRITE and
+                        connection.sock in self.connections):
+                    self._handle_write_event(connection)
 
+        self._close_all()
         self.logger.debug('Exited consumer thread')
 
     @staticmethod
     def config_sample():
         return '''
         # Listen on a TCP port and serve results to incoming connections
+        # New connections wait once max_connections clients are connected,
+        # it is lowered to stay below the limit of open files
         - type: TCPServer
           port: 5555
+          backlog: 128
+          max_connections: 10000
         '''
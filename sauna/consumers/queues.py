@@ -0,0 +1,198 @@
+"""Queues holding the checks waiting to be processed by consumers."""
+from collections import deque, OrderedDict
+from logging import getLogger
+import queue
+import threading
+
+from sauna import metrics
+
+logger = getLogger(__name__)
+
+dropped_checks = metrics.counter(
+    'sauna_consumer_queue_dropped_total',
+    'Number of checks dropped because the queue of a consumer was full'
+)
+coalesced_checks = metrics.counter(
+    'sauna_consumer_queue_coalesced_total',
+    'Number of checks replaced by a newer result in the queue of a consumer'
+)
+
+
+def _check_key(service_check):
+    return service_check.hostname, service_check.name
+
+
+class BoundedQueue(queue.Queue):
+    """Queue of checks that does not grow past a maximum size.
+
+    When the consumer cannot keep up, for instance because its receiver is
+    down, what happens to new checks depends on the policy:
+
+    - drop_oldest: the oldest check in the queue is discarded
+    - drop_newest: the new check is discarded
+    - block: the producer waits until the consumer makes some room
+    - coalesce: the new check replaces the result of the same check
+      already in the queue, if there is none the oldest check is discarded
+
+    Events notifying the consumer that it must stop are always accepted.
+    """
+
+    policies = ('drop_oldest', 'drop_newest', 'block', 'coalesce')
+
+    def __init__(self, maxsize, policy='drop_oldest', name=''):
+        if policy not in self.policies:
+            raise ValueError('Queue overflow policy must be one of {}'
+                             .format(', '.join(self.policies)))
+        if maxsize <= 0:
+            raise ValueError('Queue size must be positive')
+        # The bound is enforced by put, the parent never blocks
+        super().__init__()
+        self.max_queue_size = maxsize
+        self.policy = policy
+        self.name = name
+        self._closed = False
+
+    def _init(self, maxsize):
+        # Items are stored in cells so that coalescing can replace a check
+        # in place, the latest cell of each check is indexed by its key.
+        self.queue = deque()
+        self._latest_cells = {}
+
+    def _put(self, item):
+        cell = [item]
+        self.queue.append(cell)
+        if not isinstance(item, threading.Event):
+            self._latest_cells[_check_key(item)] = cell
+
+    def _get(self):
+        cell = self.queue.popleft()
+        item = cell[0]
+        if not isinstance(item, threading.Event):
+            key = _check_key(item)
+            if self._latest_cells.get(key) is cell:
+                del self._latest_cells[key]
+        return item
+
+    def _drop(self, service_check):
+        dropped_checks.inc(consumer=self.name)
+        logger.debug('Queue of {} is full, dropping {}'
+                     .format(self.name, service_check))
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if isinstance(item, threading.Event):
+                self._closed = True
+                # Blocked producers give up, the consumer is stopping
+                self.not_full.notify_all()
+
+            elif self._qsize() >= self.max_queue_size:
+                if self._closed:
+                    # Do not risk dropping the event the consumer waits for
+                    self._drop(item)
+                    return
+                if self.policy == 'block':
+                    while (self._qsize() >= self.max_queue_size and
+                           not self._closed):
+                        self.not_full.wait()
+                    if self._closed:
+                        self._drop(item)
+                        return
+                elif self.policy == 'drop_newest':
+                    self._drop(item)
+                    return
+                elif (self.policy == 'coalesce' and
+                        _check_key(item) in self._latest_cells):
+                    self._latest_cells[_check_key(item)][0] = item
+                    coalesced_checks.inc(consumer=self.name)
+                    return
+                else:
+                    self._drop(self._get())
+                    self.unfinished_tasks -= 1
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class CoalescingQueue(queue.Queue):
+    """Queue keeping only the latest result of each check.
+
+    When the consumer falls behind, a new result of a check replaces the
+    one waiting in the queue, at the same position. After an outage the
+    consumer catches up with one result per check instead of one per run.
+
+    With `deliver_transitions`, a result with a different status than the
+    one it would replace is queued after it instead, so that the receiver
+    still sees every change of status. A flapping check then adds a result
+    per run, `max_queue_size` bounds the queue by dropping the oldest
+    results once it is full.
+
+    Events notifying the consumer that it must stop are always accepted.
+    """
+
+    def __init__(self, deliver_transitions=True, max_queue_size=None,
+                 name=''):
+        if max_queue_size is not None and max_queue_size <= 0:
+            raise ValueError('Queue size must be positive')
+        # The bound is enforced by _put, the parent never blocks
+        super().__init__()
+        self.deliver_transitions = deliver_transitions
+        self.max_queue_size = max_queue_size
+        self.name = name
+
+    def _init(self, maxsize):
+        # Lists of results indexed by check, in the order they were queued
+        self.queue = OrderedDict()
+        self._size = 0
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, item):
+        self._size += 1
+        if isinstance(item, threading.Event):
+            # Events are unique keys, never coalesced
+            self.queue[item] = [item]
+            return
+
+        key = _check_key(item)
+        try:
+            results = self.queue[key]
+        except KeyError:
+            self.queue[key] = [item]
+        else:
+            if (self.deliver_transitions and
+                    results[-1].status != item.status):
+                results.append(item)
+            else:
+                results[-1] = item
+                self._size -= 1
+                self.unfinished_tasks -= 1
+                coalesced_checks.inc(consumer=self.name)
+                return
+
+        if (self.max_queue_size is not None and
+                self._size > self.max_queue_size):
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        for key, results in self.queue.items():
+            if isinstance(key, threading.Event):
+                continue
+            service_check = results.pop(0)
+            if not results:
+                del self.queue[key]
+            self._size -= 1
+            self.unfinished_tasks -= 1
+            dropped_checks.inc(consumer=self.name)
+            logger.debug('Queue of {} is full, dropping {}'
+                         .format(self.name, service_check))
+            return
+
+    def _get(self):
+        self._size -= 1
+        key, results = next(iter(self.queue.items()))
+        item = results.pop(0)
+        if not results:
+            del self.queue[key]
+        return item
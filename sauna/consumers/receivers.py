@@ -0,0 +1,164 @@
+"""Helpers for consumers sending checks to remote receivers."""
+from logging import getLogger
+import socket
+import threading
+import time
+
+logger = getLogger(__name__)
+
+
+class DNSCache:
+    """Cache of resolved addresses shared by all consumers.
+
+    Resolving a name can block for seconds when the resolver is slow,
+    results are kept for `ttl` seconds. Failures are kept for
+    `negative_ttl` seconds so that a name that does not resolve does not
+    hit the resolver before each send. When a name cannot be resolved
+    anymore its last known addresses keep being used.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (host, port) -> (expiration time, addresses or exception)
+        self._entries = {}
+        # (host, port) -> last addresses successfully resolved
+        self._last_known = {}
+
+    def get_addresses(self, host, port, ttl=300, negative_ttl=30):
+        """Get the addresses of a host, resolving it if needed.
+
+        :returns: list of addresses in the order given by the resolver
+        :raises socket.gaierror: if the host cannot be resolved
+        """
+        key = (host, port)
+        now = self._clock()
+        with self._lock:
+            try:
+                expires_at, result = self._entries[key]
+            except KeyError:
+                pass
+            else:
+                if now < expires_at:
+                    if isinstance(result, Exception):
+                        raise result
+                    return list(result)
+
+        try:
+            addresses = self._resolve(host, port)
+        except socket.gaierror as e:
+            with self._lock:
+                self._entries[key] = (now + negative_ttl, e)
+                last_known = self._last_known.get(key)
+            if last_known is None:
+                raise
+            logger.warning('Could not resolve {}, using last known addresses:'
+                           ' {}'.format(host, e))
+            return list(last_known)
+
+        with self._lock:
+            self._entries[key] = (now + ttl, addresses)
+            self._last_known[key] = addresses
+        return list(addresses)
+
+    @staticmethod
+    def _resolve(host, port):
+        receivers = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+        # Only keep the actual address, without duplicates
+        addresses = []
+        for receiver in receivers:
+            if receiver[4][0] not in addresses:
+                addresses.append(receiver[4][0])
+        return tuple(addresses)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._last_known.clear()
+
+
+#: Cache shared by all consumers
+dns_cache = DNSCache()
+
+
+class ReceiverState:
+
+    def __init__(self):
+        #: Moving average of the time it takes to connect, in seconds
+        self.latency = None
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        #: Time until which the receiver should not be used
+        self.cooldown_until = 0
+
+
+class ReceiverHealth:
+    """Track the health of the receivers of a consumer.
+
+    A receiver that fails is put aside for `cooldown` seconds, doubled at
+    each consecutive failure up to `max_cooldown`. Consumers can then skip
+    receivers known to be down instead of waiting for each of them to time
+    out.
+    """
+
+    #: Weight of the last measure in the moving average of latencies
+    latency_weight = 0.3
+
+    def __init__(self, cooldown=30, max_cooldown=300, clock=time.monotonic):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._receivers = {}
+
+    def __getitem__(self, address):
+        with self._lock:
+            return self._receivers.setdefault(address, ReceiverState())
+
+    def record_latency(self, address, latency):
+        receiver = self[address]
+        with self._lock:
+            if receiver.latency is None:
+                receiver.latency = latency
+            else:
+                receiver.latency += self.latency_weight * (
+                    latency - receiver.latency
+                )
+
+    def record_success(self, address):
+        receiver = self[address]
+        with self._lock:
+            receiver.successes += 1
+            receiver.consecutive_failures = 0
+            receiver.cooldown_until = 0
+
+    def record_failure(self, address, error):
+        receiver = self[address]
+        with self._lock:
+            receiver.failures += 1
+            receiver.consecutive_failures += 1
+            receiver.last_error = error
+            cooldown = min(
+                self.cooldown * 2 ** (receiver.consecutive_failures - 1),
+                self.max_cooldown
+            )
+            receiver.cooldown_until = self._clock() + cooldown
+        logger.info('Receiver {} put aside for {}s'.format(address, cooldown))
+
+    def available(self, addresses):
+        """Filter out addresses of receivers in cooldown.
+
+        When all receivers are in cooldown, the one whose cooldown ends
+        first is returned, so that sending is still attempted.
+        :returns: list of addresses, in the same order
+        """
+        now = self._clock()
+        cooldowns = [(self[address].cooldown_until, address)
+                     for address in addresses]
+        available = [address for cooldown_until, address in cooldowns
+                     if cooldown_until <= now]
+        if available or not cooldowns:
+            return available
+        return [min(cooldowns)[1]]
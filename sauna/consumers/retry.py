@@ -0,0 +1,131 @@
+"""Policies deciding when consumers retry sending checks."""
+from logging import getLogger
+import random
+import threading
+import time
+
+from sauna import metrics
+
+logger = getLogger(__name__)
+
+retries = metrics.counter(
+    'sauna_consumer_retries_total',
+    'Number of times a consumer retried sending a batch of checks'
+)
+breaker_state = metrics.gauge(
+    'sauna_consumer_circuit_breaker_state',
+    'State of the circuit breaker of a consumer: 0 closed, 1 half-open, '
+    '2 open'
+)
+breaker_opened = metrics.counter(
+    'sauna_consumer_circuit_breaker_opened_total',
+    'Number of times the circuit breaker of a consumer opened'
+)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter.
+
+    The delay before the n-th retry is drawn uniformly between 0 and
+    `base_delay * 2 ** (n - 1)`, capped to `max_delay`. Drawing the delay
+    at random spreads the retries of many agents that lost their receiver
+    at the same time, instead of having them all come back together.
+    """
+
+    def __init__(self, base_delay=10, max_delay=300, jitter=True,
+                 random=random.random):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._random = random
+
+    def delay(self, attempt):
+        """Seconds to wait after the `attempt`-th failed attempt."""
+        # Past 2 ** 32 times the base delay, the cap is reached anyway
+        exponent = min(max(attempt - 1, 0), 32)
+        delay = min(self.base_delay * 2 ** exponent, self.max_delay)
+        if self.jitter:
+            delay *= self._random()
+        return delay
+
+
+class CircuitBreaker:
+    """Stop sending to a receiver that keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    no attempt is made for `reset_timeout` seconds. It then becomes
+    half-open and lets a single attempt through as a probe: the breaker
+    closes if it succeeds and opens again if it fails.
+
+    A threshold of 0 disables the breaker.
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half-open'
+    OPEN = 'open'
+
+    _state_values = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, name='',
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def _set_state(self, state):
+        self.state = state
+        breaker_state.set(self._state_values[state], consumer=self.name)
+
+    def _refresh(self):
+        if (self.state == self.OPEN and
+                self._clock() >= self._opened_at + self.reset_timeout):
+            self._set_state(self.HALF_OPEN)
+            self._probing = False
+
+    def allow(self):
+        """Tell whether an attempt can be made now."""
+        with self._lock:
+            self._refresh()
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def remaining(self):
+        """Seconds until the breaker lets a probe through."""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(self._opened_at + self.reset_timeout - self._clock(),
+                       0)
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                logger.info('Circuit breaker of {} closed'.format(self.name))
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probing = False
+            if not self.failure_threshold:
+                return
+            if (self.state == self.HALF_OPEN or
+                    self.consecutive_failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    breaker_opened.inc(consumer=self.name)
+                    logger.warning('Circuit breaker of {} opened for {}s'
+                                   .format(self.name, self.reset_timeout))
+                self._set_state(self.OPEN)
+                self._opened_at = self._clock()
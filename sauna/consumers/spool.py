@@ -0,0 +1,402 @@
+"""Queue of checks persisted on disk.
+
+The spool is a directory of append-only segment files holding the checks
+not yet processed by a consumer, and a checkpoint file recording up to
+which record checks were processed. Checks survive restarts of sauna and
+long outages of a receiver without being kept in memory.
+
+Each record is made of its length, a CRC32 of its content and the fields
+of the check. A record that was only partially written when sauna crashed
+is detected by its CRC and ignored, with everything after it.
+
+Processing is acknowledged with :py:meth:`SpoolQueue.task_done`, a check
+that was taken from the spool but not acknowledged before sauna stopped is
+processed again on the next start.
+"""
+from collections import deque
+from logging import getLogger
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from sauna import ServiceCheck
+from sauna.consumers.queues import dropped_checks
+
+logger = getLogger(__name__)
+
+_record_header = struct.Struct('!II')
+_check_header = struct.Struct('!qhHHI')
+_checkpoint = struct.Struct('!QQ')
+
+_segment_prefix = 'segment-'
+_segment_suffix = '.spool'
+_checkpoint_file = 'checkpoint'
+
+
+def encode_record(service_check):
+    hostname = service_check.hostname.encode()
+    name = service_check.name.encode()
+    output = service_check.output.encode()
+    payload = b''.join((
+        _check_header.pack(int(service_check.timestamp),
+                           service_check.status, len(hostname), len(name),
+                           len(output)),
+        hostname, name, output
+    ))
+    return _record_header.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload):
+    timestamp, status, hostname_len, name_len, output_len = (
+        _check_header.unpack_from(payload)
+    )
+    offset = _check_header.size
+    hostname = payload[offset:offset + hostname_len].decode()
+    offset += hostname_len
+    name = payload[offset:offset + name_len].decode()
+    offset += name_len
+    output = payload[offset:offset + output_len].decode()
+    return ServiceCheck(timestamp=timestamp, hostname=hostname, name=name,
+                        status=status, output=output)
+
+
+def read_record(f):
+    """Read the next record of a segment.
+
+    :returns: the record as bytes without its header, None at the end of
+              the segment or if the record is incomplete or corrupted
+    """
+    header = f.read(_record_header.size)
+    if len(header) < _record_header.size:
+        return None
+    length, crc = _record_header.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        return None
+    return payload
+
+
+class Segment:
+
+    def __init__(self, seq, path):
+        self.seq = seq
+        self.path = path
+        #: Size in bytes of the valid records
+        self.size = 0
+        #: Number of valid records
+        self.count = 0
+        #: Wall clock time of the last write
+        self.last_write = time.time()
+
+
+class SpoolQueue(queue.Queue):
+    """Queue of checks stored in segment files.
+
+    New checks are appended to the last segment, a new segment is started
+    once it reaches `segment_size` bytes. Data is flushed to disk at most
+    every `fsync_interval` seconds, and when the consumer is asked to stop.
+
+    When the spool grows past `max_size` bytes, or when a segment was last
+    written more than `max_age` seconds ago, the oldest segment is removed
+    with the checks it contains. Segments whose checks were all processed
+    are removed as well.
+
+    Events notifying the consumer that it must stop are kept in memory and
+    handed out before any check, the checks remaining in the spool are
+    processed on the next start.
+    """
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024,
+                 max_size=256 * 1024 * 1024, max_age=None,
+                 fsync_interval=1, name='', clock=time.monotonic):
+        if segment_size <= 0 or max_size <= 0:
+            raise ValueError('Spool sizes must be positive')
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self.name = name
+        self._clock = clock
+        super().__init__()
+        self._open()
+
+    def _init(self, maxsize):
+        self._events = deque()
+        self._segments = deque()
+        self._size = 0
+        self._closed = False
+        self._writer = None
+        self._reader = None
+        #: Position (segment seq, offset) of the next record to read
+        self._read_position = None
+        #: Position up to which records were processed
+        self._checkpoint = (0, 0)
+        #: Positions following the records read but not acknowledged yet
+        self._unacked = deque()
+        self._needs_sync = False
+        self._last_sync = None
+
+    # Files
+
+    def _segment_path(self, seq):
+        return os.path.join(
+            self.directory,
+            '{}{:016d}{}'.format(_segment_prefix, seq, _segment_suffix)
+        )
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._checkpoint = self._load_checkpoint()
+        seqs = sorted(
+            int(f[len(_segment_prefix):-len(_segment_suffix)])
+            for f in os.listdir(self.directory)
+            if f.startswith(_segment_prefix) and f.endswith(_segment_suffix)
+        )
+        for seq in seqs:
+            segment = Segment(seq, self._segment_path(seq))
+            if seq < self._checkpoint[0]:
+                # Already processed, removal was interrupted
+                os.unlink(segment.path)
+                continue
+            self._scan(segment)
+            self._segments.append(segment)
+
+        self._read_position = max(
+            self._checkpoint,
+            (self._segments[0].seq, 0) if self._segments else (0, 0)
+        )
+        if self._size:
+            logger.info('Replaying {} checks from spool {}'
+                        .format(self._size, self.directory))
+        # Checks replayed are acknowledged like the ones put in the queue
+        self.unfinished_tasks = self._size
+
+        # Never append to a segment written by a previous run, its end may
+        # be corrupted
+        next_seq = self._segments[-1].seq + 1 if self._segments else 0
+        self._start_segment(max(next_seq, self._checkpoint[0]))
+        self._last_sync = self._clock()
+
+    def _scan(self, segment):
+        """Count the valid records of a segment, skipping processed ones."""
+        segment.last_write = os.stat(segment.path).st_mtime
+        with open(segment.path, 'rb') as f:
+            while True:
+                payload = read_record(f)
+                if payload is None:
+                    break
+                position = (segment.seq, f.tell())
+                segment.size = f.tell()
+                segment.count += 1
+                if position > self._checkpoint:
+                    self._size += 1
+
+    def _start_segment(self, seq):
+        segment = Segment(seq, self._segment_path(seq))
+        # Opened first, if it fails checks keep going to the current one
+        writer = open(segment.path, 'ab', buffering=0)
+        if self._writer is not None:
+            self._sync_writer()
+            self._writer.close()
+        self._writer = writer
+        self._segments.append(segment)
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.directory, _checkpoint_file)
+        try:
+            with open(path, 'rb') as f:
+                return _checkpoint.unpack(f.read())
+        except FileNotFoundError:
+            return (0, 0)
+        except (OSError, struct.error) as e:
+            logger.warning('Could not read spool checkpoint {}, replaying '
+                           'all checks: {}'.format(path, e))
+            return (0, 0)
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, _checkpoint_file)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_checkpoint.pack(*self._checkpoint))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Could not write spool checkpoint {}: {}'
+                           .format(path, e))
+
+    def _sync_writer(self):
+        try:
+            os.fsync(self._writer.fileno())
+        except OSError as e:
+            logger.warning('Could not sync spool {}: {}'
+                           .format(self.directory, e))
+
+    def _sync(self):
+        """Flush new checks and the checkpoint to disk."""
+        self._sync_writer()
+        self._save_checkpoint()
+        self._remove_processed_segments()
+        self._needs_sync = False
+        self._last_sync = self._clock()
+
+    def _maybe_sync(self):
+        self._needs_sync = True
+        if (self._closed or
+                self._clock() - self._last_sync >= self.fsync_interval):
+            self._sync()
+
+    # Segments
+
+    def _remove_segment(self, segment):
+        self._segments.remove(segment)
+        try:
+            os.unlink(segment.path)
+        except OSError as e:
+            logger.warning('Could not remove spool segment {}: {}'
+                           .format(segment.path, e))
+
+    def _remove_processed_segments(self):
+        while (len(self._segments) > 1 and
+               self._segments[0].seq < self._checkpoint[0]):
+            self._remove_segment(self._segments[0])
+
+    def _unread_count(self, segment):
+        """Number of records of a segment that were not read yet."""
+        if (segment.seq, segment.size) <= self._read_position:
+            return 0
+        if segment.seq > self._read_position[0]:
+            return segment.count
+        count = 0
+        with open(segment.path, 'rb') as f:
+            f.seek(self._read_position[1])
+            while f.tell() < segment.size and read_record(f) is not None:
+                count += 1
+        return count
+
+    def _evict(self, segment):
+        dropped = self._unread_count(segment)
+        self._size -= dropped
+        self.unfinished_tasks -= dropped
+        if dropped:
+            dropped_checks.inc(dropped, consumer=self.name)
+            logger.warning('Spool {} is full, dropped {} checks'
+                           .format(self.directory, dropped))
+        if self._reader is not None and self._reader[0] is segment:
+            self._reader[1].close()
+            self._reader = None
+        next_position = (segment.seq + 1, 0)
+        self._read_position = max(self._read_position, next_position)
+        self._checkpoint = max(self._checkpoint, next_position)
+        self._remove_segment(segment)
+        self._needs_sync = True
+
+    def _enforce_limits(self):
+        if self._segments[-1].size >= self.segment_size:
+            self._start_segment(self._segments[-1].seq + 1)
+
+        while (len(self._segments) > 1 and
+               sum(s.size for s in self._segments) > self.max_size):
+            self._evict(self._segments[0])
+
+        if self.max_age is not None:
+            too_old = time.time() - self.max_age
+            while (len(self._segments) > 1 and
+                   self._segments[0].last_write < too_old):
+                self._evict(self._segments[0])
+
+    # Queue interface, called with the mutex of the queue held
+
+    def _qsize(self):
+        return self._size + len(self._events)
+
+    def _put(self, item):
+        if isinstance(item, threading.Event):
+            self._events.append(item)
+            self._closed = True
+            if self._needs_sync:
+                self._sync()
+            return
+
+        segment = self._segments[-1]
+        try:
+            record = encode_record(item)
+            self._writer.write(record)
+        except (OSError, struct.error) as e:
+            self._drop(item, segment, e)
+            return
+        segment.size += len(record)
+        segment.count += 1
+        segment.last_write = time.time()
+        self._size += 1
+        try:
+            self._enforce_limits()
+        except OSError as e:
+            logger.warning('Could not rotate spool {}: {}'
+                           .format(self.directory, e))
+        self._maybe_sync()
+
+    def _drop(self, item, segment, error):
+        """Give up on a check that could not be written to the spool."""
+        # Remove what may have been written of the record, so that the
+        # next records are not appended after a corrupted one
+        try:
+            self._writer.truncate(segment.size)
+        except OSError:
+            pass
+        # Balance the increment done by put once _put returns
+        self.unfinished_tasks -= 1
+        dropped_checks.inc(consumer=self.name)
+        logger.warning('Could not write check {} to spool {}, dropped it: {}'
+                       .format(item.name, self.directory, error))
+
+    def _get(self):
+        if self._events:
+            return self._events.popleft()
+
+        while True:
+            seq, offset = self._read_position
+            if self._reader is None or self._reader[0].seq != seq:
+                if self._reader is not None:
+                    self._reader[1].close()
+                segment = next(s for s in self._segments if s.seq >= seq)
+                if segment.seq != seq:
+                    seq, offset = segment.seq, 0
+                self._reader = (segment, open(segment.path, 'rb'))
+                self._reader[1].seek(offset)
+
+            segment, f = self._reader
+            if offset < segment.size:
+                payload = read_record(f)
+                self._read_position = (seq, f.tell())
+                self._unacked.append(self._read_position)
+                self._size -= 1
+                return decode_payload(payload)
+
+            # End of this segment, continue with the next one
+            self._read_position = (seq + 1, 0)
+
+    def task_done(self):
+        """Acknowledge that a check taken from the spool was processed."""
+        with self.mutex:
+            if self._unacked:
+                self._checkpoint = max(self._checkpoint,
+                                       self._unacked.popleft())
+                self._maybe_sync()
+        super().task_done()
+
+    def close(self):
+        with self.mutex:
+            if self._writer is None:
+                return
+            self._sync()
+            self._writer.close()
+            self._writer = None
+            if self._reader is not None:
+                self._reader[1].close()
+                self._reader = None
@@ -0,0 +1,439 @@
+import asyncio
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                Future, CancelledError)
+from concurrent.futures.process import BrokenProcessPool
+import functools
+import heapq
+import itertools
+from logging import getLogger
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+
+logger = getLogger(__name__)
+
+try:
+    all_tasks = asyncio.all_tasks
+except AttributeError:
+    # Python 3.6 only has the deprecated class method
+    all_tasks = asyncio.Task.all_tasks
+
+
+class CheckTimeoutError(Exception):
+    pass
+
+
+def _cancel_plugin_check(check):
+    """Let the plugin clean up what a timed out check left behind."""
+    if check.plugin is None:
+        return
+    try:
+        check.plugin.cancel_check(check.config)
+    except Exception as e:
+        logger.warning('Could not cancel check {}: {}'.format(check.name, e))
+
+
+class ThreadExecutor:
+    """Run checks on a pool of threads."""
+
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, check):
+        """Run a check in a thread.
+
+        :returns: a :py:class:`concurrent.futures.Future` holding the
+                  (status, output) tuple of the check
+        """
+        return self._pool.submit(check.run_check)
+
+    def cancel(self, future, check):
+        """Try to stop a check that timed out.
+
+        A running thread cannot be interrupted, the plugin is asked to
+        abort what it is doing instead. The future only completes once
+        the thread returns.
+
+        :returns: whether the check had started to run
+        """
+        if future.cancel():
+            # Still waiting for a thread
+            return False
+        _cancel_plugin_check(check)
+        return True
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+class SerialExecutor(ThreadExecutor):
+    """Run checks one by one.
+
+    Checks do not run in the producer thread itself but in a single
+    worker thread, this allows the producer to give up on a check that
+    does not complete in time. The worker is then abandoned and a new one
+    takes its place, sauna does not run the check again until the
+    abandoned worker returns.
+    """
+
+    def __init__(self):
+        super().__init__(1)
+
+    def cancel(self, future, check):
+        if not super().cancel(future, check):
+            return False
+        self._pool.shutdown(wait=False)
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        return True
+
+
+class AsyncioExecutor:
+    """Run checks concurrently on a single asyncio event loop.
+
+    Checks written as coroutines run directly on the event loop, which
+    allows thousands of network probes to wait at the same time without
+    tying up a thread each. Other checks fall back to a bounded pool of
+    threads. A semaphore limits the number of checks running at once.
+    """
+
+    #: Maximum number of threads running synchronous checks.
+    max_threads = 32
+
+    def __init__(self, concurrency):
+        self._concurrency = concurrency
+        self._semaphore = None
+        self._lock = threading.Lock()
+        # Futures returned by submit mapped to an event set once their
+        # check acquired the semaphore
+        self._started = {}
+        self._thread_pool = ThreadPoolExecutor(
+            max_workers=min(concurrency, self.max_threads)
+        )
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            name='asyncio_executor', target=self._run_loop, daemon=True
+        )
+        self._loop_thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            for task in all_tasks(self._loop):
+                task.cancel()
+            self._loop.close()
+        logger.debug('Exited asyncio executor loop')
+
+    async def _run_check(self, check, started):
+        # The semaphore is created lazily so that it belongs to the loop
+        # of the executor, it is only ever touched from the loop thread.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        async with self._semaphore:
+            started.set()
+            if check.is_coroutine:
+                return await check.check_func(check.config)
+            return await self._loop.run_in_executor(self._thread_pool,
+                                                    check.run_check)
+
+    def submit(self, check):
+        """Schedule a check on the event loop.
+
+        :returns: a :py:class:`concurrent.futures.Future` holding the
+                  (status, output) tuple of the check
+        """
+        started = threading.Event()
+        future = asyncio.run_coroutine_threadsafe(
+            self._run_check(check, started), self._loop
+        )
+        with self._lock:
+            self._started[future] = started
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            self._started.pop(future, None)
+
+    def cancel(self, future, check):
+        """Stop a check that timed out.
+
+        Coroutines and checks still waiting for the semaphore are
+        cancelled. Checks running in a thread cannot be interrupted so the
+        plugin is asked to abort instead, their future and their slot of
+        the semaphore are only released once the thread returns.
+
+        :returns: whether the check had started to run
+        """
+        with self._lock:
+            started = self._started.get(future)
+        started = started is not None and started.is_set()
+        if check.is_coroutine or not started:
+            future.cancel()
+        else:
+            _cancel_plugin_check(check)
+        return started
+
+    def shutdown(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread_pool.shutdown(wait=False)
+
+
+# Plugin instances living in a worker process, indexed by the key of the
+# plugin in the main process
+_worker_plugins = {}
+
+
+def _init_worker(extra_plugins):
+    """Make plugins available in a freshly started worker process."""
+    # Interruptions are handled by the main process which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from sauna import Sauna
+    Sauna.import_submodules('sauna.plugins.ext')
+    for extra_plugin_path in extra_plugins:
+        Sauna.import_directory_modules(extra_plugin_path)
+
+
+def _run_check_in_worker(plugin_key, plugin_cls, plugin_config,
+                         cache_generation, func_name, check_config):
+    """Run a check with a plugin instance living in the worker.
+
+    The instance is created on the first run and reused afterwards, its
+    cache is invalidated whenever the one of the main process was.
+    """
+    from sauna.plugins.base import Check
+    try:
+        plugin, plugin_generation = _worker_plugins[plugin_key]
+    except KeyError:
+        plugin = plugin_cls(plugin_config)
+    else:
+        if plugin_generation != cache_generation:
+            plugin.invalidate_cache()
+    _worker_plugins[plugin_key] = (plugin, cache_generation)
+    check = Check(func_name, 0, getattr(plugin, func_name), check_config)
+    return check.run_check()
+
+
+class ProcessExecutor:
+    """Run checks in a pool of long-lived worker processes.
+
+    CPU heavy checks running in the main process compete for the GIL with
+    the consumers. Workers keep their own plugin instances between runs,
+    so only the configuration of the check goes back and forth.
+
+    A check that times out gets its whole pool killed, a new one is
+    started on the next submission. Checks that were running in a pool
+    that crashed or was killed fail.
+    """
+
+    #: Pools are created with an initializer and a start method, which
+    #: need Python 3.7
+    supported = sys.version_info >= (3, 7)
+
+    def __init__(self, max_workers, extra_plugins=()):
+        self._max_workers = max_workers
+        self._extra_plugins = tuple(extra_plugins)
+        self._pool = None
+        self._lock = threading.Lock()
+        # Futures returned by submit mapped to the pool running them
+        self._running = {}
+
+    def _create_pool(self):
+        # Forking a process running threads is unsafe, the pool starts
+        # its workers from a pristine process instead.
+        methods = multiprocessing.get_all_start_methods()
+        method = 'forkserver' if 'forkserver' in methods else 'spawn'
+        return ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context(method),
+            initializer=_init_worker,
+            initargs=(self._extra_plugins,)
+        )
+
+    def _kill_pool(self, pool):
+        """Stop a pool without waiting for its workers to finish."""
+        if self._pool is pool:
+            self._pool = None
+        processes = getattr(pool, '_processes', None) or {}
+        for process in list(processes.values()):
+            process.kill()
+        pool.shutdown(wait=False)
+
+    def submit(self, check):
+        """Run a check in a worker process.
+
+        :returns: a :py:class:`concurrent.futures.Future` holding the
+                  (status, output) tuple of the check
+        """
+        args = (id(check.plugin), type(check.plugin), check.plugin_config,
+                check.plugin.cache_generation, check.check_func.__name__,
+                check.config)
+        result = Future()
+        result.set_running_or_notify_cancel()
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._create_pool()
+            pool = self._pool
+            try:
+                future = pool.submit(_run_check_in_worker, *args)
+            except BrokenProcessPool:
+                self._kill_pool(pool)
+                pool = self._pool = self._create_pool()
+                future = pool.submit(_run_check_in_worker, *args)
+            self._running[result] = pool
+        future.add_done_callback(
+            functools.partial(self._set_result, result)
+        )
+        return result
+
+    def _set_result(self, result, future):
+        with self._lock:
+            pool = self._running.pop(result, None)
+            if pool is None:
+                # The check was cancelled
+                return
+            if isinstance(future.exception(), BrokenProcessPool):
+                logger.warning('A worker process crashed, restarting pool')
+                self._kill_pool(pool)
+        try:
+            result.set_result(future.result())
+        except BrokenProcessPool:
+            result.set_exception(
+                RuntimeError('Worker process crashed while running the '
+                             'check')
+            )
+        except Exception as e:
+            result.set_exception(e)
+
+    def cancel(self, future, check):
+        """Stop a check that timed out by killing its pool.
+
+        :returns: whether the check had started to run
+        """
+        with self._lock:
+            pool = self._running.pop(future, None)
+            if pool is None:
+                return False
+            logger.warning('Check {} timed out, killing worker '
+                           'processes'.format(check.name))
+            self._kill_pool(pool)
+        future.set_exception(CheckTimeoutError('Worker process was killed'))
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+
+class Watchdog:
+    """Fail futures that do not complete in time.
+
+    A single thread keeps the deadlines of all watched futures in a heap
+    and wakes up when the earliest one expires.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deadlines_changed = threading.Condition(self._lock)
+        # Heap of (deadline, sequence, watched future, timeout, on_timeout)
+        self._deadlines = []
+        self._sequence = itertools.count()
+        # Watched futures whose result has not been decided yet
+        self._pending = set()
+        self._thread = None
+        self._must_stop = False
+
+    def watch(self, future, timeout, on_timeout=None):
+        """Watch a future.
+
+        :param timeout: seconds the future has to complete, None to wait
+                        forever
+        :param on_timeout: callable run when the future times out, before
+                           the returned future fails
+        :returns: a :py:class:`concurrent.futures.Future` with the result
+                  of `future`, or a :py:class:`CheckTimeoutError` if it
+                  did not complete in time
+        """
+        watched = Future()
+        watched.set_running_or_notify_cancel()
+        with self._lock:
+            self._pending.add(watched)
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (
+                    time.monotonic() + timeout, next(self._sequence),
+                    watched, timeout, on_timeout
+                ))
+                self._deadlines_changed.notify()
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        name='watchdog', target=self._run, daemon=True
+                    )
+                    self._thread.start()
+        future.add_done_callback(
+            functools.partial(self._copy_result, watched)
+        )
+        return watched
+
+    def _claim(self, watched):
+        """Decide the result of a watched future, only once."""
+        with self._lock:
+            try:
+                self._pending.remove(watched)
+            except KeyError:
+                return False
+            return True
+
+    def _copy_result(self, watched, future):
+        if not self._claim(watched):
+            return
+        try:
+            watched.set_result(future.result())
+        except CancelledError:
+            watched.set_exception(CheckTimeoutError('Check was cancelled'))
+        except Exception as e:
+            watched.set_exception(e)
+
+    def _expire(self, watched, timeout, on_timeout):
+        if not self._claim(watched):
+            return
+        if on_timeout is not None:
+            try:
+                on_timeout()
+            except Exception as e:
+                logger.warning('Could not stop timed out check: {}'
+                               .format(e))
+        watched.set_exception(CheckTimeoutError(
+            'Check timed out after {}s'.format(timeout)
+        ))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._must_stop:
+                        return
+                    now = time.monotonic()
+                    if self._deadlines and self._deadlines[0][0] <= now:
+                        break
+                    if self._deadlines:
+                        wait = self._deadlines[0][0] - now
+                    else:
+                        wait = None
+                    self._deadlines_changed.wait(timeout=wait)
+                _, _, watched, timeout, on_timeout = heapq.heappop(
+                    self._deadlines
+                )
+            # Called without the lock, on_timeout and the callbacks of the
+            # future may take their own locks
+            self._expire(watched, timeout, on_timeout)
+
+    def shutdown(self):
+        with self._lock:
+            self._must_stop = True
+            self._deadlines_changed.notify()
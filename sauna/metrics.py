@@ -0,0 +1,203 @@
+"""Metrics describing how sauna itself behaves.
+
+Metrics are registered once by name and shared by the whole process::
+
+    overruns = metrics.counter('sauna_check_overruns_total',
+                               'Checks that exceeded their timeout')
+    overruns.inc(check='load_load1')
+
+They are exposed in the Prometheus text format by :py:func:`render`.
+"""
+import bisect
+import threading
+
+all_metrics = {}
+_all_metrics_lock = threading.Lock()
+
+
+class Metric:
+    """Value of a metric, one per set of labels."""
+
+    type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels_key(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, amount=1, **labels):
+        key = self._labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._labels_key(labels), 0)
+
+    def items(self):
+        """List of (labels, value) tuples, labels being a dict."""
+        with self._lock:
+            return [(dict(key), value) for key, value in self._values.items()]
+
+    def samples(self):
+        """List of (name, labels, value) tuples to expose."""
+        return [(self.name, labels, value) for labels, value in self.items()]
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    type = 'counter'
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._labels_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, func, **labels):
+        """Read the value from a callable whenever the gauge is read."""
+        self.set(func, **labels)
+
+    @staticmethod
+    def _resolve(value):
+        return value() if callable(value) else value
+
+    def get(self, **labels):
+        return self._resolve(super().get(**labels))
+
+    def items(self):
+        return [(labels, self._resolve(value))
+                for labels, value in super().items()]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in buckets."""
+
+    type = 'histogram'
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                       10, 30, 60)
+
+    def __init__(self, name, description, buckets=default_buckets):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._labels_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                # The last count is for values above all buckets
+                counts, total = [0] * (len(self.buckets) + 1), 0
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """Number of observations and their sum."""
+        with self._lock:
+            counts, total = self._values.get(self._labels_key(labels),
+                                             ((), 0))
+            return sum(counts), total
+
+    def items(self):
+        """List of (labels, (counts per bucket, sum)) tuples."""
+        with self._lock:
+            return [(dict(key), (list(counts), total))
+                    for key, (counts, total) in self._values.items()]
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total) in self.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                dict(labels, le=format_value(bound)),
+                                cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+def _get_or_create(metric_cls, name, description, **kwargs):
+    with _all_metrics_lock:
+        try:
+            metric = all_metrics[name]
+        except KeyError:
+            metric = all_metrics[name] = metric_cls(name, description,
+                                                    **kwargs)
+    if not isinstance(metric, metric_cls):
+        raise ValueError('Metric {} is already registered as a {}'
+                         .format(name, metric.type))
+    return metric
+
+
+def counter(name, description=''):
+    """Get the counter registered under a name, creating it if needed."""
+    return _get_or_create(Counter, name, description)
+
+
+def gauge(name, description=''):
+    """Get the gauge registered under a name, creating it if needed."""
+    return _get_or_create(Gauge, name, description)
+
+
+def histogram(name, description='', **kwargs):
+    """Get the histogram registered under a name, creating it if needed."""
+    return _get_or_create(Histogram, name, description, **kwargs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+def _escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_sample(name, labels, value):
+    """Line of the Prometheus text format for a sample."""
+    if labels:
+        name += '{' + ','.join(
+            '{}="{}"'.format(label, _escape_label(labels[label]))
+            for label in sorted(labels)
+        ) + '}'
+    return '{} {}\n'.format(name, format_value(value))
+
+
+def format_help(name, description, type_):
+    return '# HELP {} {}\n# TYPE {} {}\n'.format(
+        name, description.replace('\\', '\\\\').replace('\n', '\\n'),
+        name, type_
+    )
+
+
+def render():
+    """Expose all metrics in the Prometheus text format."""
+    with _all_metrics_lock:
+        metrics = sorted(all_metrics.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.append(format_help(metric.name, metric.description,
+                                 metric.type))
+        for name, labels, value in metric.samples():
+            lines.append(format_sample(name, labels, value))
+    return ''.join(lines)
@@ -1,5 +1,8 @@
+import asyncio
 import copy
 import logging
+import threading
+import time
 
 
 class Plugin:
@@ -19,11 +22,39 @@ class Plugin:
     STATUS_CRIT = 2
     STATUS_UNKNOWN = 3
 
+    #: Attributes holding data shared by the checks of a plugin during a
+    #: single run, they are reset by :py:meth:`invalidate_cache`.
+    cached_attributes = ()
+
+    #: Incremented each time the cache is invalidated, it lets copies of
+    #: the plugin living in worker processes know when to invalidate theirs.
+    cache_generation = 0
+
     def __init__(self, config):
         if config is None:
             config = {}
         self.config = config
 
+    def invalidate_cache(self):
+        """Forget the data fetched during the previous run of checks.
+
+        Plugin instances live as long as sauna, this is called before each
+        run so that checks do not report stale data. Checks of a previous
+        run may still be running, getters must return the value they read
+        or fetched rather than read the attribute again.
+        """
+        for attribute in self.cached_attributes:
+            setattr(self, attribute, None)
+        self.cache_generation += 1
+
+    def cancel_check(self, check_config):
+        """Abort a check that did not complete before its timeout.
+
+        Called from another thread than the one running the check, plugins
+        starting subprocesses or holding resources can override it to
+        release them.
+        """
+
     @property
     def logger(self):
         return logging.getLogger('sauna.' + self.__class__.__name__)
@@ -92,9 +123,68 @@ class Check:
         self.periodicity = periodicity
         self.check_func = check_func
         self.config = config
+        # Plugin instance the check belongs to, if any
+        self.plugin = getattr(check_func, '__self__', None)
+        # Seconds to wait after sauna starts before the first run
+        self.offset = 0
+        # Name of the executor to run the check in, None for the default one
+        self.executor = None
+        # Configuration the plugin was created with
+        self.plugin_config = {}
+        # Seconds the check has to complete, None for no limit
+        self.timeout = None
+        self.is_coroutine = asyncio.iscoroutinefunction(check_func)
 
     def run_check(self):
-        return self.check_func(self.config)
+        if not self.is_coroutine:
+            return self.check_func(self.config)
+        # Checks written as coroutines can still run outside of an event
+        # loop, each run then gets its own loop
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.check_func(self.config))
+        finally:
+            loop.close()
+
+
+class CheckRegistry:
+    """Active checks built once from the configuration.
+
+    Plugins are instantiated a single time and shared by all their checks,
+    checks are indexed by periodicity so that finding the ones to run is
+    cheap.
+    """
+
+    def __init__(self, checks):
+        self.checks = checks
+        self._checks_by_periodicity = {}
+        self._checks_by_schedule = {}
+        for check in checks:
+            self._checks_by_periodicity.setdefault(check.periodicity, [])
+            self._checks_by_periodicity[check.periodicity].append(check)
+            schedule = (check.periodicity, check.offset)
+            self._checks_by_schedule.setdefault(schedule, [])
+            self._checks_by_schedule[schedule].append(check)
+
+    @property
+    def periodicities(self):
+        return set(self._checks_by_periodicity)
+
+    @property
+    def schedules(self):
+        """Checks grouped by (periodicity, offset), they run together."""
+        return self._checks_by_schedule
+
+    def get_checks(self, periodicity):
+        return self._checks_by_periodicity.get(periodicity, [])
+
+    @staticmethod
+    def invalidate_plugins_cache(checks):
+        """Reset the cache of every plugin owning one of the checks."""
+        plugins = {id(check.plugin): check.plugin for check in checks
+                   if check.plugin is not None}
+        for plugin in plugins.values():
+            plugin.invalidate_cache()
 
 
 class PsutilPlugin(Plugin):
@@ -108,3 +198,88 @@ class PsutilPlugin(Plugin):
             from .. import DependencyError
             raise DependencyError(self.__class__.__name__, 'psutil',
                                   'psutil', 'python3-psutil')
+
+
+class RateSampler:
+    """Compute rates from consecutive samples of ever increasing counters.
+
+    Samples are taken by a function returning a dict of namedtuples, for
+    instance ``psutil.net_io_counters(pernic=True)``. The previous sample
+    is kept between runs so that rates are computed without waiting,
+    except on the very first run when no previous sample exists yet.
+
+    >>> sampler = RateSampler(
+    ...     lambda: psutil.disk_io_counters(perdisk=True))
+    >>> sampler.prime()
+    >>> sampler.rates()['sda'].read_bytes
+    12884.7
+    """
+
+    def __init__(self, sample_func, min_interval=1, clock=time.monotonic):
+        """
+        :param sample_func: callable returning a dict of namedtuples of
+                            counters
+        :param min_interval: minimum number of seconds between two samples,
+                             rates asked for more often are shared
+        :param clock: function returning the current time in seconds
+        """
+        self._sample_func = sample_func
+        self._min_interval = min_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._previous_sample = None
+        self._previous_time = None
+        self._rates = None
+        self._rates_time = None
+
+    def _sample(self):
+        self._previous_sample = self._sample_func()
+        self._previous_time = self._clock()
+
+    def prime(self):
+        """Take a first sample so that the first rates come without wait."""
+        with self._lock:
+            self._sample()
+
+    def rates(self):
+        """Rate per second of each counter since the previous sample.
+
+        :returns: dict of namedtuples with the same keys and fields as the
+                  samples
+        """
+        with self._lock:
+            now = self._clock()
+            if (self._rates is not None and
+                    now - self._rates_time < self._min_interval):
+                return self._rates
+
+            if self._previous_sample is None:
+                self._sample()
+                now = self._previous_time
+            if self._rates is None:
+                # Too short an interval would give meaningless rates
+                elapsed = now - self._previous_time
+                if elapsed < self._min_interval:
+                    time.sleep(self._min_interval - elapsed)
+
+            first_sample, first_time = (self._previous_sample,
+                                        self._previous_time)
+            self._sample()
+            elapsed = self._previous_time - first_time
+            self._rates = {
+                key: self._compute_rates(first_sample[key], counters,
+                                         elapsed)
+                for key, counters in self._previous_sample.items()
+                if key in first_sample
+            }
+            self._rates_time = self._previous_time
+            return self._rates
+
+    @staticmethod
+    def _compute_rates(first, last, elapsed):
+        # A counter going backward was reset or wrapped around, the amount
+        # it changed since the previous sample is unknown.
+        return type(last)._make(
+            max(0, last_value - first_value) / elapsed
+            for first_value, last_value in zip(first, last)
+        )
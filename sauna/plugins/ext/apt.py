@@ -6,6 +6,8 @@ my_plugin = PluginRegister('Apt')
 @my_plugin.plugin()
 class AptPlugin(Plugin):
 
+    cached_attributes = ('_packages',)
+
     def __init__(self, config):
         super().__init__(config)
         try:
@@ -22,11 +24,12 @@ class AptPlugin(Plugin):
 
     @property
     def packages(self) -> list:
-        if self._packages is None:
+        packages = self._packages
+        if packages is None:
             with self._apt.Cache() as cache:
                 cache.upgrade()  # Only reads the packages to upgrade
-                self._packages = cache.get_changes()
-        return self._packages
+                packages = self._packages = cache.get_changes()
+        return packages
 
     @my_plugin.check()
     def security_updates(self, check_config):
@@ -1,5 +1,6 @@
 import subprocess
 import shlex
+import threading
 
 from sauna.plugins import Plugin, PluginRegister
 
@@ -9,6 +10,12 @@ myplugin = PluginRegister('Command')
 @myplugin.plugin()
 class Command(Plugin):
 
+    def __init__(self, config):
+        super().__init__(config)
+        # Running subprocesses indexed by the id of their check config
+        self._processes = {}
+        self._processes_lock = threading.Lock()
+
     @myplugin.check()
     def command(self, check_config):
         p = subprocess.Popen(
@@ -17,9 +24,21 @@ class Command(Plugin):
             stderr=subprocess.STDOUT,
             universal_newlines=True
         )
-        stdout, _ = p.communicate()
+        with self._processes_lock:
+            self._processes[id(check_config)] = p
+        try:
+            stdout, _ = p.communicate()
+        finally:
+            with self._processes_lock:
+                self._processes.pop(id(check_config), None)
         return p.returncode, stdout
 
+    def cancel_check(self, check_config):
+        with self._processes_lock:
+            p = self._processes.get(id(check_config))
+        if p is not None:
+            p.kill()
+
     @staticmethod
     def _return_code_to_status(cls, return_code):
         if return_code in (cls.STATUS_OK, cls.STATUS_WARN, cls.STATUS_CRIT):
@@ -7,6 +7,8 @@ my_plugin = PluginRegister('Disque')
 @my_plugin.plugin()
 class Disque(Plugin):
 
+    cached_attributes = ('_disque_info',)
+
     def __init__(self, config):
         super().__init__(config)
         try:
@@ -39,10 +41,11 @@ class Disque(Plugin):
 
     @property
     def disque_info(self):
-        if not self._disque_info:
+        disque_info = self._disque_info
+        if not disque_info:
             r = self.redis.StrictRedis(**self.config)
-            self._disque_info = r.info()
-        return self._disque_info
+            disque_info = self._disque_info = r.info()
+        return disque_info
 
     @my_plugin.check()
     def qlen(self, check_config):
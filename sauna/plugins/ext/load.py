@@ -9,6 +9,8 @@ my_plugin = PluginRegister('Load')
 @my_plugin.plugin()
 class Load(Plugin):
 
+    cached_attributes = ('_load',)
+
     def __init__(self, config):
         super().__init__(config)
         self._load = None
@@ -30,9 +32,10 @@ class Load(Plugin):
 
     @property
     def load(self):
-        if not self._load:
-            self._load = os.getloadavg()
-        return self._load
+        load = self._load
+        if not load:
+            load = self._load = os.getloadavg()
+        return load
 
     @staticmethod
     def config_sample():
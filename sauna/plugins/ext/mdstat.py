@@ -6,6 +6,8 @@ my_plugin = PluginRegister('MDStat')
 @my_plugin.plugin()
 class MDStat(Plugin):
 
+    cached_attributes = ('_md_stats',)
+
     def __init__(self, config):
         super().__init__(config)
         try:
@@ -19,9 +21,10 @@ class MDStat(Plugin):
 
     @property
     def md_stats(self):
-        if not self._md_stats:
-            self._md_stats = self.pymdstat.MdStat().get_stats()
-        return self._md_stats
+        md_stats = self._md_stats
+        if not md_stats:
+            md_stats = self._md_stats = self.pymdstat.MdStat().get_stats()
+        return md_stats
 
     @my_plugin.check()
     def status(self, check_config):
@@ -10,6 +10,8 @@ my_plugin = PluginRegister('Memcached')
 @my_plugin.plugin()
 class Memcached(Plugin):
 
+    cached_attributes = ('_stats',)
+
     def __init__(self, config):
         super().__init__(config)
         self.config = {
@@ -61,11 +63,12 @@ class Memcached(Plugin):
 
     @property
     def stats(self):
-        if not self._stats:
-            self._stats = self._raw_stats_to_dict(
+        stats = self._stats
+        if not stats:
+            stats = self._stats = self._raw_stats_to_dict(
                 self._fetch_memcached_stats()
             )
-        return self._stats
+        return stats
 
     @classmethod
     def _raw_stats_to_dict(cls, stats_data):
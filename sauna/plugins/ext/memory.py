@@ -7,6 +7,8 @@ my_plugin = PluginRegister('Memory')
 @my_plugin.plugin()
 class Memory(PsutilPlugin):
 
+    cached_attributes = ('_virtual_memory', '_swap_memory')
+
     def __init__(self, config):
         super().__init__(config)
         self._virtual_memory = None
@@ -41,15 +43,19 @@ class Memory(PsutilPlugin):
 
     @property
     def virtual_memory(self):
-        if not self._virtual_memory:
-            self._virtual_memory = self.psutil.virtual_memory()
-        return self._virtual_memory
+        virtual_memory = self._virtual_memory
+        if not virtual_memory:
+            virtual_memory = self._virtual_memory = (
+                self.psutil.virtual_memory()
+            )
+        return virtual_memory
 
     @property
     def swap_memory(self):
-        if not self._swap_memory:
-            self._swap_memory = self.psutil.swap_memory()
-        return self._swap_memory
+        swap_memory = self._swap_memory
+        if not swap_memory:
+            swap_memory = self._swap_memory = self.psutil.swap_memory()
+        return swap_memory
 
     @staticmethod
     def config_sample():
@@ -1,7 +1,4 @@
-from functools import lru_cache
-import time
-
-from sauna.plugins.base import PsutilPlugin
+from sauna.plugins.base import PsutilPlugin, RateSampler
 from sauna.plugins import human_to_bytes, bytes_to_human, PluginRegister
 
 my_plugin = PluginRegister('Network')
@@ -12,6 +9,11 @@ class Network(PsutilPlugin):
 
     def __init__(self, config):
         super().__init__(config)
+        # All interfaces are sampled at once and shared by the checks
+        self._rates = RateSampler(
+            lambda: self.psutil.net_io_counters(pernic=True)
+        )
+        self._rates.prime()
 
     @my_plugin.check()
     def upload_data_speed(self, check_config):
@@ -54,23 +56,15 @@ class Network(PsutilPlugin):
             'Download : {} p/s'.format(dl)
         )
 
-    @lru_cache()
-    def get_network_data(self, interface='eth0', delay=1):
-        t0 = time.time()
-        counter = self.psutil.net_io_counters(pernic=True)[interface]
-        first_values = (counter.bytes_sent, counter.bytes_recv,
-                        counter.packets_sent, counter.packets_recv)
+    def get_network_data(self, interface='eth0'):
+        """Upload and download speeds of an interface.
 
-        time.sleep(delay)
-        counter = self.psutil.net_io_counters(pernic=True)[interface]
-        t1 = time.time()
-        last_values = (counter.bytes_sent, counter.bytes_recv,
-                       counter.packets_sent, counter.packets_recv)
-        kb_ul, kb_dl, p_ul, p_dl = [
-            (last - first) / (t1 - t0)
-            for last, first in zip(last_values, first_values)
-        ]
-        return kb_ul, kb_dl, p_ul, p_dl
+        Speeds are averaged since the previous time they were asked for.
+        :returns: bytes and packets per second sent and received
+        """
+        rates = self._rates.rates()[interface]
+        return (rates.bytes_sent, rates.bytes_recv,
+                rates.packets_sent, rates.packets_recv)
 
     @staticmethod
     def config_sample():
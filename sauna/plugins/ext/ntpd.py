@@ -10,6 +10,8 @@ my_plugin = PluginRegister('Ntpd')
 @my_plugin.plugin()
 class Ntpd(Plugin):
 
+    cached_attributes = ('_last_loop_stats',)
+
     def __init__(self, config):
         super().__init__(config)
         self.config = {
@@ -20,14 +22,15 @@ class Ntpd(Plugin):
     @property
     def last_loop_stats(self):
         loopstats_file = os.path.join(self.config['stats_dir'], 'loopstats')
-        if not self._last_loop_stats:
+        last_loop_stats = self._last_loop_stats
+        if not last_loop_stats:
             with open(loopstats_file) as f:
                 last_line_items = f.readlines()[-1].split()
-            self._last_loop_stats = {
+            last_loop_stats = self._last_loop_stats = {
                 'timestamp': int(os.stat(loopstats_file).st_mtime),
                 'offset': float(last_line_items[2])
             }
-        return self._last_loop_stats
+        return last_loop_stats
 
     @my_plugin.check()
     def last_sync_delta(self, check_config):
@@ -11,6 +11,8 @@ my_plugin = PluginRegister('Postfix')
 @my_plugin.plugin()
 class Postfix(Plugin):
 
+    cached_attributes = ('_mailq_output',)
+
     def __init__(self, config):
         super().__init__(config)
         self.config = {
@@ -29,12 +31,14 @@ class Postfix(Plugin):
 
     @property
     def mailq_output(self):
-        if not self._mailq_output:
+        mailq_output = self._mailq_output
+        if not mailq_output:
             if self.config['method'] == 'tcp':
-                self._mailq_output = self._fetch_showq()
+                mailq_output = self._fetch_showq()
             else:
-                self._mailq_output = self._exec_mailq_command()
-        return self._mailq_output
+                mailq_output = self._exec_mailq_command()
+            self._mailq_output = mailq_output
+        return mailq_output
 
     def _get_queue_size(self):
         if 'Mail queue is empty' in self.mailq_output:
@@ -1,4 +1,6 @@
+from collections import defaultdict
 import re
+import threading
 
 from sauna.plugins import PluginRegister
 from sauna.plugins.base import PsutilPlugin
@@ -6,12 +8,69 @@ from sauna.plugins.base import PsutilPlugin
 my_plugin = PluginRegister('Processes')
 
 
+class ProcessTable:
+    """Snapshot of the processes running on the system.
+
+    It is collected in a single pass over the process table and indexed
+    so that checks do not have to walk through all the processes.
+    """
+
+    def __init__(self, processes, attrs):
+        #: Set of psutil attributes fetched for each process
+        self.attrs = attrs
+        #: List of dicts of process attributes
+        self.processes = processes
+        #: Command lines of processes indexed by their executable
+        self.cmdlines_by_exec = defaultdict(list)
+        self.num_zombies = 0
+        for info in processes:
+            cmdline = info.get('cmdline')
+            # Zombies and processes of other users often have no cmdline
+            if cmdline:
+                self.cmdlines_by_exec[cmdline[0]].append(cmdline)
+            if info.get('status') == 'zombie':
+                self.num_zombies += 1
+
+
 @my_plugin.plugin()
 class Processes(PsutilPlugin):
 
+    cached_attributes = ('_process_table',)
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._process_table = None
+        # Attributes needed by the checks that ran so far
+        self._wanted_attrs = {'pid'}
+        self._process_table_lock = threading.Lock()
+        # Soft fd limits of processes indexed by pid, with the creation
+        # time of the process they were read from
+        self._fd_limits = {}
+
+    def _get_process_table(self, *attrs):
+        """Get the snapshot of the process table for the current run.
+
+        Only the attributes needed by the checks are fetched. The first
+        time a check needs new attributes the snapshot is collected again,
+        afterwards a single pass per run answers all checks.
+        """
+        with self._process_table_lock:
+            table = self._process_table
+            if table is not None and table.attrs.issuperset(attrs):
+                return table
+            self._wanted_attrs.update(attrs)
+            attrs = frozenset(self._wanted_attrs)
+            processes = [
+                p.info for p in self.psutil.process_iter(attrs=list(attrs))
+            ]
+            # Not read back from the attribute, it is reset without the lock
+            # when the next run starts
+            table = self._process_table = ProcessTable(processes, attrs)
+            return table
+
     @my_plugin.check()
     def count(self, check_config):
-        num_pids = len(self.psutil.pids())
+        num_pids = len(self._get_process_table().processes)
         return (
             self._value_to_status_less(num_pids, check_config),
             '{} processes'.format(num_pids)
@@ -19,9 +78,7 @@ class Processes(PsutilPlugin):
 
     @my_plugin.check()
     def zombies(self, check_config):
-        zombies = [p for p in self.psutil.process_iter()
-                   if p.status() == 'zombie']
-        num_zombies = len(zombies)
+        num_zombies = self._get_process_table('status').num_zombies
         return (
             self._value_to_status_less(num_zombies, check_config),
             '{} zombies'.format(num_zombies)
@@ -36,26 +93,11 @@ class Processes(PsutilPlugin):
         """
         process_exec = check_config['exec']
         required_args = check_config.get('args', '').split()
-        instances = 0
-
-        for process in self.psutil.process_iter():
-            try:
-                cmdline = process.cmdline()
-            except (self.psutil.NoSuchProcess, self.psutil.AccessDenied):
-                # Zombies and processes that stopped throw NoSuchProcess
-                continue
-
-            # Often cmdline in an empty list
-            if not cmdline:
-                continue
-
-            if cmdline[0] != process_exec:
-                continue
-
-            if self._required_args_are_in_cmdline(required_args, cmdline):
-                instances += 1
-
-        return instances
+        table = self._get_process_table('cmdline')
+        return sum(
+            1 for cmdline in table.cmdlines_by_exec.get(process_exec, ())
+            if self._required_args_are_in_cmdline(required_args, cmdline)
+        )
 
     @my_plugin.check()
     def running(self, check_config):
@@ -99,30 +141,94 @@ class Processes(PsutilPlugin):
     def _get_processes_exhausting_fds(self, check_config):
         processes_names = set()
         highest_percentage = 0
-        for process in self.psutil.process_iter():
+        table = self._get_process_table('name', 'num_fds', 'create_time')
+        fd_limits = self._get_fd_limits(table)
+        for info in table.processes:
+            open_fd = info['num_fds']
+            limit_fd = fd_limits.get(info['pid'])
+            if open_fd is None or not limit_fd:
+                # Access to the process was denied or it has no limit
+                continue
+            percentage = int(open_fd * 100 / limit_fd)
+            if (self._value_to_status_less(percentage, check_config) !=
+                    self.STATUS_OK):
+                processes_names.add(info['name'])
+            if percentage > highest_percentage:
+                highest_percentage = percentage
+        return processes_names, highest_percentage
+
+    def _get_fd_limits(self, table):
+        """Soft limit of usable fds of each process in the table.
+
+        Limits rarely change during the life of a process, they are only
+        read for processes that were not running during the previous run.
+        A process is identified by its pid and creation time as pids get
+        reused.
+
+        :returns: dict of limits indexed by pid
+        """
+        previous_limits = self._fd_limits
+        fd_limits = {}
+        for info in table.processes:
+            pid, create_time = info['pid'], info['create_time']
             try:
-                open_fd = process.num_fds()
-                limit_fd = self._get_process_fd_limit(process.pid)
-                percentage = int(open_fd * 100 / limit_fd)
-                if (self._value_to_status_less(percentage, check_config) !=
-                        self.STATUS_OK):
-                    processes_names.add(process.name())
-                if percentage > highest_percentage:
-                    highest_percentage = percentage
-            except (self.psutil.NoSuchProcess, self.psutil.AccessDenied,
-                    OSError):
+                cached_create_time, limit = previous_limits[pid]
+            except KeyError:
                 pass
-        return processes_names, highest_percentage
+            else:
+                if cached_create_time == create_time:
+                    fd_limits[pid] = (create_time, limit)
+                    continue
+            try:
+                limit = self._read_fd_limit(pid)
+            except (self.psutil.NoSuchProcess, OSError):
+                # The process stopped in the meantime
+                continue
+            except ValueError as e:
+                self.logger.debug(str(e))
+                continue
+            fd_limits[pid] = (create_time, limit)
+
+        # Only processes still running are kept in the cache
+        self._fd_limits = fd_limits
+        return {pid: limit for pid, (_, limit) in fd_limits.items()}
+
+    def _read_fd_limit(self, pid):
+        """Read the soft limit of usable fds for a process.
+
+        prlimit is used when available, it avoids parsing a text file.
+        :returns: the limit or None if the process has no limit
+        """
+        rlimit_nofile = getattr(self.psutil, 'RLIMIT_NOFILE', None)
+        if rlimit_nofile is not None:
+            try:
+                soft, _ = self.psutil.Process(pid).rlimit(rlimit_nofile)
+            except self.psutil.AccessDenied:
+                # Requires privileges for processes of other users
+                pass
+            else:
+                if soft == self.psutil.RLIM_INFINITY:
+                    return None
+                return soft
+        return self._get_process_fd_limit(pid)
 
     @classmethod
     def _get_process_fd_limit(cls, pid):
-        """Retrieve the soft limit of usable fds for a process."""
+        """Retrieve the soft limit of usable fds for a process.
+
+        :returns: the limit or None if the process has no limit
+        :raises ValueError: if the limits file cannot be parsed
+        """
         with open('/proc/{}/limits'.format(pid)) as f:
             limits = f.read()
-        match = re.search(r'^Max open files\s+(\d+)\s+\d+\s+files',
-                          limits, flags=re.MULTILINE)
+        match = re.search(
+            r'^Max open files\s+(\d+|unlimited)\s+(?:\d+|unlimited)\s+files',
+            limits, flags=re.MULTILINE
+        )
         if not match:
-            raise Exception('Cannot parse /proc/{}/limits'.format(pid))
+            raise ValueError('Cannot parse /proc/{}/limits'.format(pid))
+        if match.group(1) == 'unlimited':
+            return None
         return int(match.group(1))
 
     @classmethod
@@ -9,6 +9,8 @@ my_plugin = PluginRegister('PuppetAgent')
 @my_plugin.plugin()
 class PuppetAgent(Plugin):
 
+    cached_attributes = ('_last_run_summary',)
+
     def __init__(self, config):
         super().__init__(config)
         self.config = {
@@ -22,10 +24,11 @@ class PuppetAgent(Plugin):
     @property
     def last_run_summary(self):
         import yaml
-        if not self._last_run_summary:
+        last_run_summary = self._last_run_summary
+        if not last_run_summary:
             with open(self.config['summary_path']) as f:
-                self._last_run_summary = yaml.safe_load(f)
-        return self._last_run_summary
+                last_run_summary = self._last_run_summary = yaml.safe_load(f)
+        return last_run_summary
 
     @my_plugin.check()
     def last_run_delta(self, check_config):
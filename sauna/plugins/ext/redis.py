@@ -7,6 +7,8 @@ my_plugin = PluginRegister('Redis')
 @my_plugin.plugin()
 class Redis(Plugin):
 
+    cached_attributes = ('_redis_info',)
+
     def __init__(self, config):
         super().__init__(config)
         try:
@@ -38,10 +40,11 @@ class Redis(Plugin):
 
     @property
     def redis_info(self):
-        if not self._redis_info:
+        redis_info = self._redis_info
+        if not redis_info:
             r = self.redis.StrictRedis(**self.config)
-            self._redis_info = r.info()
-        return self._redis_info
+            redis_info = self._redis_info = r.info()
+        return redis_info
 
     @my_plugin.check()
     def llen(self, check_config):
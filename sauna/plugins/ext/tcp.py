@@ -1,4 +1,4 @@
-import socket
+import asyncio
 
 from sauna.plugins import (Plugin, PluginRegister)
 
@@ -9,15 +9,19 @@ my_plugin = PluginRegister('TCP')
 class Tcp(Plugin):
 
     @my_plugin.check()
-    def request(self, check_config):
+    async def request(self, check_config):
         try:
-            with socket.create_connection((check_config['host'],
-                                           check_config['port']),
-                                          timeout=check_config['timeout']):
-                pass
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(check_config['host'],
+                                        check_config['port']),
+                timeout=check_config['timeout']
+            )
+        except asyncio.TimeoutError:
+            return Plugin.STATUS_CRIT, "timed out"
         except Exception as e:
             return Plugin.STATUS_CRIT, "{}".format(e)
         else:
+            writer.close()
             return Plugin.STATUS_OK, "OK"
 
     @staticmethod
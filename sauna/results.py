@@ -0,0 +1,129 @@
+"""Store of the last result of each check.
+
+The producer publishes results, asynchronous consumers read them. Readers
+never take a lock: each change creates a new immutable snapshot of all the
+results, which replaces the current one in a single reference swap::
+
+    snapshot = result_store.snapshot()
+    for service_check in snapshot.results.values():
+        ...
+
+A snapshot also carries the number of checks in each status, so that the
+worst status is known without going through all the results.
+"""
+from collections import Counter
+import threading
+from types import MappingProxyType
+
+from sauna.plugins.base import Plugin
+
+# Statuses from the worst to the best, unknown is not taken into account
+# when computing the worst status
+_WORST_FIRST = (Plugin.STATUS_CRIT, Plugin.STATUS_WARN)
+
+
+class Snapshot:
+    """Results of all checks at a given version, never modified."""
+
+    __slots__ = ('version', 'statuses_version', 'results', 'status_counts')
+
+    def __init__(self, version, statuses_version, results, status_counts):
+        #: Incremented when any result changes
+        self.version = version
+        #: Incremented when the status of a check changes
+        self.statuses_version = statuses_version
+        #: Read-only mapping of check names to their last ServiceCheck
+        self.results = MappingProxyType(results)
+        #: Read-only mapping of statuses to their number of checks
+        self.status_counts = MappingProxyType(status_counts)
+
+    @property
+    def worst_status(self):
+        """Worst status of all checks, ignoring unknown ones."""
+        for status in _WORST_FIRST:
+            if self.status_counts.get(status):
+                return status
+        return Plugin.STATUS_OK
+
+
+class ResultStore:
+    """Last result of each check, published as immutable snapshots.
+
+    Writers serialize on a lock and copy the results before modifying
+    them. Readers get the current snapshot without locking and can wait
+    for a newer version.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._snapshot = Snapshot(0, 0, {}, {})
+
+    def snapshot(self):
+        """Get the current results."""
+        return self._snapshot
+
+    def _swap(self, results, status_counts, statuses_changed):
+        # Called with the lock held
+        current = self._snapshot
+        self._snapshot = Snapshot(
+            current.version + 1,
+            current.statuses_version + (1 if statuses_changed else 0),
+            results, status_counts
+        )
+        self._changed.notify_all()
+
+    def publish(self, service_check):
+        """Make a result the last one of its check.
+
+        A new snapshot is only created if the result differs from the
+        previous one.
+        """
+        with self._lock:
+            current = self._snapshot
+            previous = current.results.get(service_check.name)
+            if previous == service_check:
+                return
+            results = dict(current.results)
+            results[service_check.name] = service_check
+            status_counts = Counter(current.status_counts)
+            status_counts[service_check.status] += 1
+            if previous is not None:
+                status_counts[previous.status] -= 1
+            self._swap(results, +status_counts,
+                       previous is None or
+                       previous.status != service_check.status)
+
+    def remove(self, name):
+        """Forget the result of a check.
+
+        :returns: the last ServiceCheck of the check, None if there is none
+        """
+        with self._lock:
+            current = self._snapshot
+            previous = current.results.get(name)
+            if previous is None:
+                return None
+            results = dict(current.results)
+            del results[name]
+            status_counts = Counter(current.status_counts)
+            status_counts[previous.status] -= 1
+            self._swap(results, +status_counts, True)
+            return previous
+
+    def clear(self):
+        with self._lock:
+            if self._snapshot.results:
+                self._swap({}, {}, True)
+
+    def wait_for_change(self, version, timeout=None):
+        """Wait until the results are newer than a version.
+
+        :returns: the current snapshot, which may still be at `version`
+                  if the timeout expired
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._snapshot.version > version, timeout=timeout
+            )
+            return self._snapshot
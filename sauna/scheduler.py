@@ -1,57 +1,108 @@
-import time
+import hashlib
+import heapq
 import math
-from functools import reduce
+import time
 from logging import getLogger
 
 logger = getLogger(__name__)
 
 
+def splay_offset(key, window):
+    """Deterministic offset between 0 and window seconds for a key.
+
+    The same key always gets the same offset, even across restarts and
+    hosts, while different keys are spread uniformly over the window.
+    """
+    digest = hashlib.sha1(key.encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 * window
+
+
 class Scheduler:
 
-    def __init__(self, jobs):
+    #: Jobs due within this amount of seconds are run in the same batch,
+    #: it absorbs floating point errors on non-integer periodicities.
+    tolerance = 1e-6
+
+    def __init__(self, jobs, clock=time.monotonic):
         """
         Create a new Scheduler.
 
+        Each job has its own deadline, they are kept in a heap so that
+        finding the next jobs to run does not depend on the number of jobs.
+
         >>> s = Scheduler([Job(1, max, 100, 200)])
-        >>> for jobs in s:
-        ...    time.sleep(s.tick_duration)
+        >>> while True:
+        ...    time.sleep(s.time_until_next_run())
+        ...    jobs = next(s)
 
         :param jobs: Sequence of jobs to schedule
+        :param clock: Function returning the current time in seconds
         """
-        periodicities = {job.periodicity for job in jobs}
-        self.tick_duration = reduce(lambda x, y: math.gcd(x, y),
-                                    periodicities)
-        self._ticks = self.find_minimum_ticks_required(self.tick_duration,
-                                                       periodicities)
+        for job in jobs:
+            if job.periodicity <= 0:
+                raise ValueError('Job periodicity must be positive')
+        self._clock = clock
         self._jobs = jobs
-        self._current_tick = 0
-        logger.debug('Scheduler has {} ticks, each one is {} seconds'.
-                     format(self._ticks, self.tick_duration))
-
-    @staticmethod
-    def find_minimum_ticks_required(tick_duration, periodicities):
-        """Find the minimum number of ticks required to execute all jobs
-        at once."""
-        ticks = 1
-        for periodicity in reversed(sorted(periodicities)):
-            if ticks % periodicity != 0:
-                ticks *= int(periodicity / tick_duration)
-        return ticks
+        self._start = clock()
+        # Heap of [deadline, job index, number of runs, job]
+        self._queue = [[self._start + job.offset, index, 0, job]
+                       for index, job in enumerate(jobs)]
+        heapq.heapify(self._queue)
+        logger.debug('Scheduler has {} jobs'.format(len(jobs)))
+
+    @property
+    def next_deadline(self):
+        """Time at which the next jobs should run."""
+        return self._queue[0][0]
+
+    def time_until_next_run(self):
+        """Seconds to wait before the next jobs are due."""
+        return max(0, self.next_deadline - self._clock())
+
+    def _reschedule(self, entry, now):
+        """Compute the next deadline of a job that just ran.
+
+        Deadlines are always computed from the start of the scheduler to
+        prevent drifting. A job that missed some of its deadlines, because
+        the process was stalled, only runs once and then catches up with
+        its original schedule.
+        """
+        _, index, runs, job = entry
+        next_runs = runs + 1
+        elapsed_runs = math.floor(
+            (now - self._start - job.offset) / job.periodicity
+        ) + 1
+        if elapsed_runs > next_runs:
+            logger.warning('{} missed {} runs'.format(
+                job, elapsed_runs - next_runs
+            ))
+            next_runs = elapsed_runs
+        deadline = self._start + job.offset + next_runs * job.periodicity
+        heapq.heappush(self._queue, [deadline, index, next_runs, job])
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        jobs = [job for job in self._jobs
-                if ((self._current_tick * self.tick_duration)
-                    % job.periodicity) == 0
-                ]
-        if jobs:
-            logger.debug('Tick {}, scheduled {}'.
-                         format(self._current_tick, jobs))
-        self._current_tick += 1
-        if self._current_tick >= self._ticks:
-            self._current_tick = 0
+        """Run the next jobs.
+
+        Jobs that are due are run, if none of them is, the jobs with the
+        earliest deadline are run without waiting. Callers wait for
+        :py:meth:`time_until_next_run` before each call, including the
+        first one as jobs may have an offset.
+        """
+        if not self._queue:
+            raise StopIteration
+        now = self._clock()
+        due = max(now, self.next_deadline) + self.tolerance
+        entries = []
+        while self._queue and self._queue[0][0] <= due:
+            entries.append(heapq.heappop(self._queue))
+        entries.sort(key=lambda entry: entry[1])
+        jobs = [entry[3] for entry in entries]
+        logger.debug('Scheduled {}'.format(jobs))
+        for entry in entries:
+            self._reschedule(entry, now)
         for job in jobs:
             job()
         return jobs
@@ -65,8 +116,9 @@ class Scheduler:
         1470146095.0748773
         1470146096.076028
         """
-        for _ in self:
-            time.sleep(self.tick_duration)
+        while self._queue:
+            time.sleep(self.time_until_next_run())
+            next(self)
 
 
 class Job:
@@ -75,7 +127,8 @@ class Job:
         """
         Create a new Job to be scheduled and run periodically.
 
-        :param periodicity: Number of seconds to wait between job runs
+        :param periodicity: Number of seconds to wait between job runs, it
+                            can be a float
         :param func: callable that perform the job action
         :param func_args: arguments of the callable
         :param func_kwargs: keyword arguments of the callable
@@ -86,6 +139,9 @@ class Job:
         self.func = func
         self.func_args = func_args
         self.func_kwargs = func_kwargs
+        #: Seconds to wait after the start of the scheduler before the
+        #: first run of the job
+        self.offset = 0
 
     def __repr__(self):
         try:
@@ -39,7 +39,7 @@ setup(
 
     keywords='monitoring health checks nagios shinken',
 
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
 
     install_requires=[
         'docopt',
@@ -53,7 +53,12 @@ setup(
             'requests-mock',
             'pymdstat',
             'jsonpath_rw',
-            'psutil'
+            'psutil>=5.3',
+            'paho-mqtt>=1.6'
+        ],
+        'benchmarks': [
+            'pytest',
+            'pytest-benchmark',
         ],
     },
 
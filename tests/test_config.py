@@ -267,3 +267,141 @@ class ConfigTest(unittest.TestCase):
         }
         sauna = Sauna(config=original)
         self.assertIsNone(sauna._thread_pool)
+
+    def test_check_registry_is_compiled_once(self):
+        original = {
+            'periodicity': 60,
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [
+                    {'type': 'dummy', 'name': 'foo'},
+                    {'type': 'dummy', 'name': 'bar', 'periodicity': 10}
+                ]
+            }]
+        }
+        sauna = Sauna(config=original)
+        with mock.patch.object(sauna, 'get_all_active_checks',
+                               wraps=sauna.get_all_active_checks) as m:
+            registry = sauna.check_registry
+            self.assertIs(registry, sauna.check_registry)
+            sauna.launch_and_publish_checks_with_periodicity(60)
+            sauna.launch_and_publish_checks_with_periodicity(10)
+            self.assertEqual(m.call_count, 1)
+        foo, bar = registry.checks
+        self.assertIs(foo.plugin, bar.plugin)
+        self.assertSetEqual(registry.periodicities, {10, 60})
+
+    def test_duplicate_check_names(self):
+        original = {
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [{'type': 'dummy'}, {'type': 'dummy'}]
+            }]
+        }
+        sauna = Sauna(config=original)
+        with mock.patch('builtins.print'):
+            with self.assertRaises(SystemExit):
+                sauna.compile_checks()
+
+    def test_check_splay(self):
+        original = {
+            'hostname': 'node-1',
+            'periodicity': 60,
+            'splay': 30,
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [
+                    {'type': 'dummy', 'name': 'foo'},
+                    {'type': 'dummy', 'name': 'bar', 'splay': True},
+                    {'type': 'dummy', 'name': 'baz', 'splay': 0},
+                    {'type': 'dummy', 'name': 'qux', 'periodicity': 10}
+                ]
+            }]
+        }
+        sauna = Sauna(config=original)
+        foo, bar, baz, qux = sauna.check_registry.checks
+        self.assertGreater(foo.offset, 0)
+        self.assertLess(foo.offset, 30)
+        self.assertEqual(foo.offset,
+                         sauna.get_check_offset('foo', 60, 30))
+        self.assertGreater(bar.offset, 0)
+        self.assertLess(bar.offset, 60)
+        self.assertEqual(baz.offset, 0)
+        self.assertLess(qux.offset, 10)
+        self.assertEqual(len(sauna.check_registry.schedules), 4)
+        self.assertNotEqual(sauna.get_check_offset('foo', 60, 30),
+                            sauna.get_check_offset('bar', 60, 30))
+
+    def test_splayed_check_waits_for_offset(self):
+        sauna = Sauna(config={
+            'hostname': 'node-1',
+            'periodicity': 60,
+            'splay': 60,
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [{'type': 'dummy', 'name': 'foo'}]
+            }]
+        })
+        self.assertGreater(sauna.check_registry.checks[0].offset, 1)
+        with mock.patch.object(sauna, 'launch_and_publish_checks') as m:
+            sauna.must_stop.wait = mock.Mock(side_effect=[False, True])
+            sauna.run_producer()
+        first_wait = sauna.must_stop.wait.call_args_list[0]
+        self.assertGreater(first_wait[1]['timeout'], 1)
+        self.assertEqual(m.call_count, 1)
+
+    def test_blocking_queue_needs_serial_checks(self):
+        from sauna.consumers.queues import BoundedQueue
+        plugins = [{'type': 'Dummy', 'checks': [{'type': 'dummy'}]}]
+        blocking = BoundedQueue(10, 'block')
+
+        sauna = Sauna(config={'plugins': plugins})
+        sauna._validate_consumer_queue(blocking)
+        sauna._validate_consumer_queue(BoundedQueue(10, 'drop_oldest'))
+
+        sauna = Sauna(config={'concurrency': 2, 'plugins': plugins})
+        self.addCleanup(sauna._thread_pool.shutdown)
+        with self.assertRaises(ValueError):
+            sauna._validate_consumer_queue(blocking)
+
+    def test_process_executor_unsupported(self):
+        from sauna.executors import ProcessExecutor
+        sauna = Sauna(config={
+            'plugins': [{
+                'type': 'Dummy',
+                'executor': 'process',
+                'checks': [{'type': 'dummy', 'name': 'foo'}]
+            }]
+        })
+        with mock.patch.object(ProcessExecutor, 'supported', False):
+            with mock.patch('builtins.print') as print_mock:
+                with self.assertRaises(SystemExit):
+                    sauna.compile_checks()
+        self.assertIn('Python 3.7', print_mock.call_args[0][0])
+
+    def test_no_splay(self):
+        sauna = Sauna(config={'hostname': 'node-1'})
+        self.assertEqual(sauna.get_check_offset('foo', 60, 0), 0)
+
+    def test_check_timeout(self):
+        original = {
+            'periodicity': 60,
+            'check_timeout': 20,
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [
+                    {'type': 'dummy', 'name': 'foo'},
+                    {'type': 'dummy', 'name': 'bar', 'check_timeout': 5},
+                    {'type': 'dummy', 'name': 'baz', 'check_timeout': None}
+                ]
+            }]
+        }
+        foo, bar, baz = Sauna(config=original).check_registry.checks
+        self.assertEqual(foo.timeout, 20)
+        self.assertEqual(bar.timeout, 5)
+        self.assertIsNone(baz.timeout)
+
+        # Checks have their periodicity to complete by default
+        del original['check_timeout']
+        foo, _, _ = Sauna(config=original).check_registry.checks
+        self.assertEqual(foo.timeout, 60)
@@ -1,17 +1,31 @@
+import binascii
+import errno
+import gzip
+import http.client as http_client
+import json
 import unittest
 import threading
 import socket
+import struct
 import os
+import queue
+import tempfile
+import time
 try:
     from unittest import mock
 except ImportError:
     # Python 3.2 does not have mock in the standard library
     import mock
 
-from sauna import Sauna, ServiceCheck
-from sauna.consumers import base, ConsumerRegister
-from sauna.consumers.ext import nsca
+from sauna import Sauna, ServiceCheck, metrics
+from sauna.results import ResultStore
+from sauna.consumers import (base, ConsumerRegister, receivers, queues,
+                             retry, spool)
+from sauna.consumers.ext import (nsca, http, http_icinga,
+                                 home_assistant_mqtt, tcp_server,
+                                 http_server)
 from sauna.consumers.ext.http_server.html import get_check_html
+import requests_mock
 
 
 class DumbConsumer(base.QueuedConsumer):
@@ -27,7 +41,7 @@ class DumbConsumer(base.QueuedConsumer):
             raise RuntimeError('Send check failed')
         self.last_service_check = service_check
 
-    def _wait_before_retry(self, must_stop):
+    def _wait_before_retry(self, must_stop, retry_count=1):
         pass
 
 
@@ -82,28 +96,87 @@ class ConsumersTest(unittest.TestCase):
         self.assertIs(s, dumb_consumer.last_service_check)
         self.assertEqual(2, dumb_consumer.times_called)
 
+    @mock.patch('sauna.consumers.base.time')
+    def test_consumer_retry_unsent_checks(self, time_mock):
+        time_mock.time.return_value = 1461363313
+        must_stop = threading.Event()
+        checks = [
+            ServiceCheck(timestamp=1461363313, hostname='node-1.domain.tld',
+                         name=name, status=0, output='Check okay')
+            for name in ('foo', 'bar')
+        ]
+        dumb_consumer = DumbConsumer({})
+        sent = []
+
+        def send(service_check):
+            if service_check.name == 'bar' and not dumb_consumer.fail_next:
+                dumb_consumer.fail_next = True
+                raise RuntimeError('Send check failed')
+            sent.append(service_check.name)
+
+        dumb_consumer._send = send
+        dumb_consumer.try_send(list(checks), must_stop)
+        self.assertListEqual(sent, ['foo', 'bar'])
+
     def test_wait_before_retry(self):
         must_stop = mock.Mock()
         stdout_consumer = (
             ConsumerRegister.get_consumer('Stdout')['consumer_cls']({})
         )
-        stdout_consumer._wait_before_retry(must_stop)
+        stdout_consumer.retry_policy._random = lambda: 0.5
+        stdout_consumer._wait_before_retry(must_stop, 3)
         must_stop.wait.assert_called_once_with(
-            timeout=stdout_consumer.retry_delay
+            timeout=stdout_consumer.retry_delay * 2
+        )
+
+    @mock.patch('sauna.consumers.base.time')
+    def test_circuit_breaker(self, time_mock):
+        time_mock.time.return_value = 1461363313
+        must_stop = threading.Event()
+        s = ServiceCheck(timestamp=1461363313, hostname='node-1.domain.tld',
+                         name='dumb_check', status=0, output='Check okay')
+        dumb_consumer = DumbConsumer({'max_retry': 2, 'breaker_threshold': 2,
+                                      'breaker_reset_timeout': 30})
+        dumb_consumer._send = mock.Mock(side_effect=RuntimeError('Down'))
+        dumb_consumer.try_send([s], must_stop)
+        self.assertEqual(dumb_consumer._send.call_count, 2)
+        self.assertEqual(dumb_consumer.circuit_breaker.state, 'open')
+
+        # The receiver is not tried again until the breaker lets a probe
+        # through
+        def wait_for_breaker(must_stop):
+            dumb_consumer.circuit_breaker._opened_at -= 30
+
+        dumb_consumer._wait_for_circuit_breaker = mock.Mock(
+            side_effect=wait_for_breaker
+        )
+        dumb_consumer._send = mock.Mock()
+        dumb_consumer.try_send([s], must_stop)
+        dumb_consumer._wait_for_circuit_breaker.assert_called_once_with(
+            must_stop
         )
+        dumb_consumer._send.assert_called_once_with(s)
+        self.assertEqual(dumb_consumer.circuit_breaker.state, 'closed')
+
+    @staticmethod
+    def result_store(*service_checks):
+        store = ResultStore()
+        for service_check in service_checks:
+            store.publish(service_check)
+        return mock.patch('sauna.result_store', store)
 
     def test_get_current_status(self):
         foo = ServiceCheck(timestamp=42, hostname='server1',
                            name='foo', status=0, output='foo out')
         bar = ServiceCheck(timestamp=42, hostname='server1',
                            name='bar', status=1, output='bar out')
-        with mock.patch.dict('sauna.check_results'):
+        with self.result_store():
             self.assertEqual(base.AsyncConsumer.get_current_status(),
                              ('OK', 0))
-        with mock.patch.dict('sauna.check_results', foo=foo):
+        with self.result_store(foo):
             self.assertEqual(base.AsyncConsumer.get_current_status(),
                              ('OK', 0))
-        with mock.patch.dict('sauna.check_results', foo=foo, bar=bar):
+        with self.result_store(foo, bar):
             self.assertEqual(base.AsyncConsumer.get_current_status(),
                              ('WARNING', 1))
 
@@ -112,7 +185,7 @@ class ConsumersTest(unittest.TestCase):
                            name='foo', status=0, output='foo out')
         bar = ServiceCheck(timestamp=42, hostname='server1',
                            name='bar', status=1, output='bar out')
-        with mock.patch.dict('sauna.check_results', foo=foo, bar=bar):
+        with self.result_store(foo, bar):
             self.assertDictEqual(base.AsyncConsumer.get_checks_as_dict(), {
                 'foo': {
                     'status': 'OK',
@@ -128,11 +201,486 @@ class ConsumersTest(unittest.TestCase):
                 }
             })
 
+    def test_cached_status(self):
+        sauna = Sauna()
+        sauna._consumers_queues = []
+        foo = ServiceCheck(timestamp=42, hostname='server1',
+                           name='foo', status=0, output='foo out')
+        with self.result_store():
+            sauna._publish(foo)
+            line = base.AsyncConsumer.get_status_line()
+            self.assertEqual(line, b'OK\n')
+            data = base.AsyncConsumer.get_checks_json()
+            self.assertEqual(json.loads(data.decode())['checks']['foo'],
+                             {'status': 'OK', 'code': 0, 'timestamp': 42,
+                              'output': 'foo out'})
+
+            # Same status, only the JSON document is built again
+            sauna._publish(foo._replace(timestamp=43))
+            self.assertIs(base.AsyncConsumer.get_status_line(), line)
+            new_data = base.AsyncConsumer.get_checks_json()
+            self.assertIsNot(new_data, data)
+            self.assertIs(base.AsyncConsumer.get_checks_json(), new_data)
+
+            sauna._publish(foo._replace(status=2))
+            self.assertEqual(base.AsyncConsumer.get_status_line(),
+                             b'CRITICAL\n')
+            self.assertEqual(
+                json.loads(base.AsyncConsumer.get_checks_json().decode())
+                ['code'], 2
+            )
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_exponential_backoff(self):
+        policy = retry.RetryPolicy(base_delay=10, max_delay=300,
+                                   jitter=False)
+        self.assertListEqual([policy.delay(n) for n in range(1, 7)],
+                             [10, 20, 40, 80, 160, 300])
+        self.assertEqual(policy.delay(10000), 300)
+
+    def test_full_jitter(self):
+        policy = retry.RetryPolicy(base_delay=10, max_delay=300,
+                                   random=lambda: 0.25)
+        self.assertEqual(policy.delay(1), 2.5)
+        self.assertEqual(policy.delay(3), 10)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.breaker = retry.CircuitBreaker(
+            failure_threshold=3, reset_timeout=60, name='Breaker',
+            clock=lambda: self.now
+        )
+
+    def test_opens_after_failures(self):
+        before = retry.breaker_opened.get(consumer='Breaker')
+        for _ in range(2):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.remaining(), 60)
+        self.assertEqual(retry.breaker_opened.get(consumer='Breaker'),
+                         before + 1)
+        self.assertEqual(retry.breaker_state.get(consumer='Breaker'), 2)
+
+    def test_half_open_probe(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 60
+        self.assertEqual(self.breaker.remaining(), 0)
+        # A single probe is let through
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.assertFalse(self.breaker.allow())
+
+        # A failed probe opens the breaker again
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.now += 60
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(retry.breaker_state.get(consumer='Breaker'), 0)
+        self.assertTrue(self.breaker.allow())
+
+    def test_disabled(self):
+        breaker = retry.CircuitBreaker(failure_threshold=0)
+        for _ in range(10):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test',
+                                      buckets=(0.1, 1))
+        histogram.observe(0.05, check='foo')
+        histogram.observe(1, check='foo')
+        histogram.observe(5, check='foo')
+        self.assertEqual(histogram.get(check='foo'), (3, 6.05))
+        self.assertListEqual(histogram.samples(), [
+            ('test_seconds_bucket', {'check': 'foo', 'le': '0.1'}, 1),
+            ('test_seconds_bucket', {'check': 'foo', 'le': '1'}, 2),
+            ('test_seconds_bucket', {'check': 'foo', 'le': '+Inf'}, 3),
+            ('test_seconds_sum', {'check': 'foo'}, 6.05),
+            ('test_seconds_count', {'check': 'foo'}, 3)
+        ])
+
+    def test_gauge_function(self):
+        gauge = metrics.Gauge('test_depth', 'Test')
+        q = queue.Queue()
+        gauge.set_function(q.qsize, consumer='Test')
+        q.put(1)
+        self.assertEqual(gauge.get(consumer='Test'), 1)
+        self.assertListEqual(gauge.items(), [({'consumer': 'Test'}, 1)])
+
+    def test_format_sample(self):
+        self.assertEqual(
+            metrics.format_sample('sauna_check_status',
+                                  {'check': 'a"b\\c\nd'}, 2),
+            'sauna_check_status{check="a\\"b\\\\c\\nd"} 2\n'
+        )
+        self.assertEqual(metrics.format_sample('foo', {}, 1.0), 'foo 1\n')
+
+    def test_consumer_instrumentation(self):
+        must_stop = threading.Event()
+        consumer = DumbConsumer({})
+        q = queue.Queue()
+        q.put(ServiceCheck(timestamp=int(time.time()), hostname='server1',
+                           name='foo', status=0, output='OK'))
+        count, _ = base.send_durations.get(consumer='DumbConsumer')
+
+        def send(service_check):
+            must_stop.set()
+
+        consumer._send = send
+        consumer.run(must_stop, q)
+        self.assertEqual(base.send_durations.get(consumer='DumbConsumer')[0],
+                         count + 1)
+        self.assertEqual(base.queue_depth.get(consumer='DumbConsumer'), 0)
+        self.assertIn('sauna_consumer_queue_depth{consumer="DumbConsumer"} 0',
+                      metrics.render())
+
+
+class BoundedQueueTest(unittest.TestCase):
+
+    @staticmethod
+    def check(name, output='OK'):
+        return ServiceCheck(timestamp=42, hostname='server1', name=name,
+                            status=0, output=output)
+
+    def drain(self, q):
+        items = []
+        while not q.empty():
+            item = q.get_nowait()
+            items.append(item if isinstance(item, threading.Event)
+                         else (item.name, item.output))
+        return items
+
+    def test_create_queue(self):
+        consumer = DumbConsumer({})
+        self.assertNotIsInstance(consumer.create_queue(),
+                                 queues.BoundedQueue)
+        consumer = DumbConsumer({'max_queue_size': 10,
+                                 'queue_overflow': 'coalesce'})
+        q = consumer.create_queue()
+        self.assertIsInstance(q, queues.BoundedQueue)
+        self.assertEqual(q.policy, 'coalesce')
+        with self.assertRaises(ValueError):
+            DumbConsumer({'max_queue_size': 10,
+                          'queue_overflow': 'foo'}).create_queue()
+
+    def test_drop_oldest(self):
+        q = queues.BoundedQueue(2, 'drop_oldest', name='DropOldest')
+        before = queues.dropped_checks.get(consumer='DropOldest')
+        for name in ('foo', 'bar', 'baz'):
+            q.put(self.check(name))
+        self.assertListEqual(self.drain(q), [('bar', 'OK'), ('baz', 'OK')])
+        self.assertEqual(queues.dropped_checks.get(consumer='DropOldest'),
+                         before + 1)
+
+    def test_drop_newest(self):
+        q = queues.BoundedQueue(2, 'drop_newest')
+        for name in ('foo', 'bar', 'baz'):
+            q.put(self.check(name))
+        self.assertListEqual(self.drain(q), [('foo', 'OK'), ('bar', 'OK')])
+
+    def test_coalesce(self):
+        q = queues.BoundedQueue(2, 'coalesce', name='Coalesce')
+        before = queues.coalesced_checks.get(consumer='Coalesce')
+        q.put(self.check('foo', 'first'))
+        q.put(self.check('bar', 'first'))
+        q.put(self.check('foo', 'second'))
+        self.assertEqual(queues.coalesced_checks.get(consumer='Coalesce'),
+                         before + 1)
+        # Without a result to replace, the oldest check is dropped
+        q.put(self.check('baz', 'first'))
+        self.assertListEqual(self.drain(q),
+                             [('bar', 'first'), ('baz', 'first')])
+
+    def test_events_bypass_bound(self):
+        q = queues.BoundedQueue(1, 'drop_newest')
+        must_stop = threading.Event()
+        q.put(self.check('foo'))
+        q.put(must_stop)
+        q.put(self.check('bar'))
+        self.assertListEqual(self.drain(q), [('foo', 'OK'), must_stop])
+
+    def test_block(self):
+        q = queues.BoundedQueue(1, 'block')
+        q.put(self.check('foo'))
+        producer = threading.Thread(target=q.put, args=(self.check('bar'),))
+        producer.start()
+        producer.join(0.05)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(q.get().name, 'foo')
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(q.get().name, 'bar')
+
+        # Stopping the consumer releases blocked producers
+        q.put(self.check('foo'))
+        producer = threading.Thread(target=q.put, args=(self.check('bar'),))
+        producer.start()
+        must_stop = threading.Event()
+        q.put(must_stop)
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertListEqual(self.drain(q), [('foo', 'OK'), must_stop])
+
+
+class CoalescingQueueTest(unittest.TestCase):
+
+    @staticmethod
+    def check(name, status=0, output='OK'):
+        return ServiceCheck(timestamp=42, hostname='server1', name=name,
+                            status=status, output=output)
+
+    def drain(self, q):
+        items = []
+        while not q.empty():
+            item = q.get_nowait()
+            items.append(item if isinstance(item, threading.Event)
+                         else (item.name, item.status, item.output))
+        return items
+
+    def test_create_queue(self):
+        q = DumbConsumer({'coalesce': True}).create_queue()
+        self.assertIsInstance(q, queues.CoalescingQueue)
+        self.assertTrue(q.deliver_transitions)
+        q = DumbConsumer({'coalesce': True,
+                          'deliver_transitions': False}).create_queue()
+        self.assertFalse(q.deliver_transitions)
+
+    def test_latest_result(self):
+        q = queues.CoalescingQueue(deliver_transitions=False,
+                                   name='Coalescing')
+        before = queues.coalesced_checks.get(consumer='Coalescing')
+        q.put(self.check('foo', output='first'))
+        q.put(self.check('bar'))
+        q.put(self.check('foo', status=2, output='second'))
+        q.put(self.check('foo', output='third'))
+        self.assertEqual(q.qsize(), 2)
+        self.assertListEqual(self.drain(q), [('foo', 0, 'third'),
+                                             ('bar', 0, 'OK')])
+        self.assertEqual(queues.coalesced_checks.get(consumer='Coalescing'),
+                         before + 2)
+        self.assertEqual(q.unfinished_tasks, 2)
+
+    def test_deliver_transitions(self):
+        q = queues.CoalescingQueue()
+        q.put(self.check('foo', output='first'))
+        q.put(self.check('foo', output='second'))
+        q.put(self.check('foo', status=2, output='third'))
+        q.put(self.check('bar'))
+        q.put(self.check('foo', status=2, output='fourth'))
+        self.assertEqual(q.qsize(), 3)
+        self.assertListEqual(self.drain(q), [('foo', 0, 'second'),
+                                             ('foo', 2, 'fourth'),
+                                             ('bar', 0, 'OK')])
+
+    def test_max_queue_size(self):
+        q = DumbConsumer({'coalesce': True,
+                          'max_queue_size': 3}).create_queue()
+        self.assertEqual(q.max_queue_size, 3)
+        q.name = 'CoalescingMax'
+        # A flapping check adds a result per run
+        for i in range(5):
+            q.put(self.check('foo', status=i % 2, output=str(i)))
+        q.put(self.check('bar'))
+        self.assertEqual(q.qsize(), 3)
+        self.assertEqual(q.unfinished_tasks, 3)
+        self.assertEqual(queues.dropped_checks.get(consumer='CoalescingMax'),
+                         3)
+        self.assertListEqual(self.drain(q), [('foo', 1, '3'),
+                                             ('foo', 0, '4'),
+                                             ('bar', 0, 'OK')])
+
+    def test_events_not_coalesced(self):
+        q = queues.CoalescingQueue()
+        must_stop = threading.Event()
+        q.put(self.check('foo'))
+        q.put(must_stop)
+        q.put(self.check('foo', output='newer'))
+        self.assertListEqual(self.drain(q), [('foo', 0, 'newer'),
+                                             must_stop])
+
+
+class SpoolQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.directory = os.path.join(self.tmp_dir.name, 'spool')
+
+    @staticmethod
+    def check(name, output='OK'):
+        return ServiceCheck(timestamp=42, hostname='server1', name=name,
+                            status=2, output=output)
+
+    def spool(self, **kwargs):
+        q = spool.SpoolQueue(self.directory, **kwargs)
+        self.addCleanup(q.close)
+        return q
+
+    def segments(self):
+        return sorted(f for f in os.listdir(self.directory)
+                      if f.endswith('.spool'))
+
+    def test_create_queue(self):
+        q = DumbConsumer({'spool': {'directory': self.directory,
+                                    'max_age': 3600}}).create_queue()
+        self.addCleanup(q.close)
+        self.assertIsInstance(q, spool.SpoolQueue)
+        self.assertEqual(q.max_age, 3600)
+        with self.assertRaises(ValueError):
+            DumbConsumer({'spool': {'max_age': 60}}).create_queue()
+
+    def test_record(self):
+        check = ServiceCheck(timestamp=1500000000, hostname='server1',
+                             name='load', status=1, output='Load é 3')
+        record = spool.encode_record(check)
+        self.assertEqual(spool.decode_payload(record[8:]), check)
+
+    def test_negative_status(self):
+        # Commands killed by a signal have a negative return code
+        check = ServiceCheck(timestamp=1500000000, hostname='server1',
+                             name='killed', status=-9, output='')
+        q = self.spool()
+        q.put(check)
+        self.assertEqual(q.get_nowait(), check)
+
+    def test_write_error_drops_check(self):
+        q = self.spool(name='SpoolWriteError')
+        q.put(self.check('foo'))
+        with mock.patch.object(q._writer, 'write',
+                               side_effect=OSError('No space left')):
+            q.put(self.check('bar'))
+        q.put(ServiceCheck(timestamp=42, hostname='server1', name='baz',
+                           status=70000, output=''))
+        q.put(self.check('qux'))
+        self.assertEqual(
+            queues.dropped_checks.get(consumer='SpoolWriteError'), 2
+        )
+        self.assertEqual(q.unfinished_tasks, 2)
+        self.assertListEqual([q.get_nowait().name for _ in range(2)],
+                             ['foo', 'qux'])
+        self.assertTrue(q.empty())
+
+    def test_fifo(self):
+        q = self.spool()
+        for name in ('foo', 'bar', 'baz'):
+            q.put(self.check(name))
+        self.assertEqual(q.qsize(), 3)
+        self.assertListEqual([q.get_nowait().name for _ in range(3)],
+                             ['foo', 'bar', 'baz'])
+        self.assertTrue(q.empty())
+
+    def test_replay_from_checkpoint(self):
+        q = self.spool(fsync_interval=0)
+        for name in ('foo', 'bar', 'baz'):
+            q.put(self.check(name))
+        q.get_nowait()
+        q.task_done()
+        # Read but not acknowledged, processed again after a restart
+        q.get_nowait()
+        q.close()
+
+        q = self.spool()
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.get_nowait().name, 'bar')
+        q.put(self.check('qux'))
+        self.assertListEqual([q.get_nowait().name for _ in range(2)],
+                             ['baz', 'qux'])
+
+    def test_truncated_record_ignored(self):
+        q = self.spool()
+        q.put(self.check('foo'))
+        q.put(self.check('bar'))
+        q.close()
+        path = os.path.join(self.directory, self.segments()[-1])
+        os.truncate(path, os.path.getsize(path) - 1)
+
+        q = self.spool()
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.get_nowait().name, 'foo')
+        # New checks are not appended after the corrupted record
+        q.put(self.check('baz'))
+        self.assertEqual(q.get_nowait().name, 'baz')
+
+    def test_processed_segments_removed(self):
+        record_size = len(spool.encode_record(self.check('foo')))
+        q = self.spool(segment_size=record_size * 2, fsync_interval=0)
+        for name in ('foo', 'bar', 'baz', 'qux', 'quux'):
+            q.put(self.check(name))
+        self.assertEqual(len(self.segments()), 3)
+        for _ in range(3):
+            q.get_nowait()
+            q.task_done()
+        self.assertEqual(len(self.segments()), 2)
+
+    def test_max_size(self):
+        record_size = len(spool.encode_record(self.check('foo')))
+        q = self.spool(segment_size=record_size * 2,
+                       max_size=record_size * 4, name='SpoolMaxSize')
+        for name in ('foo', 'bar', 'baz', 'qux', 'quux'):
+            q.put(self.check(name))
+        self.assertEqual(q.qsize(), 3)
+        self.assertEqual(queues.dropped_checks.get(consumer='SpoolMaxSize'),
+                         2)
+        self.assertListEqual([q.get_nowait().name for _ in range(3)],
+                             ['baz', 'qux', 'quux'])
+
+    def test_max_age(self):
+        record_size = len(spool.encode_record(self.check('foo')))
+        q = self.spool(segment_size=record_size, max_age=60)
+        q.put(self.check('foo'))
+        with mock.patch('sauna.consumers.spool.time.time',
+                        return_value=time.time() + 120):
+            q.put(self.check('bar'))
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.get_nowait().name, 'bar')
+
+    def test_events_first(self):
+        q = self.spool()
+        must_stop = threading.Event()
+        q.put(self.check('foo'))
+        q.put(must_stop)
+        self.assertIs(q.get_nowait(), must_stop)
+        self.assertEqual(q.get_nowait().name, 'foo')
+
+    def test_consumer_keeps_unsent_checks(self):
+        consumer = DumbConsumer({'spool': {'directory': self.directory}})
+        q = consumer.create_queue()
+        q.put(self.check('foo')._replace(timestamp=int(time.time())))
+        must_stop = threading.Event()
+
+        def send(service_check):
+            # Sauna is stopped while the receiver is down
+            must_stop.set()
+            raise RuntimeError('Down')
+
+        with mock.patch.object(consumer, '_send', side_effect=send):
+            consumer.run(must_stop, q)
+        q.close()
+
+        q = self.spool()
+        self.assertEqual(q.get_nowait().name, 'foo')
+
 
 class ConsumerNSCATest(unittest.TestCase):
 
     def setUp(self):
         self.nsca = nsca.NSCAConsumer({})
+        self.nsca._dns_cache = receivers.DNSCache()
 
     def test_encrypt_xor(self):
         encrypt_xor = nsca.encrypt_xor
@@ -151,6 +699,32 @@ class ConsumerNSCATest(unittest.TestCase):
         key = bytes.fromhex('E1D0')
         self.assertEqual(encrypt_xor(data, iv, key), bytes.fromhex('12F2'))
 
+        # An empty key leaves the data XORed with the IV only
+        data = bytes.fromhex('7DE8')
+        iv = bytes.fromhex('8ECA')
+        self.assertEqual(encrypt_xor(data, iv, b''), bytes.fromhex('F322'))
+
+    def test_encode_service_payload(self):
+        def reference_payload(service_check):
+            payload = [3, 0, 0, service_check.timestamp, service_check.status,
+                       service_check.hostname.encode(),
+                       service_check.name.encode(),
+                       service_check.output.encode(), 0]
+            payload[2] = binascii.crc32(
+                struct.pack(self.nsca.service_payload_fmt, *payload)
+            )
+            return struct.pack(self.nsca.service_payload_fmt, *payload)
+
+        # Payloads built from the same template do not share their output
+        for output in ('long output' * 10, 'short', '', 'x' * 5000):
+            service_check = ServiceCheck(timestamp=42, hostname='server1',
+                                         name='foo', status=2, output=output)
+            self.assertEqual(
+                self.nsca._encode_service_payload(service_check),
+                reference_payload(service_check)
+            )
+        self.assertEqual(len(self.nsca._payload_templates), 1)
+
     def test_no_encryption(self):
         self.nsca.config['encryption'] = 0
         self.assertEqual(
@@ -167,7 +741,7 @@ class ConsumerNSCATest(unittest.TestCase):
             bytes.fromhex('CBD7')
         )
 
-    @mock.patch('sauna.consumers.ext.nsca.socket')
+    @mock.patch('sauna.consumers.receivers.socket')
     def test_get_receivers_addresses(self, socket_mock):
         socket_mock.getaddrinfo.return_value = [
             (None, None, None, None, ('7.7.7.7', 5667)),
@@ -182,12 +756,20 @@ class ConsumerNSCATest(unittest.TestCase):
         self.assertListEqual(self.nsca._get_receivers_addresses(),
                              ['9.9.9.9', '7.7.7.7', '8.8.8.8'])
 
-    def test_send(self):
+        # Receivers that failed are skipped
+        self.nsca._receivers.record_failure('7.7.7.7', ConnectionError())
+        self.assertListEqual(self.nsca._get_receivers_addresses(),
+                             ['9.9.9.9', '8.8.8.8'])
+        socket_mock.getaddrinfo.assert_called_once_with(
+            'localhost', 5667, proto=socket_mock.IPPROTO_TCP
+        )
+
+    def test_send_batch(self):
         self.nsca._get_receivers_addresses = lambda: ['7.7.7.7', '8.8.8.8']
         self.nsca._send_to_receiver = lambda x, y: None
 
         self.assertEqual(self.nsca._last_good_receiver_address, None)
-        self.nsca._send(None)
+        self.nsca._send_batch([])
         self.assertEqual(self.nsca._last_good_receiver_address, '7.7.7.7')
 
         def raise_socket_timeout(*args, **kwargs):
@@ -195,9 +777,693 @@ class ConsumerNSCATest(unittest.TestCase):
 
         self.nsca._send_to_receiver = raise_socket_timeout
         with self.assertRaises(IOError):
-            self.nsca._send(None)
+            self.nsca._send_batch([])
         self.assertEqual(self.nsca._last_good_receiver_address, '7.7.7.7')
 
+    def test_send_batch_failover_remainder(self):
+        self.nsca._get_receivers_addresses = lambda: ['7.7.7.7', '8.8.8.8']
+        received = {}
+
+        def send_to_receiver(service_checks, receiver_address):
+            received[receiver_address] = list(service_checks)
+            if receiver_address == '7.7.7.7':
+                # Connection lost after sending the first check
+                del service_checks[0]
+                raise ConnectionResetError()
+            service_checks.clear()
+
+        self.nsca._send_to_receiver = send_to_receiver
+        service_checks = ['foo', 'bar', 'baz']
+        self.nsca._send_batch(service_checks)
+        self.assertListEqual(received['7.7.7.7'], ['foo', 'bar', 'baz'])
+        self.assertListEqual(received['8.8.8.8'], ['bar', 'baz'])
+        self.assertListEqual(service_checks, [])
+        self.assertEqual(self.nsca._last_good_receiver_address, '8.8.8.8')
+
+    @mock.patch('sauna.consumers.ext.nsca.socket')
+    def test_send_to_receiver_single_connection(self, socket_mock):
+        s = socket_mock.socket.return_value.__enter__.return_value
+        s.recv.return_value = bytes(self.nsca.init_payload_size)
+        service_checks = [
+            ServiceCheck(timestamp=42, hostname='server1', name=name,
+                         status=0, output='OK')
+            for name in ('foo', 'bar', 'baz')
+        ]
+        self.nsca._send_to_receiver(service_checks, '7.7.7.7')
+        s.connect.assert_called_once_with(('7.7.7.7', 5667))
+        self.assertEqual(s.sendall.call_count, 3)
+        for call in s.sendall.call_args_list:
+            self.assertEqual(len(call[0][0]), self.nsca.service_payload_size)
+        self.assertListEqual(service_checks, [])
+
+    def test_recv_init_payload_connection_closed(self):
+        s = mock.Mock()
+        s.recv.side_effect = [bytes(10), b'']
+        with self.assertRaises(ConnectionError):
+            self.nsca._recv_init_payload(s)
+
+    def test_batch_config(self):
+        self.assertEqual(self.nsca.max_batch_size, 64)
+        consumer = nsca.NSCAConsumer({'max_batch_size': 10,
+                                      'max_batch_delay': 0.5})
+        self.assertEqual(consumer.max_batch_size, 10)
+        self.assertEqual(consumer.max_batch_delay.total_seconds(), 0.5)
+
+
+class DNSCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = receivers.DNSCache(clock=lambda: self.now)
+
+    @mock.patch('sauna.consumers.receivers.socket')
+    def test_ttl(self, socket_mock):
+        socket_mock.getaddrinfo.return_value = [
+            (None, None, None, None, ('7.7.7.7', 5667)),
+            (None, None, None, None, ('7.7.7.7', 5667)),
+            (None, None, None, None, ('8.8.8.8', 5667))
+        ]
+        self.assertListEqual(self.cache.get_addresses('foo', 5667, ttl=10),
+                             ['7.7.7.7', '8.8.8.8'])
+        self.now = 9
+        self.cache.get_addresses('foo', 5667, ttl=10)
+        self.assertEqual(socket_mock.getaddrinfo.call_count, 1)
+        self.now = 10
+        self.cache.get_addresses('foo', 5667, ttl=10)
+        self.assertEqual(socket_mock.getaddrinfo.call_count, 2)
+
+    @mock.patch('sauna.consumers.receivers.socket')
+    def test_negative_ttl(self, socket_mock):
+        socket_mock.gaierror = socket.gaierror
+        socket_mock.getaddrinfo.side_effect = socket.gaierror('not found')
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                self.cache.get_addresses('foo', 5667, negative_ttl=5)
+        self.assertEqual(socket_mock.getaddrinfo.call_count, 1)
+
+        self.now = 5
+        socket_mock.getaddrinfo.side_effect = None
+        socket_mock.getaddrinfo.return_value = [
+            (None, None, None, None, ('7.7.7.7', 5667))
+        ]
+        self.assertListEqual(self.cache.get_addresses('foo', 5667, ttl=10),
+                             ['7.7.7.7'])
+
+        # Last known addresses are used when the resolver fails
+        self.now = 20
+        socket_mock.getaddrinfo.side_effect = socket.gaierror('not found')
+        self.assertListEqual(self.cache.get_addresses('foo', 5667),
+                             ['7.7.7.7'])
+
+
+class ReceiverHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.health = receivers.ReceiverHealth(
+            cooldown=10, max_cooldown=25, clock=lambda: self.now
+        )
+
+    def test_cooldown(self):
+        addresses = ['7.7.7.7', '8.8.8.8']
+        self.health.record_failure('7.7.7.7', ConnectionRefusedError())
+        self.assertListEqual(self.health.available(addresses), ['8.8.8.8'])
+        self.now = 10
+        self.assertListEqual(self.health.available(addresses), addresses)
+
+        # Cooldown doubles at each consecutive failure, up to a maximum
+        self.health.record_failure('7.7.7.7', ConnectionRefusedError())
+        self.assertEqual(self.health['7.7.7.7'].cooldown_until, 30)
+        self.health.record_failure('7.7.7.7', ConnectionRefusedError())
+        self.assertEqual(self.health['7.7.7.7'].cooldown_until, 35)
+        self.assertEqual(self.health['7.7.7.7'].failures, 3)
+
+        self.health.record_success('7.7.7.7')
+        self.assertListEqual(self.health.available(addresses), addresses)
+
+    def test_all_in_cooldown(self):
+        self.health.record_failure('7.7.7.7', ConnectionRefusedError())
+        self.now = 1
+        self.health.record_failure('8.8.8.8', ConnectionRefusedError())
+        self.assertListEqual(self.health.available(['8.8.8.8', '7.7.7.7']),
+                             ['7.7.7.7'])
+        self.assertListEqual(self.health.available([]), [])
+
+    def test_latency(self):
+        self.health.record_latency('7.7.7.7', 1)
+        self.health.record_latency('7.7.7.7', 2)
+        self.assertAlmostEqual(self.health['7.7.7.7'].latency, 1.3)
+
+
+class ConsumerHTTPPostTest(unittest.TestCase):
+
+    url = 'http://server.tld/services'
+
+    def service_checks(self, number):
+        return [ServiceCheck(timestamp=42, hostname='server1',
+                             name='check_{}'.format(i), status=0,
+                             output='OK')
+                for i in range(number)]
+
+    def test_single_check(self):
+        consumer = http.HTTPConsumer({'url': self.url,
+                                      'headers': {'X-Token': 'foo'}})
+        self.assertEqual(consumer.max_batch_size, 1)
+        with requests_mock.Mocker() as m:
+            m.post(self.url)
+            service_checks = self.service_checks(1)
+            consumer._send_batch(service_checks)
+        self.assertListEqual(service_checks, [])
+        self.assertDictEqual(m.last_request.json(), {
+            'timestamp': 42, 'hostname': 'server1', 'service': 'check_0',
+            'status': 0, 'output': 'OK'
+        })
+        self.assertEqual(m.last_request.headers['X-Token'], 'foo')
+
+    def test_batch(self):
+        consumer = http.HTTPConsumer({'url': self.url, 'batch': True,
+                                      'max_batch_size': 2, 'gzip': True})
+        self.assertEqual(consumer.max_batch_size, 2)
+        with requests_mock.Mocker() as m:
+            m.post(self.url)
+            consumer._send_batch(self.service_checks(3))
+        self.assertEqual(m.call_count, 2)
+        request = m.request_history[0]
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        checks = json.loads(gzip.decompress(request.body).decode())
+        self.assertListEqual([c['service'] for c in checks],
+                             ['check_0', 'check_1'])
+
+    def test_requests_in_flight(self):
+        consumer = http.HTTPConsumer({'url': self.url, 'batch': True,
+                                      'max_batch_size': 2,
+                                      'max_in_flight': 3})
+        self.assertEqual(consumer.max_batch_size, 6)
+
+        def fail_second_request(request, context):
+            if request.json()[0]['service'] == 'check_2':
+                context.status_code = 500
+
+        with requests_mock.Mocker() as m:
+            m.post(self.url, text=fail_second_request)
+            service_checks = self.service_checks(6)
+            with self.assertRaises(Exception):
+                consumer._send_batch(service_checks)
+        self.assertEqual(m.call_count, 3)
+        # Only the checks of the failed request are left to send
+        self.assertListEqual([c.name for c in service_checks],
+                             ['check_2', 'check_3'])
+
+
+class ConsumerHTTPIcingaTest(unittest.TestCase):
+
+    url = 'http://icinga.host:5665/v1/actions/process-check-result'
+
+    def test_send_batch(self):
+        consumer = http_icinga.HTTPIcingaConsumer({'url': self.url,
+                                                  'batch': True})
+        self.assertEqual(consumer.max_batch_size, 4)
+        service_checks = [
+            ServiceCheck(timestamp=42, hostname='server1', name=name,
+                         status=2, output='Critical')
+            for name in ('foo', 'bar')
+        ]
+        with requests_mock.Mocker() as m:
+            m.post(self.url)
+            consumer._send_batch(service_checks)
+        self.assertListEqual(service_checks, [])
+        self.assertEqual(m.call_count, 2)
+        self.assertListEqual(
+            sorted((r.json()['service'] for r in m.request_history)),
+            ['server1!bar', 'server1!foo']
+        )
+        self.assertDictEqual(m.last_request.json(), {
+            'type': 'Service',
+            'service': m.last_request.json()['service'],
+            'exit_status': 2,
+            'plugin_output': 'Critical'
+        })
+
+
+class MQTTBrokerStandIn:
+    """Minimal MQTT 3.1.1 broker recording the messages it receives."""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self._sockets = []
+        self._server = socket.socket()
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(8)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self._sockets.append(conn)
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    @staticmethod
+    def _recv_exactly(conn, size):
+        data = b''
+        while len(data) < size:
+            buffer = conn.recv(size - len(data))
+            if not buffer:
+                raise ConnectionError()
+            data += buffer
+        return data
+
+    def _recv_packet(self, conn):
+        packet_type = self._recv_exactly(conn, 1)[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = self._recv_exactly(conn, 1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return packet_type, self._recv_exactly(conn, length)
+
+    def _serve(self, conn):
+        try:
+            while True:
+                packet_type, body = self._recv_packet(conn)
+                if packet_type >> 4 == 1:  # CONNECT
+                    conn.sendall(bytes([0x20, 2, 0, 0]))
+                elif packet_type >> 4 == 3:  # PUBLISH
+                    qos = (packet_type >> 1) & 3
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    payload = body[2 + topic_length:]
+                    if qos:
+                        packet_id, payload = payload[:2], payload[2:]
+                        conn.sendall(bytes([0x40, 2]) + packet_id)
+                    self.messages.append(
+                        (topic, json.loads(payload.decode()), qos,
+                         bool(packet_type & 1))
+                    )
+                elif packet_type >> 4 == 12:  # PINGREQ
+                    conn.sendall(bytes([0xD0, 0]))
+                elif packet_type >> 4 == 14:  # DISCONNECT
+                    return
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def wait_for_messages(self, count, timeout=5):
+        """Wait for messages, QoS 0 ones are not acknowledged."""
+        for _ in range(int(timeout * 100)):
+            if len(self.messages) >= count:
+                return
+            time.sleep(0.01)
+
+    def wait_for_topic(self, topic, timeout=5):
+        """Wait for a message published on a topic."""
+        for _ in range(int(timeout * 100)):
+            if topic in [message[0] for message in self.messages]:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def drop_connections(self):
+        for conn in self._sockets:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already closed by the client
+                pass
+        self._sockets = []
+
+    def close(self):
+        self.drop_connections()
+        try:
+            # Wakes up the thread blocked in accept
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+
+
+class ConsumerHomeAssistantMQTTTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = MQTTBrokerStandIn()
+        self.consumers = []
+
+    def tearDown(self):
+        for consumer in self.consumers:
+            consumer._close_client()
+        self.broker.close()
+
+    def consumer(self, **config):
+        config.update({'hostname': '127.0.0.1', 'port': self.broker.port})
+        consumer = home_assistant_mqtt.HomeAssistantMQTTConsumer(config)
+        self.consumers.append(consumer)
+        return consumer
+
+    @staticmethod
+    def service_checks(*names):
+        return [ServiceCheck(timestamp=42, hostname='server.tld', name=name,
+                             status=1, output='Warning')
+                for name in names]
+
+    def test_persistent_connection(self):
+        consumer = self.consumer()
+        service_checks = self.service_checks('load', 'disk-usage')
+        consumer._send_batch(service_checks)
+        self.assertListEqual(service_checks, [])
+        consumer._send_batch(self.service_checks('load'))
+        self.assertEqual(self.broker.connections, 1)
+        self.broker.wait_for_messages(5)
+
+        topics = [(topic, qos, retain)
+                  for topic, _, qos, retain in self.broker.messages]
+        self.assertListEqual(topics, [
+            ('homeassistant/sensor/sauna_server_tld_load/config', 1, True),
+            ('sauna/server_tld/load/state', 0, False),
+            ('homeassistant/sensor/sauna_server_tld_disk_usage/config', 1,
+             True),
+            ('sauna/server_tld/disk_usage/state', 0, False),
+            ('sauna/server_tld/load/state', 0, False),
+        ])
+        self.assertDictEqual(self.broker.messages[-1][1],
+                             {'status': 'Warning', 'output': 'Warning'})
+
+    def test_discovered_checks_persist(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = os.path.join(tmp_dir, 'mqtt.json')
+            self.consumer(state_file=state_file)._send_batch(
+                self.service_checks('load')
+            )
+            self.consumer(state_file=state_file)._send_batch(
+                self.service_checks('load', 'memory')
+            )
+        self.broker.wait_for_messages(5)
+        discovery_topics = [topic for topic, _, _, retain
+                            in self.broker.messages if retain]
+        self.assertListEqual(discovery_topics, [
+            'homeassistant/sensor/sauna_server_tld_load/config',
+            'homeassistant/sensor/sauna_server_tld_memory/config',
+        ])
+
+    def test_reconnect(self):
+        consumer = self.consumer()
+        consumer._send_batch(self.service_checks('load'))
+        self.broker.drop_connections()
+
+        service_checks = self.service_checks('memory')
+        for _ in range(100):
+            try:
+                consumer._send_batch(service_checks)
+            except IOError:
+                # Not reconnected yet, the discovery message is sent again
+                time.sleep(0.1)
+            else:
+                break
+        self.assertListEqual(service_checks, [])
+        self.assertEqual(self.broker.connections, 2)
+        self.assertTrue(
+            self.broker.wait_for_topic('sauna/server_tld/memory/state')
+        )
+
+    def test_broker_unavailable(self):
+        self.broker.close()
+        with self.assertRaises(OSError):
+            self.consumer()._send_batch(self.service_checks('load'))
+
+
+class ConsumerTCPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(tcp_server.TCPServerConsumer,
+                                    'get_status_line',
+                                    return_value=b'WARNING\n')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_server(self, **config):
+        consumer = tcp_server.TCPServerConsumer(dict(config, port=0))
+        must_stop = threading.Event()
+        thread = threading.Thread(target=consumer.run, args=(must_stop,),
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(must_stop.set)
+        for _ in range(100):
+            if consumer.selector is not None:
+                break
+            time.sleep(0.01)
+        return consumer, consumer.server.getsockname()[1]
+
+    def connect(self, port):
+        client = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.addCleanup(client.close)
+        return client
+
+    def test_config(self):
+        consumer = tcp_server.TCPServerConsumer({'port': 1234,
+                                                 'backlog': 16})
+        self.assertEqual(consumer.config['port'], 1234)
+        self.assertEqual(consumer.config['backlog'], 16)
+        self.assertEqual(consumer.config['max_connections'], 10000)
+
+    def test_status_on_connect_and_newline(self):
+        consumer, port = self.start_server()
+        client = self.connect(port)
+        self.assertEqual(client.recv(64), b'WARNING\n')
+        client.sendall(b'status\n')
+        self.assertEqual(client.recv(64), b'WARNING\n')
+        client.close()
+        for _ in range(100):
+            if not consumer.connections:
+                break
+            time.sleep(0.01)
+        self.assertDictEqual(consumer.connections, {})
+
+    def test_max_connections(self):
+        consumer, port = self.start_server(max_connections=1)
+        first = self.connect(port)
+        self.assertEqual(first.recv(64), b'WARNING\n')
+
+        # Waits in the backlog until the first client leaves
+        second = self.connect(port)
+        second.settimeout(0.2)
+        with self.assertRaises(socket.timeout):
+            second.recv(64)
+        first.close()
+        second.settimeout(5)
+        self.assertEqual(second.recv(64), b'WARNING\n')
+
+    def test_out_of_file_descriptors(self):
+        consumer = tcp_server.TCPServerConsumer({'port': 0})
+        consumer._create_server()
+        self.addCleanup(consumer._close_all)
+        error = OSError(errno.EMFILE, 'Too many open files')
+        with mock.patch.object(socket.socket, 'accept', side_effect=error):
+            consumer._accept_new_connections()
+
+        # Select does not keep returning the listening socket
+        self.assertFalse(consumer._accepting)
+        self.assertEqual(consumer.selector.get_map(), {})
+        self.assertGreater(consumer._select_timeout(), 0)
+
+        consumer._resume_accepting_at = time.monotonic()
+        consumer._maybe_resume_accepting()
+        self.assertTrue(consumer._accepting)
+        self.assertIsNone(consumer._resume_accepting_at)
+
+    @unittest.skipIf(tcp_server.resource is None, 'resource is not available')
+    def test_max_connections_capped_by_open_files(self):
+        consumer = tcp_server.TCPServerConsumer({'port': 0})
+        with mock.patch.object(tcp_server.resource, 'getrlimit',
+                               return_value=(1024, 4096)):
+            with self.assertLogs('sauna', level='WARNING'):
+                consumer._create_server()
+        self.addCleanup(consumer._close_all)
+        self.assertEqual(consumer.config['max_connections'],
+                         1024 - consumer.reserved_fds)
+
+    def test_partial_send(self):
+        connection = tcp_server.Connection(mock.Mock(), ('127.0.0.1', 1234))
+        connection.sock.send.side_effect = [3, 6, 3]
+        connection.queue(b'CRITICAL\n')
+        connection.queue(b'OK\n')
+        self.assertFalse(connection.send())
+        self.assertEqual(connection.outgoing[0].tobytes(), b'TICAL\n')
+        self.assertTrue(connection.send())
+        sent = [bytes(c[0][0]) for c in connection.sock.send.call_args_list]
+        # Sent data is not copied, remaining data is a view of the original
+        self.assertListEqual(sent, [b'CRITICAL\n', b'TICAL\n', b'OK\n'])
+
+
+class ConsumerHTTPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ResultStore()
+        patcher = mock.patch('sauna.result_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publish('load', 'Load is fine')
+
+    def publish(self, name, output, status=0):
+        self.store.publish(ServiceCheck(timestamp=42, hostname='server1',
+                                        name=name, status=status,
+                                        output=output))
+
+    def start_server(self, **config):
+        consumer = http_server.HTTPServerConsumer(dict(config, port=0))
+        must_stop = threading.Event()
+        server = consumer._create_server(must_stop)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.01},
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(must_stop.set)
+        return server.server_address[1]
+
+    def connect(self, port):
+        conn = http_client.HTTPConnection('127.0.0.1', port, timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def get(self, conn, headers=None):
+        conn.request('GET', '/', headers=headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        conn = self.connect(self.start_server())
+        response, data = self.get(conn)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(data.decode())['checks']['load']
+                         ['output'], 'Load is fine')
+        sock = conn.sock
+        response, _ = self.get(conn)
+        self.assertEqual(response.status, 200)
+        # The same connection was used for both requests
+        self.assertIs(conn.sock, sock)
+
+    def test_not_found(self):
+        conn = self.connect(self.start_server())
+        conn.request('GET', '/foo')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+        self.assertDictEqual(json.loads(response.read().decode()),
+                             {'error': 'Resource not found'})
+
+    def test_etag(self):
+        conn = self.connect(self.start_server())
+        response, _ = self.get(conn)
+        etag = response.getheader('ETag')
+        self.assertIsNotNone(etag)
+
+        response, data = self.get(conn, {'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(data, b'')
+
+        self.publish('load', 'Load is high', status=1)
+        response, data = self.get(conn, {'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.getheader('ETag'), etag)
+        self.assertEqual(json.loads(data.decode())['code'], 1)
+
+    def test_gzip(self):
+        for i in range(50):
+            self.publish('check_{}'.format(i), 'Everything is fine')
+        conn = self.connect(self.start_server(gzip_min_size=1024))
+        response, data = self.get(conn, {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(data).decode())
+                             ['checks']), 51)
+
+        response, data = self.get(conn, {'Accept-Encoding': 'gzip;q=0'})
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(len(json.loads(data.decode())['checks']), 51)
+
+        # Small documents are not worth compressing
+        conn = self.connect(self.start_server(gzip_min_size=1000000))
+        response, _ = self.get(conn, {'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.getheader('Content-Encoding'))
+
+    def test_metrics(self):
+        self.publish('disk', 'Disk is "full"\n', status=2)
+        conn = self.connect(self.start_server())
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertTrue(
+            response.getheader('Content-Type').startswith('text/plain')
+        )
+        body = response.read().decode()
+        self.assertIn('# TYPE sauna_check_status gauge\n'
+                      'sauna_check_status{check="disk"} 2\n'
+                      'sauna_check_status{check="load"} 0\n', body)
+        self.assertIn('sauna_check_timestamp_seconds{check="load"} 42\n',
+                      body)
+        self.assertIn('# TYPE sauna_check_skipped_runs_total counter', body)
+
+    def test_metrics_rendered_incrementally(self):
+        consumer = http_server.HTTPServerConsumer({})
+        self.publish('disk', 'Disk is fine')
+        data = consumer.get_metrics()
+        load_lines = consumer._checks_samples['load'][1]
+        disk_lines = consumer._checks_samples['disk'][1]
+
+        self.publish('disk', 'Disk is full', status=2)
+        new_data = consumer.get_metrics()
+        self.assertNotEqual(new_data, data)
+        self.assertIn(b'sauna_check_status{check="disk"} 2\n', new_data)
+        # Lines of the checks that did not change are reused
+        self.assertIs(consumer._checks_samples['load'][1], load_lines)
+        self.assertIsNot(consumer._checks_samples['disk'][1], disk_lines)
+
+    def test_slow_client_does_not_block(self):
+        port = self.start_server(max_threads=2)
+        slow = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.addCleanup(slow.close)
+        slow.sendall(b'GET / HTTP/1.1\r\n')
+        response, _ = self.get(self.connect(port))
+        self.assertEqual(response.status, 200)
+
+    def test_idle_connections_do_not_block(self):
+        port = self.start_server(max_threads=2, keepalive_timeout=30)
+        idle = http_client.HTTPConnection('127.0.0.1', port, timeout=2)
+        self.addCleanup(idle.close)
+        response, _ = self.get(idle)
+        self.assertIsNone(response.getheader('Connection'))
+
+        # The last thread is not kept by an idle connection
+        for _ in range(3):
+            conn = http_client.HTTPConnection('127.0.0.1', port, timeout=2)
+            self.addCleanup(conn.close)
+            response, _ = self.get(conn)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader('Connection'), 'close')
+
+    def test_idle_connections_not_modified(self):
+        port = self.start_server(max_threads=2, keepalive_timeout=30)
+        idle = http_client.HTTPConnection('127.0.0.1', port, timeout=2)
+        self.addCleanup(idle.close)
+        response, _ = self.get(idle)
+        etag = response.getheader('ETag')
+
+        # Scrapers sending If-None-Match do not keep the last thread
+        for _ in range(3):
+            conn = http_client.HTTPConnection('127.0.0.1', port, timeout=2)
+            self.addCleanup(conn.close)
+            response, _ = self.get(conn, {'If-None-Match': etag})
+            self.assertEqual(response.status, 304)
+            self.assertEqual(response.getheader('Connection'), 'close')
+
 
 class ConsumerHTTPTest(unittest.TestCase):
     @mock.patch('sauna.consumers.base.AsyncConsumer.get_checks_as_dict')
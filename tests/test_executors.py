@@ -0,0 +1,528 @@
+import asyncio
+import os
+import sys
+import socket
+import threading
+import time
+import unittest
+
+from concurrent.futures import Future
+import functools
+
+from sauna.executors import (ThreadExecutor, SerialExecutor,
+                             AsyncioExecutor, ProcessExecutor, Watchdog,
+                             CheckTimeoutError)
+from sauna.plugins import Plugin
+from sauna.plugins.base import Check
+from sauna.plugins.ext import tcp, command
+
+
+class WatchdogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.watchdog = Watchdog()
+
+    def tearDown(self):
+        self.watchdog.shutdown()
+
+    def test_result_in_time(self):
+        future = Future()
+        watched = self.watchdog.watch(future, 5)
+        future.set_result((0, 'OK'))
+        self.assertEqual(watched.result(timeout=5), (0, 'OK'))
+
+    def test_timeout(self):
+        timed_out = []
+        future = Future()
+        watched = self.watchdog.watch(
+            future, 0.05, on_timeout=lambda: timed_out.append(True)
+        )
+        with self.assertRaises(CheckTimeoutError):
+            watched.result(timeout=5)
+        self.assertEqual(timed_out, [True])
+
+        # A late result is ignored
+        future.set_result((0, 'OK'))
+        with self.assertRaises(CheckTimeoutError):
+            watched.result()
+
+    def test_no_timeout(self):
+        future = Future()
+        watched = self.watchdog.watch(future, None)
+        self.assertIsNone(self.watchdog._thread)
+        future.set_exception(RuntimeError('oops'))
+        with self.assertRaises(RuntimeError):
+            watched.result(timeout=5)
+
+    def test_earliest_deadline_first(self):
+        slow = self.watchdog.watch(Future(), 10)
+        fast = self.watchdog.watch(Future(), 0.05)
+        with self.assertRaises(CheckTimeoutError):
+            fast.result(timeout=5)
+        self.assertFalse(slow.done())
+
+
+def blocking_check(name, release, started=None):
+    def check_func(check_config):
+        if started is not None:
+            started.set()
+        release.wait(5)
+        return Plugin.STATUS_OK, 'released'
+    return Check(name, 60, check_func, {})
+
+
+class ThreadExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadExecutor(1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_cancel(self):
+        release, started = threading.Event(), threading.Event()
+        running = blocking_check('foo', release, started)
+        running_future = self.executor.submit(running)
+        queued = blocking_check('bar', release)
+        queued_future = self.executor.submit(queued)
+        self.assertTrue(started.wait(5))
+
+        # A queued check never runs
+        self.assertFalse(self.executor.cancel(queued_future, queued))
+        self.assertTrue(queued_future.cancelled())
+
+        # A running one completes when its thread returns
+        self.assertTrue(self.executor.cancel(running_future, running))
+        self.assertFalse(running_future.done())
+        release.set()
+        self.assertEqual(running_future.result(timeout=5), (0, 'released'))
+
+
+class SerialExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = SerialExecutor()
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_cancel_replaces_worker(self):
+        release = threading.Event()
+
+        def blocking(check_config):
+            release.wait(5)
+            return Plugin.STATUS_OK, 'released'
+
+        check = Check('foo', 60, blocking, {})
+        future = self.executor.submit(check)
+        self.executor.cancel(future, check)
+
+        # The next check does not wait for the abandoned one
+        check = Check('bar', 60, lambda c: (Plugin.STATUS_OK, 'bar'), {})
+        self.assertEqual(self.executor.submit(check).result(timeout=1),
+                         (0, 'bar'))
+        release.set()
+
+
+class AsyncioExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = AsyncioExecutor(concurrency=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_coroutine_check(self):
+        async def check_func(check_config):
+            await asyncio.sleep(0)
+            return Plugin.STATUS_OK, check_config['output']
+
+        check = Check('foo', 60, check_func, {'output': 'async'})
+        self.assertTrue(check.is_coroutine)
+        future = self.executor.submit(check)
+        self.assertEqual(future.result(timeout=5), (0, 'async'))
+
+    def test_sync_check(self):
+        loop_thread = []
+
+        def check_func(check_config):
+            loop_thread.append(threading.current_thread())
+            return Plugin.STATUS_WARN, 'sync'
+
+        check = Check('foo', 60, check_func, {})
+        self.assertFalse(check.is_coroutine)
+        future = self.executor.submit(check)
+        self.assertEqual(future.result(timeout=5), (1, 'sync'))
+        # Synchronous checks must not block the event loop
+        self.assertIsNot(loop_thread[0], self.executor._loop_thread)
+
+    def test_check_exception(self):
+        async def check_func(check_config):
+            raise RuntimeError('oops')
+
+        future = self.executor.submit(Check('foo', 60, check_func, {}))
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+
+    def test_concurrency_limit(self):
+        running = []
+        max_running = []
+
+        async def check_func(check_config):
+            running.append(1)
+            max_running.append(len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+            return Plugin.STATUS_OK, ''
+
+        futures = [self.executor.submit(Check(str(i), 60, check_func, {}))
+                   for i in range(6)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(max(max_running), 2)
+
+    def test_cancel_coroutine(self):
+        cancelled = threading.Event()
+
+        async def check_func(check_config):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        check = Check('foo', 60, check_func, {})
+        future = self.executor.submit(check)
+        time.sleep(0.05)
+        self.executor.cancel(future, check)
+        self.assertTrue(cancelled.wait(5))
+
+    def test_cancel_sync_check(self):
+        release, started = threading.Event(), threading.Event()
+        running = blocking_check('foo', release, started)
+        running_future = self.executor.submit(running)
+        self.assertTrue(started.wait(5))
+        blocking_future = self.executor.submit(blocking_check('bar', release))
+        queued = blocking_check('baz', release)
+        queued_future = self.executor.submit(queued)
+        time.sleep(0.05)
+
+        # Waiting for the semaphore, cancelled
+        self.assertFalse(self.executor.cancel(queued_future, queued))
+        self.assertTrue(queued_future.cancelled())
+
+        # The thread keeps its slot until it returns
+        self.assertTrue(self.executor.cancel(running_future, running))
+        self.assertFalse(running_future.done())
+        release.set()
+        self.assertEqual(running_future.result(timeout=5), (0, 'released'))
+        self.assertEqual(blocking_future.result(timeout=5), (0, 'released'))
+
+    def test_coroutine_check_outside_loop(self):
+        async def check_func(check_config):
+            return Plugin.STATUS_OK, 'no loop'
+
+        check = Check('foo', 60, check_func, {})
+        self.assertEqual(check.run_check(), (0, 'no loop'))
+
+
+class WorkerPlugin(Plugin):
+
+    cached_attributes = ('_pid',)
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._pid = None
+
+    def pid(self, check_config):
+        if self._pid is None:
+            self._pid = os.getpid()
+        return Plugin.STATUS_OK, str(self._pid)
+
+    def sleep(self, check_config):
+        time.sleep(check_config['duration'])
+        return Plugin.STATUS_OK, 'slept'
+
+    def crash(self, check_config):
+        os._exit(1)
+
+
+@unittest.skipUnless(ProcessExecutor.supported, 'requires Python 3.7')
+class ProcessExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ProcessExecutor(max_workers=1)
+        self.watchdog = Watchdog()
+        self.plugin = WorkerPlugin({})
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.watchdog.shutdown()
+
+    def check(self, func_name, **check_config):
+        check = Check(func_name, 60, getattr(self.plugin, func_name),
+                      check_config)
+        check.executor = 'process'
+        return check
+
+    def test_run_check_in_worker(self):
+        future = self.executor.submit(self.check('pid'))
+        status, output = future.result(timeout=30)
+        self.assertEqual(status, Plugin.STATUS_OK)
+        self.assertNotEqual(output, str(os.getpid()))
+
+    def test_plugin_instance_is_reused(self):
+        check = self.check('pid')
+        first = self.executor.submit(check).result(timeout=30)
+        self.assertEqual(self.executor.submit(check).result(timeout=30),
+                         first)
+
+        # The instance in the worker is invalidated with the main one
+        self.plugin.invalidate_cache()
+        self.assertEqual(self.executor.submit(check).result(timeout=30),
+                         first)
+        self.assertEqual(self.plugin.cache_generation, 1)
+
+    def test_timeout(self):
+        # Give the pool time to start before measuring the timeout
+        self.executor.submit(self.check('pid')).result(timeout=30)
+        check = self.check('sleep', duration=10)
+        future = self.executor.submit(check)
+        watched = self.watchdog.watch(
+            future, 0.5,
+            on_timeout=functools.partial(self.executor.cancel, future, check)
+        )
+        with self.assertRaises(CheckTimeoutError):
+            watched.result(timeout=30)
+        self.assertIsNone(self.executor._pool)
+
+        # A new pool is started for the next checks
+        future = self.executor.submit(self.check('sleep', duration=0))
+        self.assertEqual(future.result(timeout=30), (0, 'slept'))
+
+    def test_crash_recovery(self):
+        future = self.executor.submit(self.check('crash'))
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=30)
+
+        future = self.executor.submit(self.check('sleep', duration=0))
+        self.assertEqual(future.result(timeout=30), (0, 'slept'))
+
+
+class TCPPluginTest(unittest.TestCase):
+
+    def test_request(self):
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            port = server.getsockname()[1]
+            check = Check('tcp', 60, tcp.Tcp({}).request,
+                          {'host': '127.0.0.1', 'port': port, 'timeout': 5})
+            self.assertEqual(check.run_check(), (Plugin.STATUS_OK, 'OK'))
+
+        status, _ = check.run_check()
+        self.assertEqual(status, Plugin.STATUS_CRIT)
+
+
+class CommandPluginTest(unittest.TestCase):
+
+    def test_cancel_check(self):
+        plugin = command.Command({})
+        check_config = {'command': '{} -c "import time; time.sleep(10)"'
+                                   .format(sys.executable)}
+        check = Check('cmd', 60, plugin.command, check_config)
+        executor = SerialExecutor()
+        try:
+            future = executor.submit(check)
+            for _ in range(100):
+                if plugin._processes:
+                    break
+                time.sleep(0.01)
+            executor.cancel(future, check)
+            # The killed subprocess lets the abandoned thread finish
+            status, _ = future.result(timeout=5)
+        finally:
+            executor.shutdown()
+        self.assertNotEqual(status, Plugin.STATUS_OK)
+        self.assertEqual(plugin._processes, {})
+
+
+class SaunaAsyncioExecutorTest(unittest.TestCase):
+
+    def test_publish_results(self):
+        from sauna import Sauna, result_store, check_durations
+        runs, _ = check_durations.get(check='async_dummy')
+        sauna = Sauna(config={
+            'executor': 'asyncio',
+            'concurrency': 10,
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [{'type': 'dummy', 'name': 'async_dummy',
+                            'status': 1, 'output': 'from asyncio'}]
+            }]
+        })
+        self.assertIsNone(sauna._thread_pool)
+        try:
+            sauna.launch_and_publish_checks(sauna.check_registry.checks)
+            # The check is removed from the current ones once published
+            for _ in range(100):
+                with sauna._current_checks_lock:
+                    if not sauna._current_checks:
+                        break
+                time.sleep(0.01)
+            service_check = result_store.remove('async_dummy')
+        finally:
+            sauna._async_executor.shutdown()
+        self.assertEqual(service_check.status, 1)
+        self.assertEqual(service_check.output, 'from asyncio')
+        self.assertEqual(check_durations.get(check='async_dummy')[0],
+                         runs + 1)
+
+
+class SaunaCheckTimeoutTest(unittest.TestCase):
+
+    def test_overrun(self):
+        from sauna import Sauna, result_store, overruns
+        sauna = Sauna(config={
+            'check_timeout': 0.2,
+            'plugins': [{
+                'type': 'Command',
+                'checks': [{
+                    'type': 'command', 'name': 'overrun_command',
+                    'command': '{} -c "import time; time.sleep(10)"'
+                               .format(sys.executable)
+                }]
+            }]
+        })
+        before = overruns.get(check='overrun_command')
+        try:
+            sauna.launch_and_publish_checks(sauna.check_registry.checks)
+            service_check = result_store.remove('overrun_command')
+        finally:
+            sauna._serial_executor.shutdown()
+            sauna._watchdog.shutdown()
+        self.assertEqual(service_check.status, Plugin.STATUS_UNKNOWN)
+        self.assertIn('timed out after 0.2s', service_check.output)
+        self.assertEqual(overruns.get(check='overrun_command'), before + 1)
+
+    def test_stuck_serial_check_not_run_again(self):
+        from sauna import Sauna, result_store, skipped_runs
+        sauna = Sauna(config={
+            'check_timeout': 0.1,
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [{'type': 'dummy', 'name': 'stuck_serial'},
+                           {'type': 'dummy', 'name': 'healthy_serial'}]
+            }]
+        })
+        release, started = threading.Event(), threading.Event()
+        stuck, _ = sauna.check_registry.checks
+        stuck.check_func = blocking_check('stuck_serial', release,
+                                          started).check_func
+        skipped = skipped_runs.get(check='stuck_serial')
+        try:
+            for _ in range(3):
+                started.clear()
+                sauna.launch_and_publish_checks(sauna.check_registry.checks)
+                service_check = result_store.remove('healthy_serial')
+                self.assertEqual(service_check.status, Plugin.STATUS_OK)
+            # Only the first run started a thread
+            self.assertFalse(started.is_set())
+            self.assertEqual(skipped_runs.get(check='stuck_serial'),
+                             skipped + 2)
+            release.set()
+            for _ in range(100):
+                with sauna._current_checks_lock:
+                    if not sauna._current_checks:
+                        break
+                time.sleep(0.01)
+            self.assertEqual(sauna._current_checks, [])
+        finally:
+            release.set()
+            result_store.remove('stuck_serial')
+            sauna._serial_executor.shutdown()
+            sauna._watchdog.shutdown()
+
+    def test_stuck_check_keeps_its_thread(self):
+        from sauna import Sauna, result_store, skipped_runs
+        sauna = Sauna(config={
+            'concurrency': 2,
+            'check_timeout': 0.1,
+            'plugins': [{
+                'type': 'Dummy',
+                'checks': [{'type': 'dummy', 'name': 'stuck_dummy'},
+                           {'type': 'dummy', 'name': 'healthy_dummy'}]
+            }]
+        })
+        release = threading.Event()
+        stuck, healthy = sauna.check_registry.checks
+        stuck.check_func = blocking_check('stuck_dummy', release).check_func
+        skipped = skipped_runs.get(check='stuck_dummy')
+        try:
+            for _ in range(3):
+                sauna.launch_and_publish_checks(sauna.check_registry.checks)
+                time.sleep(0.2)
+                service_check = result_store.remove('healthy_dummy')
+                self.assertEqual(service_check.status, Plugin.STATUS_OK)
+            service_check = result_store.remove('stuck_dummy')
+            self.assertEqual(service_check.status, Plugin.STATUS_UNKNOWN)
+
+            # The stuck check is not resubmitted until its thread returns
+            self.assertEqual(skipped_runs.get(check='stuck_dummy'),
+                             skipped + 2)
+            release.set()
+            for _ in range(100):
+                with sauna._current_checks_lock:
+                    if not sauna._current_checks:
+                        break
+                time.sleep(0.01)
+            self.assertEqual(sauna._current_checks, [])
+        finally:
+            release.set()
+            sauna._thread_pool.shutdown()
+            sauna._watchdog.shutdown()
+
+
+class FailingQueue:
+
+    def put(self, item):
+        raise OSError('No space left on device')
+
+
+class SaunaPublishTest(unittest.TestCase):
+
+    def _sauna(self, **config):
+        from sauna import Sauna
+        sauna = Sauna(config=dict(config, plugins=[{
+            'type': 'Dummy',
+            'checks': [{'type': 'dummy', 'name': 'publish_dummy'}]
+        }]))
+        sauna._consumers_queues = [FailingQueue()]
+        return sauna
+
+    def test_failing_queue_serial(self):
+        from sauna import result_store
+        sauna = self._sauna()
+        try:
+            with self.assertLogs('sauna', level='ERROR'):
+                sauna.launch_and_publish_checks(sauna.check_registry.checks)
+        finally:
+            sauna._serial_executor.shutdown()
+            sauna._watchdog.shutdown()
+        self.assertIsNotNone(result_store.remove('publish_dummy'))
+
+    def test_failing_queue_releases_check(self):
+        from sauna import result_store
+        sauna = self._sauna(concurrency=2)
+        try:
+            sauna.launch_and_publish_checks(sauna.check_registry.checks)
+            for _ in range(100):
+                with sauna._current_checks_lock:
+                    if not sauna._current_checks:
+                        break
+                time.sleep(0.01)
+        finally:
+            sauna._thread_pool.shutdown()
+            sauna._watchdog.shutdown()
+        self.assertEqual(sauna._current_checks, [])
+        self.assertIsNotNone(result_store.remove('publish_dummy'))
@@ -1,3 +1,5 @@
+import functools
+import threading
 import unittest
 from collections import namedtuple
 
@@ -9,6 +11,7 @@ except ImportError:
 
 from sauna.plugins import (human_to_bytes, bytes_to_human, Plugin,
                            PluginRegister)
+from sauna.plugins.base import Check, CheckRegistry, RateSampler
 from sauna.plugins.ext import (puppet_agent, postfix, memcached, processes,
                                hwmon, mdstat, ntpd, dummy, http_json,
                                supervisor, simple_domain, network)
@@ -126,6 +129,46 @@ class PluginsTest(unittest.TestCase):
             Plugin.status_code_to_str(42), 'UNKNOWN'
         )
 
+    def test_invalidate_cache(self):
+        class Cached(Plugin):
+            cached_attributes = ('_foo', '_bar')
+
+        plugin = Cached({})
+        plugin._foo, plugin._bar, plugin._baz = 1, 2, 3
+        plugin.invalidate_cache()
+        self.assertIsNone(plugin._foo)
+        self.assertIsNone(plugin._bar)
+        self.assertEqual(plugin._baz, 3)
+
+
+class CheckRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = dummy.Dummy({})
+        self.plugin.invalidate_cache = mock.Mock()
+        self.checks = [
+            Check('a', 60, self.plugin.dummy, {}),
+            Check('b', 300, self.plugin.dummy, {}),
+            Check('c', 60, self.plugin.dummy, {}),
+        ]
+        self.registry = CheckRegistry(self.checks)
+
+    def test_check_plugin(self):
+        self.assertIs(self.checks[0].plugin, self.plugin)
+        self.assertIsNone(Check('d', 60, lambda config: (0, ''), {}).plugin)
+
+    def test_get_checks(self):
+        self.assertSetEqual(self.registry.periodicities, {60, 300})
+        self.assertListEqual(self.registry.get_checks(60),
+                             [self.checks[0], self.checks[2]])
+        self.assertListEqual(self.registry.get_checks(300),
+                             [self.checks[1]])
+        self.assertListEqual(self.registry.get_checks(10), [])
+
+    def test_invalidate_plugins_cache(self):
+        CheckRegistry.invalidate_plugins_cache(self.registry.get_checks(60))
+        self.plugin.invalidate_cache.assert_called_once_with()
+
 
 class PuppetAgentTest(unittest.TestCase):
     def setUp(self):
@@ -278,6 +321,23 @@ class MemcachedTest(unittest.TestCase):
             (Plugin.STATUS_WARN, 'Memcached holds 100 items')
         )
 
+    def test_stats_invalidated_after_fetching(self):
+        class RacingMemcached(memcached.Memcached):
+            def __setattr__(self, name, value):
+                super().__setattr__(name, value)
+                if name == '_stats':
+                    # Another run of checks resets the cache right away
+                    super().__setattr__(name, None)
+
+        plugin = RacingMemcached({})
+        plugin._fetch_memcached_stats = (
+            lambda: b'STAT curr_items 100\r\nEND\r\n'
+        )
+        self.assertTupleEqual(
+            plugin.current_items({'warn': 50, 'crit': 200}),
+            (Plugin.STATUS_WARN, 'Memcached holds 100 items')
+        )
+
     def test_accepting_connections(self):
         self.memcached._stats = {'accepting_conns': 1}
         self.assertTupleEqual(
@@ -314,9 +374,18 @@ class ProcessesTest(unittest.TestCase):
         Processes.__init__ = lambda *args, **kwargs: None
         self.processes = Processes({})
         self.processes.psutil = mock.Mock()
+        self.processes._process_table = None
+        self.processes._wanted_attrs = {'pid'}
+        self.processes._process_table_lock = threading.Lock()
+        self.processes._fd_limits = {}
+
+    def set_processes(self, *infos):
+        self.processes.psutil.process_iter.return_value = [
+            mock.Mock(info=info) for info in infos
+        ]
 
     def test_count(self):
-        self.processes.psutil.pids.return_value = [1, 2, 3]
+        self.set_processes({'pid': 1}, {'pid': 2}, {'pid': 3})
         self.assertTupleEqual(
             self.processes.count({'warn': 5, 'crit': 10}),
             (Plugin.STATUS_OK, '3 processes')
@@ -331,36 +400,24 @@ class ProcessesTest(unittest.TestCase):
         )
 
     def test_zombies(self):
-        class Process:
-            def __init__(self, status='sleeping'):
-                self._status = status
-
-            def status(self):
-                return self._status
-
-        self.processes.psutil.process_iter.return_value = [
-            Process('sleeping'),
-            Process('zombie'),
-            Process('sleeping'),
-        ]
+        self.set_processes(
+            {'pid': 1, 'status': 'sleeping'},
+            {'pid': 2, 'status': 'zombie'},
+            {'pid': 3, 'status': 'sleeping'},
+        )
         self.assertTupleEqual(
             self.processes.zombies({'warn': 1, 'crit': 10}),
             (Plugin.STATUS_WARN, '1 zombies')
         )
 
     def test_count_running_processes(self):
-        class Process:
-            def __init__(self, cmdline):
-                self._cmdline = cmdline
-
-            def cmdline(self):
-                return self._cmdline
-
-        self.processes.psutil.process_iter.return_value = [
-            Process(['/bin/bash']),
-            Process(['/bin/bash']),
-            Process(['/usr/sbin/sshd', '-D']),
-        ]
+        self.set_processes(
+            {'pid': 1, 'cmdline': ['/bin/bash']},
+            {'pid': 2, 'cmdline': ['/bin/bash']},
+            {'pid': 3, 'cmdline': ['/usr/sbin/sshd', '-D']},
+            {'pid': 4, 'cmdline': []},
+            {'pid': 5, 'cmdline': None},
+        )
 
         check_config = {'exec': '/bin/bash'}
         self.assertEqual(
@@ -383,6 +440,117 @@ class ProcessesTest(unittest.TestCase):
             self.processes._count_running_processes(check_config), 0
         )
 
+    def test_process_table_shared(self):
+        self.set_processes(
+            {'pid': 1, 'cmdline': ['/bin/bash'], 'status': 'zombie'},
+        )
+        self.processes.zombies({'warn': 1, 'crit': 10})
+        self.processes.count({'warn': 1, 'crit': 10})
+        self.processes.running({'exec': '/bin/bash'})
+        self.processes.running({'exec': '/bin/sh'})
+        # Running needed the command line not collected yet
+        self.assertEqual(self.processes.psutil.process_iter.call_count, 2)
+        self.assertSetEqual(
+            set(self.processes.psutil.process_iter.call_args[1]['attrs']),
+            {'pid', 'status', 'cmdline'}
+        )
+
+        # Once all attributes are known a single pass answers all checks
+        self.processes.invalidate_cache()
+        self.processes.zombies({'warn': 1, 'crit': 10})
+        self.processes.running({'exec': '/bin/bash'})
+        self.processes.count({'warn': 1, 'crit': 10})
+        self.assertEqual(self.processes.psutil.process_iter.call_count, 3)
+
+    def test_processes_exhausting_fds(self):
+        self.set_processes(
+            {'pid': 1, 'name': 'nginx', 'num_fds': 90, 'create_time': 1.0},
+            {'pid': 2, 'name': 'sshd', 'num_fds': 10, 'create_time': 1.0},
+            {'pid': 3, 'name': 'secret', 'num_fds': None, 'create_time': 1.0},
+        )
+        self.processes._read_fd_limit = lambda pid: 100
+        self.assertEqual(
+            self.processes._get_processes_exhausting_fds({'warn': 80,
+                                                          'crit': 95}),
+            ({'nginx'}, 90)
+        )
+
+    def test_fd_limits_cache(self):
+        psutil = self.processes.psutil
+        psutil.RLIM_INFINITY = -1
+        psutil.Process.return_value.rlimit.return_value = (1024, 4096)
+        self.processes._fd_limits = {}
+        self.set_processes(
+            {'pid': 1, 'create_time': 1.0},
+            {'pid': 2, 'create_time': 1.0},
+        )
+        table = self.processes._get_process_table('create_time')
+        self.assertDictEqual(self.processes._get_fd_limits(table),
+                             {1: 1024, 2: 1024})
+        psutil.Process.return_value.rlimit.assert_called_with(
+            psutil.RLIMIT_NOFILE
+        )
+        self.assertEqual(psutil.Process.call_count, 2)
+
+        # Only new processes and reused pids get their limit read again
+        self.processes.invalidate_cache()
+        self.set_processes(
+            {'pid': 2, 'create_time': 5.0},
+            {'pid': 3, 'create_time': 5.0},
+        )
+        psutil.Process.return_value.rlimit.return_value = (-1, -1)
+        table = self.processes._get_process_table('create_time')
+        self.assertDictEqual(self.processes._get_fd_limits(table),
+                             {2: None, 3: None})
+        self.assertEqual(psutil.Process.call_count, 4)
+        self.assertListEqual(sorted(self.processes._fd_limits), [2, 3])
+
+    def test_read_fd_limit_fallback(self):
+        psutil = self.processes.psutil
+        psutil.AccessDenied = type('AccessDenied', (Exception,), {})
+        psutil.Process.return_value.rlimit.side_effect = psutil.AccessDenied
+        self.processes._get_process_fd_limit = lambda pid: 512
+        self.assertEqual(self.processes._read_fd_limit(1), 512)
+
+        del psutil.RLIMIT_NOFILE
+        psutil.Process.reset_mock()
+        self.assertEqual(self.processes._read_fd_limit(1), 512)
+        psutil.Process.assert_not_called()
+
+    def test_get_process_fd_limit(self):
+        limits = ('Limit                     Soft Limit           Hard Limit'
+                  '           Units\n'
+                  'Max open files            {}                 {}      '
+                  '           files\n')
+        for content, expected in ((limits.format(1024, 4096), 1024),
+                                  (limits.format('unlimited', 'unlimited'),
+                                   None)):
+            with mock.patch('builtins.open',
+                            mock.mock_open(read_data=content)):
+                self.assertEqual(self.processes._get_process_fd_limit(1),
+                                 expected)
+        with mock.patch('builtins.open', mock.mock_open(read_data='')):
+            with self.assertRaises(ValueError):
+                self.processes._get_process_fd_limit(1)
+
+    def test_fd_limits_parse_error(self):
+        def read_fd_limit(pid):
+            if pid == 1:
+                raise ValueError('Cannot parse /proc/1/limits')
+            return 1024
+
+        self.processes.psutil.NoSuchProcess = type('NoSuchProcess',
+                                                   (Exception,), {})
+        self.processes._fd_limits = {}
+        self.processes._read_fd_limit = read_fd_limit
+        self.set_processes(
+            {'pid': 1, 'create_time': 1.0},
+            {'pid': 2, 'create_time': 1.0},
+        )
+        table = self.processes._get_process_table('create_time')
+        self.assertDictEqual(self.processes._get_fd_limits(table),
+                             {2: 1024})
+
     def test_running_without_nb(self):
         check_config = {'exec': 'bash'}
         self.processes._count_running_processes = lambda *args, **kwargs: 0
@@ -837,36 +1005,88 @@ class SupervisorPluginTest(unittest.TestCase):
 
 
 class NetworkTest(unittest.TestCase):
-    def setUp(self):
-        Network = network.Network
-        self.network = Network({})
 
-    @mock.patch('time.sleep', autospec=True)
-    @mock.patch('time.time')
-    def test_get_network_data(self, time_mock, sleep_mock):
-        time_mock.side_effect = [1, 2]
+    Counter = namedtuple('Counter',
+                         ['bytes_sent', 'bytes_recv', 'packets_sent',
+                          'packets_recv'])
 
-        Counter = namedtuple('Counter',
-                             ['bytes_sent', 'bytes_recv', 'packets_sent',
-                              'packets_recv'])
-
-        first_counter = Counter(bytes_sent=54000, bytes_recv=12000,
-                                packets_sent=50, packets_recv=100)
-        second_counter = Counter(bytes_sent=108000, bytes_recv=36000,
-                                 packets_sent=75, packets_recv=150)
-
-        m = mock.Mock()
-        m.side_effect = [
+    @mock.patch('time.sleep', autospec=True)
+    def test_get_network_data(self, sleep_mock):
+        clock = mock.Mock(side_effect=[1, 2, 2])
+        first_counter = self.Counter(bytes_sent=54000, bytes_recv=12000,
+                                     packets_sent=50, packets_recv=100)
+        second_counter = self.Counter(bytes_sent=108000, bytes_recv=36000,
+                                      packets_sent=75, packets_recv=150)
+        psutil = mock.Mock()
+        psutil.net_io_counters.side_effect = [
             {'eth0': first_counter}, {'eth0': second_counter}
         ]
 
-        self.network.psutil.net_io_counters = m
+        sampler = functools.partial(RateSampler, clock=clock)
+        with mock.patch.dict('sys.modules', psutil=psutil), \
+                mock.patch.object(network, 'RateSampler', sampler):
+            self.network = network.Network({})
         kb_ul, kb_dl, p_ul, p_dl = self.network.get_network_data(
-            interface='eth0', delay=1)
+            interface='eth0')
         self.assertEqual(kb_ul, 54000)
         self.assertEqual(kb_dl, 24000)
         self.assertEqual(p_ul, 25)
         self.assertEqual(p_dl, 50)
+        psutil.net_io_counters.assert_called_with(pernic=True)
+        sleep_mock.assert_not_called()
+
+
+class RateSamplerTest(unittest.TestCase):
+
+    Counter = namedtuple('Counter', ['read', 'write'])
+
+    def setUp(self):
+        self.now = 0
+        self.samples = []
+        self.sampler = RateSampler(lambda: self.samples.pop(0),
+                                   min_interval=1, clock=lambda: self.now)
+
+    def test_rates_without_sleeping(self):
+        self.samples = [
+            {'sda': self.Counter(100, 10)},
+            {'sda': self.Counter(300, 10), 'sdb': self.Counter(0, 0)},
+            {'sda': self.Counter(400, 10), 'sdb': self.Counter(50, 0)},
+        ]
+        self.sampler.prime()
+        self.now = 2
+        with mock.patch('time.sleep') as sleep_mock:
+            self.assertDictEqual(self.sampler.rates(),
+                                 {'sda': self.Counter(100, 0)})
+            # Rates are shared until a new sample is worth taking
+            self.now = 2.5
+            self.assertDictEqual(self.sampler.rates(),
+                                 {'sda': self.Counter(100, 0)})
+            self.now = 4
+            self.assertDictEqual(self.sampler.rates(), {
+                'sda': self.Counter(50, 0), 'sdb': self.Counter(25, 0)
+            })
+        sleep_mock.assert_not_called()
+        self.assertListEqual(self.samples, [])
+
+    def test_first_rates_wait(self):
+        self.samples = [{'sda': self.Counter(0, 0)},
+                        {'sda': self.Counter(10, 20)}]
+
+        def sleep(seconds):
+            self.now += seconds
+
+        with mock.patch('time.sleep', side_effect=sleep) as sleep_mock:
+            self.assertDictEqual(self.sampler.rates(),
+                                 {'sda': self.Counter(10, 20)})
+        sleep_mock.assert_called_once_with(1)
+
+    def test_counter_reset(self):
+        self.samples = [{'eth0': self.Counter(1000, 10)},
+                        {'eth0': self.Counter(10, 20)}]
+        self.sampler.prime()
+        self.now = 10
+        self.assertDictEqual(self.sampler.rates(),
+                             {'eth0': self.Counter(0, 1)})
 
 
 class SimpleDomainTest(unittest.TestCase):
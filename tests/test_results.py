@@ -0,0 +1,86 @@
+import threading
+import unittest
+
+from sauna import ServiceCheck
+from sauna.plugins.base import Plugin
+from sauna.results import ResultStore
+
+
+def service_check(name, status=Plugin.STATUS_OK, output='OK'):
+    return ServiceCheck(timestamp=42, hostname='server1', name=name,
+                        status=status, output=output)
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ResultStore()
+
+    def test_empty(self):
+        snapshot = self.store.snapshot()
+        self.assertEqual(snapshot.version, 0)
+        self.assertDictEqual(dict(snapshot.results), {})
+        self.assertEqual(snapshot.worst_status, Plugin.STATUS_OK)
+
+    def test_publish(self):
+        empty = self.store.snapshot()
+        foo = service_check('foo')
+        self.store.publish(foo)
+        snapshot = self.store.snapshot()
+        self.assertEqual(snapshot.version, 1)
+        self.assertIs(snapshot.results['foo'], foo)
+        # Previous snapshots are not modified
+        self.assertDictEqual(dict(empty.results), {})
+        with self.assertRaises(TypeError):
+            snapshot.results['bar'] = foo
+
+    def test_same_result_keeps_snapshot(self):
+        self.store.publish(service_check('foo'))
+        snapshot = self.store.snapshot()
+        self.store.publish(service_check('foo'))
+        self.assertIs(self.store.snapshot(), snapshot)
+
+    def test_versions(self):
+        self.store.publish(service_check('foo'))
+        statuses_version = self.store.snapshot().statuses_version
+        self.store.publish(service_check('foo', output='Still OK'))
+        snapshot = self.store.snapshot()
+        self.assertEqual(snapshot.version, 2)
+        self.assertEqual(snapshot.statuses_version, statuses_version)
+        self.store.publish(service_check('foo', status=Plugin.STATUS_WARN))
+        self.assertEqual(self.store.snapshot().statuses_version,
+                         statuses_version + 1)
+
+    def test_worst_status(self):
+        self.store.publish(service_check('foo', status=Plugin.STATUS_CRIT))
+        self.store.publish(service_check('bar', status=Plugin.STATUS_WARN))
+        self.store.publish(service_check('baz', status=Plugin.STATUS_UNKNOWN))
+        snapshot = self.store.snapshot()
+        self.assertEqual(snapshot.worst_status, Plugin.STATUS_CRIT)
+        self.assertDictEqual(dict(snapshot.status_counts), {1: 1, 2: 1, 3: 1})
+
+        self.store.publish(service_check('foo'))
+        self.assertEqual(self.store.snapshot().worst_status,
+                         Plugin.STATUS_WARN)
+        self.assertIsNotNone(self.store.remove('bar'))
+        self.assertIsNone(self.store.remove('bar'))
+        snapshot = self.store.snapshot()
+        # Unknown statuses are ignored
+        self.assertEqual(snapshot.worst_status, Plugin.STATUS_OK)
+        self.assertDictEqual(dict(snapshot.status_counts), {0: 1, 3: 1})
+
+        self.store.clear()
+        self.assertDictEqual(dict(self.store.snapshot().status_counts), {})
+
+    def test_wait_for_change(self):
+        version = self.store.snapshot().version
+        snapshot = self.store.wait_for_change(version, timeout=0.01)
+        self.assertEqual(snapshot.version, version)
+
+        timer = threading.Timer(0.05, self.store.publish,
+                                args=(service_check('foo'),))
+        timer.start()
+        snapshot = self.store.wait_for_change(version, timeout=5)
+        timer.join()
+        self.assertEqual(snapshot.version, version + 1)
+        self.assertIn('foo', snapshot.results)
@@ -5,7 +5,7 @@ except ImportError:
     # Python 3.2 does not have mock in the standard library
     import mock
 
-from sauna.scheduler import Scheduler, Job
+from sauna.scheduler import Scheduler, Job, splay_offset
 
 
 class SchedulerTest(unittest.TestCase):
@@ -23,10 +23,7 @@ class SchedulerTest(unittest.TestCase):
         """
         mock1, mock2, mock3 = mock.Mock(), mock.Mock(), mock.Mock()
         ja, jb, jc = Job(1, mock1), Job(2, mock2), Job(3, mock3)
-        s = Scheduler([ja, jb, jc])
-
-        self.assertEqual(s.tick_duration, 1)
-        self.assertEqual(s._ticks, 6)
+        s = Scheduler([ja, jb, jc], clock=lambda: 0)
 
         self.assertListEqual(next(s), [ja, jb, jc])
         self.assertListEqual(next(s), [ja])
@@ -42,25 +39,90 @@ class SchedulerTest(unittest.TestCase):
     def test_scheduler_2_jobs(self):
         """Jobs every 1 and 5 min."""
         ja, jb = Job(60, lambda: None), Job(300, lambda: None)
-        s = Scheduler([ja, jb])
-
-        self.assertEqual(s.tick_duration, 60)
-        self.assertEqual(s._ticks, 5)
+        s = Scheduler([ja, jb], clock=lambda: 0)
 
         self.assertListEqual(next(s), [ja, jb])
         for _ in range(4):
             self.assertListEqual(next(s), [ja])
         self.assertListEqual(next(s), [ja, jb])
 
-    def test_number_of_ticks(self):
-        self.assertEqual(
-            Scheduler.find_minimum_ticks_required(1, {13, 15}),
-            195
-        )
-        self.assertEqual(
-            Scheduler.find_minimum_ticks_required(1, {5, 13, 1, 15}),
-            195
-        )
+    def test_time_until_next_run(self):
+        clock = mock.Mock(return_value=1000)
+        ja, jb = Job(7, lambda: None), Job(3600, lambda: None)
+        s = Scheduler([ja, jb], clock=clock)
+
+        self.assertEqual(s.time_until_next_run(), 0)
+        self.assertListEqual(next(s), [ja, jb])
+        self.assertEqual(s.next_deadline, 1007)
+        self.assertEqual(s.time_until_next_run(), 7)
+
+        clock.return_value = 1005
+        self.assertEqual(s.time_until_next_run(), 2)
+        clock.return_value = 1010
+        self.assertEqual(s.time_until_next_run(), 0)
+
+    def test_sub_second_periodicity(self):
+        ja, jb = Job(0.1, lambda: None), Job(0.3, lambda: None)
+        s = Scheduler([ja, jb], clock=lambda: 0)
+
+        self.assertListEqual(next(s), [ja, jb])
+        self.assertListEqual(next(s), [ja])
+        self.assertListEqual(next(s), [ja])
+        self.assertListEqual(next(s), [ja, jb])
+        self.assertAlmostEqual(s.next_deadline, 0.4)
+
+    def test_catch_up_after_stall(self):
+        clock = mock.Mock(return_value=0)
+        mock1 = mock.Mock()
+        ja = Job(10, mock1)
+        s = Scheduler([ja], clock=clock)
+
+        self.assertListEqual(next(s), [ja])
+        self.assertEqual(s.next_deadline, 10)
+
+        # The process is stalled for 35 seconds, the job runs only once
+        # and then goes back to its original schedule
+        clock.return_value = 45
+        self.assertListEqual(next(s), [ja])
+        self.assertEqual(mock1.call_count, 2)
+        self.assertEqual(s.next_deadline, 50)
+
+        # Running a bit late does not make the schedule drift
+        clock.return_value = 50.5
+        next(s)
+        self.assertEqual(s.next_deadline, 60)
+
+    def test_job_offset(self):
+        ja, jb = Job(10, lambda: None), Job(10, lambda: None)
+        jb.offset = 4
+        s = Scheduler([ja, jb], clock=lambda: 100)
+
+        self.assertListEqual(next(s), [ja])
+        self.assertEqual(s.next_deadline, 104)
+        self.assertListEqual(next(s), [jb])
+        self.assertListEqual(next(s), [ja])
+        self.assertEqual(s.next_deadline, 114)
+
+    def test_run_waits_for_first_offset(self):
+        mock1 = mock.Mock()
+        ja, jb = Job(10, mock1), Job(10, lambda: None)
+        ja.offset, jb.offset = 40, 50
+        s = Scheduler([ja, jb], clock=lambda: 0)
+
+        with mock.patch('sauna.scheduler.time.sleep',
+                        side_effect=[None, StopIteration]) as sleep_mock:
+            with self.assertRaises(StopIteration):
+                s.run()
+        self.assertEqual(sleep_mock.call_args_list[0], mock.call(40))
+        self.assertEqual(mock1.call_count, 1)
+        self.assertEqual(s.next_deadline, 50)
+
+    def test_no_jobs(self):
+        self.assertListEqual(list(Scheduler([])), [])
+
+    def test_invalid_periodicity(self):
+        with self.assertRaises(ValueError):
+            Scheduler([Job(0, lambda: None)])
 
 
 class JobTest(unittest.TestCase):
@@ -75,3 +137,24 @@ class JobTest(unittest.TestCase):
     def test_non_callable_job(self):
         with self.assertRaises(ValueError):
             Job(10, 'foo')
+
+
+class SplayTest(unittest.TestCase):
+
+    def test_splay_offset_is_deterministic(self):
+        self.assertEqual(splay_offset('node-1/load', 60),
+                         splay_offset('node-1/load', 60))
+        self.assertNotEqual(splay_offset('node-1/load', 60),
+                            splay_offset('node-2/load', 60))
+
+    def test_splay_offset_is_spread_in_window(self):
+        offsets = [splay_offset('node-{}/load'.format(i), 60)
+                   for i in range(1000)]
+        for offset in offsets:
+            self.assertGreaterEqual(offset, 0)
+            self.assertLess(offset, 60)
+        # Roughly uniform: each quarter of the window gets some checks
+        for quarter in range(4):
+            in_quarter = [o for o in offsets
+                          if quarter * 15 <= o < (quarter + 1) * 15]
+            self.assertGreater(len(in_quarter), 150)